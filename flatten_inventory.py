@@ -0,0 +1,87 @@
+"""
+Flatten every in-network file in a downloader inventory
+
+    python3 flatten_inventory.py \
+    --inventory transparency-in-coverage/python/downloaders/aetna_data.db \
+    --output-dir aetna_csv --jobs 8 --memory 64
+
+Files run largest first, each in its own process and output directory,
+as many at a time as fit in --memory (see mrfutils/scheduler.py). Their
+status is kept in the inventory's flatten_jobs table, so running this
+again picks up where it left off.
+"""
+import argparse
+import logging
+
+from mrfutils.helpers import import_csv_to_set
+from mrfutils.manifest import Manifest
+from mrfutils.metrics import format_bytes
+from mrfutils.scheduler import ATTEMPTS, MEMORY_BASE, MEMORY_PER_BYTE, MemoryModel, Scheduler
+from mrfutils.sinks import SINKS
+
+def main():
+    parser = argparse.ArgumentParser(description='Flatten the in-network files in a downloader inventory')
+    parser.add_argument('--inventory', required=True,
+                      help='sqlite file with an in_network_files(url, size) table')
+    parser.add_argument('--output-dir', required=True,
+                      help='Base directory for output files, one directory per file')
+    parser.add_argument('--jobs', type=int,
+                      help='Files to flatten at a time (default: one per core)')
+    parser.add_argument('--memory', type=float,
+                      help='GB of memory for all the files running at once (default: 80%% of this machine)')
+    parser.add_argument('--memory-base', type=float, default=MEMORY_BASE / 2**20,
+                      help='MB of memory a file needs, whatever its size')
+    parser.add_argument('--memory-per-gb', type=float, default=MEMORY_PER_BYTE,
+                      help='GB of memory a file needs per GB of its size, on top of --memory-base')
+    parser.add_argument('--attempts', type=int, default=ATTEMPTS,
+                      help='Times to try a file before marking it failed')
+    parser.add_argument('--retry-failed', action='store_true',
+                      help='Try the files that failed in an earlier run again')
+    parser.add_argument('--status', action='store_true',
+                      help='Print what is done, failed and left, and the order the rest would run in')
+    parser.add_argument('--code-file',
+                      help='Optional billing code CSV')
+    parser.add_argument('--npi-file',
+                      help='Optional NPI CSV')
+    parser.add_argument('--engine', default='parse')
+    parser.add_argument('--workers', type=int, default=0,
+                      help='Processes for building rows, per file')
+    parser.add_argument('--format', choices=tuple(SINKS), default='csv')
+    parser.add_argument('--manifest',
+                      help='Skip files this manifest (a sqlite file) says were already flattened with the same filters')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
+    scheduler = Scheduler(
+        args.inventory,
+        args.output_dir,
+        jobs = args.jobs,
+        memory = int(args.memory * 2**30) if args.memory else None,
+        memory_model = MemoryModel(args.memory_base * 2**20, args.memory_per_gb),
+        attempts = args.attempts,
+    )
+
+    with scheduler:
+        if args.status:
+            scheduler.sync()
+            for status, counts in scheduler.status().items():
+                print(f"{status:<8} {counts['files']:>8,} files {format_bytes(counts['bytes']):>12}")
+            for job in scheduler.plan(args.workers)[:20]:
+                size = 'unknown' if job.size is None else format_bytes(job.size)
+                print(f"{size:>12} {format_bytes(job.estimate):>12}  {job.url}")
+            return
+
+        scheduler.run(
+            retry_failed = args.retry_failed,
+            code_filter = import_csv_to_set(args.code_file) if args.code_file else None,
+            npi_filter = import_csv_to_set(args.npi_file) if args.npi_file else None,
+            engine = args.engine,
+            workers = args.workers,
+            out_format = args.format,
+            manifest = Manifest(args.manifest) if args.manifest else None,
+        )
+
+if __name__ == "__main__":
+    main()
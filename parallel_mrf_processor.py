@@ -1,43 +1,27 @@
 import os
 import glob
-from multiprocessing import Pool, cpu_count
-import subprocess
 from pathlib import Path
 import argparse
+import logging
 
-def process_npi_file(args):
+from mrfutils.helpers import import_csv_to_set
+from mrfutils.flatteners import in_network_file_to_csv
+from mrfutils.metrics import RunStats
+
+def load_npi_files(npi_files):
     """
-    Process a single NPI file using the example_cli.py script
+    Build the tenant map for in_network_file_to_csv. Each NPI file is one
+    tenant, written to output_<npi filename> like before
     """
-    npi_file, base_output_dir, url, input_file = args
-    # Create output directory based on NPI filename
-    npi_filename = Path(npi_file).stem
-    output_dir = os.path.join(base_output_dir, f"output_{npi_filename}")
-    
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Construct the command
-    cmd = [
-        "python3",
-        "transparency-in-coverage/python/mrfutils/examples/example_cli.py",
-        "--out-dir", output_dir,
-        "--npi-file", npi_file,
-        "--url", url,
-        "--file", input_file
-    ]
-    
-    try:
-        # Run the command
-        subprocess.run(cmd, check=True)
-        print(f"Successfully processed {npi_file}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error processing {npi_file}: {str(e)}")
+    return {
+        f"output_{Path(npi_file).stem}": import_csv_to_set(npi_file)
+        for npi_file in npi_files
+    }
 
 def main():
     # Set up argument parser
-    parser = argparse.ArgumentParser(description='Process multiple NPI files in parallel')
-    parser.add_argument('--npi-dir', required=True, 
+    parser = argparse.ArgumentParser(description='Process multiple NPI files in a single pass over the MRF')
+    parser.add_argument('--npi-dir', required=True,
                       help='Directory containing NPI CSV files')
     parser.add_argument('--output-dir', required=True,
                       help='Base directory for output files')
@@ -45,33 +29,41 @@ def main():
                       help='URL for the MRF data')
     parser.add_argument('--file', required=True,
                       help='Input file path')
-    
+    parser.add_argument('--code-file',
+                      help='Optional billing code CSV applied to every NPI file')
+
     args = parser.parse_args()
-    
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
+
     # Ensure output directory exists
     os.makedirs(args.output_dir, exist_ok=True)
-    
+
     # Get all CSV files in the directory
     npi_files = glob.glob(os.path.join(args.npi_dir, "*.csv"))
-    
+
     if not npi_files:
         print(f"No NPI files found in the specified directory: {args.npi_dir}")
         return
-    
-    # Get the number of CPU cores
-    num_processes = cpu_count()
+
     print(f"Found {len(npi_files)} NPI files to process")
-    print(f"Using {num_processes} CPU cores for parallel processing")
     print(f"Output will be saved in: {args.output_dir}")
     print(f"Using URL: {args.url}")
     print(f"Using input file: {args.file}")
-    
-    # Create arguments for each process
-    process_args = [(npi_file, args.output_dir, args.url, args.file) for npi_file in npi_files]
-    
-    # Create a pool of workers and process files in parallel
-    with Pool(processes=num_processes) as pool:
-        pool.map(process_npi_file, process_args)
+
+    code_filter = import_csv_to_set(args.code_file) if args.code_file else None
+
+    # One parse of the input file fans out to every NPI file's output
+    # directory, instead of one subprocess (and one full parse) per NPI file
+    in_network_file_to_csv(
+        url = args.url,
+        out_dir = args.output_dir,
+        file = args.file,
+        code_filter = code_filter,
+        tenants = load_npi_files(npi_files),
+        stats = RunStats(progress = True),
+    )
+    print(f"Successfully processed {len(npi_files)} NPI files")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
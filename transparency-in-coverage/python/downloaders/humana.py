@@ -1,9 +1,8 @@
 import requests
-import sqlite3
 
-con = sqlite3.connect("humana_data.db")
-cur = con.cursor()
-cur.execute("CREATE TABLE IF NOT EXISTS in_network_files(url PRIMARY KEY UNIQUE, size)")
+from mrfutils.inventory import Inventory
+
+inventory = Inventory("humana_data.db")
 
 params = {"fileType": "innetwork", "iDisplayLength": "2000", "iDisplayStart": 0}
 
@@ -15,20 +14,18 @@ while not finished:
         "https://developers.humana.com/Resource/GetData", params=params
     ).json()
     if len(resp["aaData"]) > 0:
-        for file in resp["aaData"]:
-            url = (
+        # The listing has the sizes, so there's nothing to probe
+        inventory.add(
+            (
                 "https://developers.humana.com/Resource/DownloadPCTFile?fileType=innetwork&"
-                + file["name"]
-            )
-            size = int(file["size"])
-            cur.execute(
-                f"""INSERT OR IGNORE INTO in_network_files VALUES ("{url}", {size})"""
+                + file["name"],
+                int(file["size"]),
             )
+            for file in resp["aaData"]
+        )
     else:
         finished = True
 
-    con.commit()
-
     # Update the counter to get the next batch
     params["iDisplayStart"] += len(resp["aaData"])
     print(
@@ -36,5 +33,6 @@ while not finished:
         end="",
     )
 
-total = cur.execute("SELECT SUM(size) FROM in_network_files").fetchone()[0]
+total = inventory.total_size()
+inventory.close()
 print(f"\nTotal filesize in GB: {total//1_000_000_000}")
@@ -1,13 +1,8 @@
 import glob
 import json
-import sqlite3
-import asyncio
-import aiohttp
 from tqdm import tqdm
 
-con = sqlite3.connect("anthem_data.db")
-cur = con.cursor()
-cur.execute("CREATE TABLE IF NOT EXISTS in_network_files(url PRIMARY KEY UNIQUE, size)")
+from mrfutils.inventory import Inventory, fetch_url_sizes
 
 files = glob.glob('./2022-09-01_anthem_index_json/*')
 
@@ -25,26 +20,10 @@ for file in tqdm(files):
 			for in_network_file in in_network_files:
 				urls.add(in_network_file['location'])
 
-async def fetch_url_sizes(table, urls):
-    """
-    Simple async function for getting all the file sizes in a list of urls
-    and writing those to a SQLite table
-    """
-    
-    session = aiohttp.ClientSession()
-    fs = [session.head(url) for url in urls]
-
-    for f in asyncio.as_completed(fs):
-        resp = await f
-        url = str(resp.url)
-        size = int(resp.headers.get("content-length", -1))
-        cur.execute(f"""INSERT OR IGNORE INTO {table} VALUES ("{url}", {size})""")
-        con.commit()
-        
-    await session.close()
-
-print(f"Fetching {len(urls)} URLs and their sizes...")
-asyncio.run(fetch_url_sizes("in_network_files", urls))
-total = cur.execute("SELECT SUM(size) FROM in_network_files").fetchone()[0]
+# A SQLite table of URLs and filesizes
+with Inventory("anthem_data.db") as inventory:
+    print(f"Fetching {len(urls)} URLs and their sizes...")
+    fetch_url_sizes(inventory, urls)
+    total = inventory.total_size()
 
 print(f"Total filesize in GB: {total//1_000_000_000}")
@@ -0,0 +1,61 @@
+"""
+Compares the parsing engines of in_network_file_to_csv
+
+>>> python3 bench_engines.py --file in-network.json.gz [--code-file codes.csv] [--npi-file npis.csv]
+
+Counts the JSON events in the file once, then runs the flattener with each
+engine into a temporary directory and prints seconds and events/sec. Also
+checks that every engine wrote the same CSVs.
+"""
+import argparse
+import filecmp
+import logging
+import os
+import tempfile
+import time
+
+import ijson
+
+from mrfutils.flatteners import ENGINES, in_network_file_to_csv
+from mrfutils.helpers import JSONOpen, import_csv_to_set
+
+logging.disable(logging.CRITICAL)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--file', required = True)
+parser.add_argument('-u', '--url', default = 'http://example.com/bench.json.gz')
+parser.add_argument('-c', '--code-file')
+parser.add_argument('-n', '--npi-file')
+args = parser.parse_args()
+
+code_filter = import_csv_to_set(args.code_file) if args.code_file else None
+npi_filter = import_csv_to_set(args.npi_file) if args.npi_file else None
+
+with JSONOpen(args.file) as f:
+    n_events = sum(1 for _ in ijson.basic_parse(f))
+
+print(f'{args.file}: {n_events:,} events (ijson backend: {ijson.backend})')
+
+with tempfile.TemporaryDirectory() as tmp:
+    base = None
+    for engine in ENGINES:
+        out_dir = os.path.join(tmp, engine)
+        start = time.perf_counter()
+        in_network_file_to_csv(
+            url = args.url,
+            out_dir = out_dir,
+            file = args.file,
+            code_filter = code_filter,
+            npi_filter = npi_filter,
+            engine = engine,
+        )
+        elapsed = time.perf_counter() - start
+        print(f'{engine:<12} {elapsed:8.2f}s {n_events / elapsed:>14,.0f} events/sec')
+
+        if base is None:
+            base = out_dir
+            continue
+
+        _, mismatch, errors = filecmp.cmpfiles(base, out_dir, os.listdir(base), shallow = False)
+        if mismatch or errors:
+            print(f'  output differs from {ENGINES[0]}: {mismatch + errors}')
@@ -0,0 +1,81 @@
+"""
+Micro-benchmark for the row id hashers
+
+>>> python3 bench_hashers.py --rows 200000
+
+Hashes the same realistic code/rate_metadata/rate/tin rows with the
+original `dicthasher` and with RowHasher in both modes, and prints rows/sec
+for each. The compat ids are checked against dicthasher while we're at it.
+"""
+import argparse
+import json
+import random
+import time
+
+from mrfutils.hashers import RowHasher, xxhash
+from mrfutils.helpers import dicthasher
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--rows', type = int, default = 200_000)
+parser.add_argument('-s', '--seed', type = int, default = 0)
+args = parser.parse_args()
+
+
+def make_rows(n, seed):
+    """Rows shaped like the ones the flattener builds"""
+    rnd = random.Random(seed)
+    rows = []
+    for _ in range(n // 4):
+        code_row = dict(
+            billing_code_type = rnd.choice(['CPT', 'HCPCS', 'MS-DRG']),
+            billing_code_type_version = '2023',
+            billing_code = str(rnd.randint(10000, 99999)),
+        )
+        rate_metadata_row = dict(
+            billing_class = rnd.choice(['professional', 'institutional']),
+            negotiated_type = rnd.choice(['negotiated', 'fee schedule']),
+            expiration_date = '9999-12-31',
+            additional_information = None,
+            service_code = json.dumps(sorted(rnd.sample(['01', '11', '21', '22', '23'], 3))),
+        )
+        rate_row = dict(
+            code_id = rnd.getrandbits(64),
+            rate_metadata_id = rnd.getrandbits(64),
+            negotiated_rate = round(rnd.uniform(1, 5000), 2),
+        )
+        tin_row = dict(
+            tin_type = 'ein',
+            tin_value = f'{rnd.randint(10, 99)}-{rnd.randint(1000000, 9999999)}',
+        )
+        rows += [
+            ('code', code_row),
+            ('rate_metadata', rate_metadata_row),
+            ('rate', rate_row),
+            ('tin', tin_row),
+        ]
+    return rows
+
+
+def bench(name, func, rows):
+    start = time.perf_counter()
+    for table_name, row in rows:
+        func(row, table_name)
+    elapsed = time.perf_counter() - start
+    rate = len(rows) / elapsed
+    print(f'{name:<28} {rate:>12,.0f} rows/sec')
+    return rate
+
+
+rows = make_rows(args.rows, args.seed)
+
+compat = RowHasher('compat')
+fast = RowHasher('fast')
+
+for table_name, row in rows[:10_000]:
+    assert compat(row, table_name) == dicthasher(row)
+
+print(f'{len(rows):,} rows, fast digest: {"xxh3" if xxhash else "blake2b"}')
+base = bench('dicthasher', lambda row, _: dicthasher(row), rows)
+for name, hasher in (('RowHasher compat', compat), ('RowHasher fast', fast)):
+    rate = bench(name, hasher, rows)
+    print(f'{"":<28} {rate / base:>12.2f}x dicthasher')
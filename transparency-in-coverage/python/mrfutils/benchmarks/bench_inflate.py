@@ -0,0 +1,67 @@
+"""
+Compares the inflate backends in mrfutils.inflate
+
+>>> python3 bench_inflate.py --file in-network.json.gz [--parse]
+
+Decompresses the file with every backend that's installed and prints MB/s
+of decompressed output, on this thread and through the background reader
+thread. With --parse, each run also feeds the bytes through
+ijson.basic_parse, which shows how much of the inflate time the background
+thread hides behind parsing. Also checks that every backend produces the
+same bytes.
+"""
+import argparse
+import hashlib
+import os
+import time
+
+import ijson
+
+from mrfutils.inflate import available_backends, open_mrf_gzip
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--file', required = True)
+parser.add_argument('-p', '--parse', action = 'store_true')
+args = parser.parse_args()
+
+READ_SIZE = 2**20
+
+
+def run(backend, threaded):
+    f = open_mrf_gzip(filename = args.file, backend = backend, threaded = threaded)
+    digest = hashlib.md5()
+    n_bytes = 0
+
+    start = time.perf_counter()
+    try:
+        if args.parse:
+            for _ in ijson.basic_parse(f):
+                pass
+        else:
+            while data := f.read(READ_SIZE):
+                digest.update(data)
+                n_bytes += len(data)
+    finally:
+        f.close()
+
+    return time.perf_counter() - start, n_bytes, digest.hexdigest()
+
+
+size_mb = os.path.getsize(args.file) / 2**20
+print(f'{args.file}: {size_mb:.1f}MB compressed (ijson backend: {ijson.backend})')
+
+digests = {}
+for backend in available_backends():
+    for threaded in (False, True):
+        elapsed, n_bytes, digest = run(backend, threaded)
+        mode = 'threaded' if threaded else 'inline'
+        label = f'{backend} ({mode})'
+        if args.parse:
+            print(f'{label:<20} {elapsed:8.2f}s')
+            continue
+
+        digests[label] = digest
+        print(f'{label:<20} {elapsed:8.2f}s {n_bytes / 2**20 / elapsed:10.1f} MB/s')
+
+if len(set(digests.values())) > 1:
+    print(f'  backends disagree: {digests}')
@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for NPI conversion and filtering
+
+>>> python3 bench_npi_filter.py --filter-size 10000
+
+Runs process_group on provider groups of several sizes, with and without
+an NPI filter, once with the original one-NPI-at-a-time implementation and
+once with the current one (numpy, if it's installed), and prints NPIs/sec
+for each. The outputs are checked against each other while we're at it.
+"""
+import argparse
+import random
+import time
+from array import array
+
+from mrfutils import npifilter
+from mrfutils.flatteners import process_group
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-f', '--filter-size', type = int, default = 10_000)
+parser.add_argument('-t', '--total', type = int, default = 2_000_000, help = 'NPIs per run')
+parser.add_argument('-s', '--seed', type = int, default = 0)
+args = parser.parse_args()
+
+SIZES = (4, 64, 256, 1_000, 50_000)
+
+
+def original_process_group(group, npi_filter):
+    """process_group before npifilter.py"""
+    try:
+        group['npi'] = [int(n) for n in group['npi']]
+    except KeyError:
+        group['npi'] = [int(n) for n in group['NPI']]
+
+    group['npi'] = array('L', group['npi'])
+
+    if not npi_filter:
+        return group
+
+    group['npi'] = [n for n in group['npi'] if n in npi_filter]
+
+    if not group['npi']:
+        return
+
+    group['npi'] = array('L', group['npi'])
+
+    return group
+
+
+def make_groups(size, n_groups, span, rnd):
+    """Groups with NPIs from the same range as the filter, so
+    some of them pass"""
+    return [
+        [rnd.randrange(1_000_000_000, 1_000_000_000 + span) for _ in range(size)]
+        for _ in range(n_groups)
+    ]
+
+
+def bench(func, npi_lists, npi_filter):
+    groups = [dict(npi = npis, tin = None) for npis in npi_lists]
+    start = time.perf_counter()
+    results = [func(group, npi_filter) for group in groups]
+    elapsed = time.perf_counter() - start
+    return sum(map(len, npi_lists)) / elapsed, results
+
+
+rnd = random.Random(args.seed)
+
+# A filter of NPIs close together (bitmap) and one spread
+# over the whole NPI range (sorted array)
+spans = {
+    'narrow': 20 * args.filter_size,
+    'wide': 1_000_000_000,
+}
+filters = {
+    name: npifilter.NPIFilter(rnd.sample(range(1_000_000_000, 1_000_000_000 + span), args.filter_size))
+    for name, span in spans.items()
+}
+
+print(f'numpy: {"yes" if npifilter.np is not None else "no"}, filter: {args.filter_size:,} NPIs')
+print(f'{"group size":>10} {"filter":>6} {"original":>14} {"current":>14}')
+for size in SIZES:
+    for name in ('none', 'narrow', 'wide'):
+        npi_filter = filters.get(name)
+        npi_lists = make_groups(size, max(1, args.total // size), spans.get(name, spans['narrow']), rnd)
+        old_rate, old = bench(original_process_group, npi_lists, npi_filter)
+        new_rate, new = bench(process_group, npi_lists, npi_filter)
+        assert [g and g['npi'] for g in old] == [g and g['npi'] for g in new]
+        print(f'{size:>10,} {name:>6} {old_rate:>10,.0f}/sec {new_rate:>10,.0f}/sec {new_rate / old_rate:>6.1f}x')
@@ -0,0 +1,113 @@
+"""
+Memory benchmark for the provider reference map
+
+>>> python3 bench_refmap.py --references 50000
+
+Builds the same processed provider references into the old dict map
+(provider_group_id -> list of group dicts) and into CompactReferenceMap,
+and prints the memory each one holds once it's built (tracemalloc), how
+much the process RSS grows over a pass that looks up every reference
+(what the lookups leave behind), and how fast lookups go: every reference
+once, and a hot set of references again and again, the way swap_references
+sees them. Lookups are checked against the dict map while we're at it.
+"""
+import argparse
+import gc
+import os
+import random
+import resource
+import time
+import tracemalloc
+
+from mrfutils.flatteners import process_reference
+from mrfutils.refmap import CompactReferenceMap, seal
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-r', '--references', type = int, default = 50_000)
+parser.add_argument('-g', '--groups', type = int, default = 3, help = 'groups per reference')
+parser.add_argument('-n', '--npis', type = int, default = 5, help = 'NPIs per group')
+parser.add_argument('-t', '--tins', type = int, default = 20_000, help = 'distinct TINs')
+parser.add_argument('--hot', type = int, default = 1_000, help = 'references looked up again and again')
+parser.add_argument('-s', '--seed', type = int, default = 0)
+args = parser.parse_args()
+
+
+def gen_references(n, seed):
+    """References as they come out of the parser"""
+    rnd = random.Random(seed)
+    for group_id in range(n):
+        groups = []
+        for _ in range(args.groups):
+            tin = rnd.randrange(args.tins)
+            groups.append(dict(
+                npi = [rnd.randint(1_000_000_000, 1_999_999_999) for _ in range(args.npis)],
+                tin = dict(type = 'ein', value = f'{tin:09d}'),
+            ))
+        yield dict(provider_group_id = group_id, provider_groups = groups)
+
+
+def build_dict():
+    ref_map = {}
+    for reference in gen_references(args.references, args.seed):
+        reference = process_reference(reference, None)
+        ref_map[reference['provider_group_id']] = reference['provider_groups']
+    return ref_map
+
+
+def build_compact():
+    ref_map = CompactReferenceMap()
+    for reference in gen_references(args.references, args.seed):
+        reference = process_reference(reference, None)
+        ref_map.add(reference['provider_group_id'], reference['provider_groups'])
+    return seal(ref_map)
+
+
+def rss():
+    """Current RSS in MiB (the peak where there's no /proc)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def measure(name, build):
+    gc.collect()
+    tracemalloc.start()
+    ref_map = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    built_rss = rss()
+
+    start = time.perf_counter()
+    for group_id in range(args.references):
+        ref_map.get(group_id, [])
+    once = args.references / (time.perf_counter() - start)
+    gc.collect()
+    growth = rss() - built_rss
+
+    start = time.perf_counter()
+    for group_id in hot:
+        ref_map.get(group_id, [])
+    again = len(hot) / (time.perf_counter() - start)
+
+    print(
+        f'{name:<24} {size / 2**20:>10,.1f} MiB {growth:>+8,.1f} MiB RSS after lookups'
+        f' {once:>12,.0f} once {again:>12,.0f} hot lookups/sec'
+    )
+    return ref_map, size
+
+
+rnd = random.Random(args.seed)
+hot_ids = rnd.sample(range(args.references), min(args.hot, args.references))
+hot = [rnd.choice(hot_ids) for _ in range(args.references)]
+
+print(f'{args.references:,} references x {args.groups} groups x {args.npis} NPIs')
+dict_map, dict_size = measure('dict', build_dict)
+compact_map, compact_size = measure('CompactReferenceMap', build_compact)
+print(f'{"":<24} {dict_size / compact_size:>10.1f}x smaller')
+
+for group_id in random.Random(args.seed).sample(range(args.references), 1000):
+    for old, new in zip(dict_map[group_id], compact_map[group_id], strict = True):
+        assert list(old['npi']) == list(new['npi']) and old['tin'] == new['tin']
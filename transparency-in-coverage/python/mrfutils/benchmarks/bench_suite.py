@@ -0,0 +1,264 @@
+"""
+Throughput and memory benchmarks on synthetic MRFs
+
+>>> python3 bench_suite.py --items 20000 --save results/before.json
+>>> # ... change something ...
+>>> python3 bench_suite.py --items 20000 --save results/after.json --compare results/before.json
+
+Generates an in-network file per provider_references placement (and one
+with remote references, with --remote, served from a local HTTP server)
+with synth_mrf.py, plus a table of contents file. Then runs
+in_network_file_to_csv on each with no filter, and with code and NPI
+filters that keep each of the --selectivity fractions, and toc_file_to_csv
+on the TOC. Every case runs in a fresh process and prints:
+
+    MB/s        uncompressed JSON per second
+    events/s    ijson events per second
+    rows/s      rows written per second, in total (per table in the JSON)
+    peak RSS    of the process, and of the largest worker with --workers
+
+The results go to --save as JSON, with the arguments, Python version and
+git commit, and --compare prints the ratio to an earlier results file.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import ijson
+
+import synth_mrf
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_mb(who) -> float:
+    # KB on Linux, bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def count_rows(out_dir: str) -> dict:
+    rows = {}
+    for name in sorted(os.listdir(out_dir)):
+        if name.endswith('.csv'):
+            with open(os.path.join(out_dir, name), newline = '') as f:
+                rows[name[:-4]] = max(0, sum(1 for _ in csv.reader(f)) - 1)
+    return rows
+
+
+def run_case(case: dict) -> dict:
+    """Runs in the child process"""
+    import logging
+
+    from mrfutils.flatteners import in_network_file_to_csv, toc_file_to_csv
+    from mrfutils.helpers import import_csv_to_set
+
+    logging.disable(logging.CRITICAL)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.perf_counter()
+        if case['kind'] == 'toc':
+            toc_file_to_csv(
+                url = 'http://example.com/index.json.gz',
+                out_dir = out_dir,
+                file = case['file'],
+                engine = case['engine'],
+            )
+        else:
+            in_network_file_to_csv(
+                url = 'http://example.com/in-network.json.gz',
+                out_dir = out_dir,
+                file = case['file'],
+                code_filter = import_csv_to_set(case['code_file']) if case.get('code_file') else None,
+                npi_filter = import_csv_to_set(case['npi_file']) if case.get('npi_file') else None,
+                engine = case['engine'],
+                workers = case['workers'],
+            )
+        elapsed = time.perf_counter() - start
+        rows = count_rows(out_dir)
+
+    return dict(
+        seconds = elapsed,
+        rows = rows,
+        peak_rss_mb = rss_mb(resource.RUSAGE_SELF),
+        peak_worker_rss_mb = rss_mb(resource.RUSAGE_CHILDREN),
+    )
+
+
+def run_in_child(case: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', json.dumps(case)],
+        capture_output = True,
+        text = True,
+        cwd = HERE,
+    )
+    if proc.returncode:
+        raise RuntimeError(f'{case["name"]} failed:\n{proc.stderr}')
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def measure_input(path: str) -> tuple[int, int]:
+    """(uncompressed bytes, ijson events)"""
+    from mrfutils.helpers import JSONOpen
+
+    class Counter:
+        def __init__(self, f):
+            self.f = f
+            self.n = 0
+
+        def read(self, size = -1):
+            data = self.f.read(size)
+            self.n += len(data)
+            return data
+
+    with JSONOpen(path) as f:
+        counted = Counter(f)
+        events = sum(1 for _ in ijson.basic_parse(counted))
+    return counted.n, events
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output = True, text = True, cwd = HERE, check = True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_cases(args, files: dict, filter_dir: str) -> list[dict]:
+    cases = []
+    for name, path in files.items():
+        if name == 'toc':
+            # The TOC engines are 'parse' and 'byte_skip'
+            engine = 'byte_skip' if args.engine == 'byte_skip' else 'parse'
+            cases.append(dict(name = 'toc', kind = 'toc', input = 'toc', file = path, engine = engine))
+            continue
+
+        base = dict(kind = 'in_network', input = name, file = path, engine = args.engine, workers = args.workers)
+        cases.append(dict(base, name = f'{name} / no filter'))
+        for selectivity in args.selectivity:
+            code_file, npi_file = synth_mrf.write_filters(filter_dir, selectivity, args.seed)
+            cases.append(dict(base, name = f'{name} / codes {selectivity:g}', code_file = code_file))
+            cases.append(dict(base, name = f'{name} / NPIs {selectivity:g}', npi_file = npi_file))
+    return cases
+
+
+def compare(results: list[dict], old_file: str) -> None:
+    with open(old_file) as f:
+        old = {r['name']: r for r in json.load(f)['results']}
+
+    print(f'\ncompared to {old_file}')
+    print(f'{"case":<26} {"MB/s":>8} {"peak RSS":>9}')
+    for r in results:
+        o = old.get(r['name'])
+        if o is None:
+            continue
+        print(f'{r["name"]:<26} {r["mb_per_sec"] / o["mb_per_sec"]:>7.2f}x {r["peak_rss_mb"] / o["peak_rss_mb"]:>8.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    synth_mrf.add_arguments(parser)
+    parser.add_argument('--selectivity', type = float, nargs = '*', default = [.1, .01])
+    parser.add_argument('--placements', nargs = '*', choices = synth_mrf.PLACEMENTS, default = list(synth_mrf.PLACEMENTS))
+    parser.add_argument('--plans', type = int, default = 2_000, help = 'plans in the TOC file')
+    parser.add_argument('--toc-file-pool', type = int, default = 0,
+                        help = 'draw the TOC\'s in-network file URLs from this many (0: all different)')
+    parser.add_argument('--engine', default = 'parse')
+    parser.add_argument('-w', '--workers', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 1, help = 'runs per case (the fastest is kept)')
+    parser.add_argument('--dir', help = 'where to put the generated files (default: a temporary directory)')
+    parser.add_argument('--save', help = 'write the results to this JSON file')
+    parser.add_argument('--compare', help = 'results file to compare with')
+    parser.add_argument('--child', help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(json.loads(args.child))))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = args.dir or tmp
+        ref_dir = os.path.join(work_dir, 'refs')
+        os.makedirs(ref_dir, exist_ok = True)
+
+        with synth_mrf.serve(ref_dir) as base_url:
+            files = {}
+            params = dict(
+                items = args.items, rates = args.rates, prices = args.prices, groups = args.groups,
+                npis = args.npis, references = args.references, seed = args.seed,
+            )
+            for placement in args.placements:
+                files[placement] = os.path.join(work_dir, f'{placement}.json.gz')
+                synth_mrf.write_in_network_file(files[placement], placement = placement, **params)
+            if args.remote:
+                files['remote'] = os.path.join(work_dir, 'remote.json.gz')
+                synth_mrf.write_in_network_file(
+                    files['remote'], remote = args.remote, base_url = base_url, ref_dir = ref_dir, **params,
+                )
+            files['toc'] = os.path.join(work_dir, 'index.json.gz')
+            synth_mrf.write_toc_file(files['toc'], plans = args.plans, seed = args.seed, file_pool = args.toc_file_pool)
+
+            inputs = {}
+            for name, path in files.items():
+                size, events = measure_input(path)
+                inputs[name] = dict(file_bytes = os.path.getsize(path), json_bytes = size, events = events)
+                print(f'{name:<8} {size / 2**20:>8.1f} MB of JSON, {events:>12,} events')
+
+            print(f'\n{"case":<26} {"MB/s":>8} {"events/s":>12} {"rows/s":>12} {"peak RSS":>12}')
+            results = []
+            for case in make_cases(args, files, os.path.join(work_dir, 'filters')):
+                runs = [run_in_child(case) for _ in range(args.repeat)]
+                run = min(runs, key = lambda r: r['seconds'])
+                seconds = run['seconds']
+                source = inputs[case['input']]
+                result = dict(
+                    name = case['name'],
+                    seconds = seconds,
+                    mb_per_sec = source['json_bytes'] / 2**20 / seconds,
+                    events_per_sec = source['events'] / seconds,
+                    rows_per_sec = sum(run['rows'].values()) / seconds,
+                    rows_per_sec_by_table = {t: n / seconds for t, n in run['rows'].items()},
+                    rows = run['rows'],
+                    peak_rss_mb = max(r['peak_rss_mb'] for r in runs),
+                    peak_worker_rss_mb = max(r['peak_worker_rss_mb'] for r in runs),
+                )
+                results.append(result)
+
+                rss = f'{result["peak_rss_mb"]:,.0f} MB'
+                if args.workers:
+                    rss += f' ({result["peak_worker_rss_mb"]:,.0f})'
+                print(
+                    f'{case["name"]:<26} {result["mb_per_sec"]:>8.1f} {result["events_per_sec"]:>12,.0f} '
+                    f'{result["rows_per_sec"]:>12,.0f} {rss:>12}'
+                )
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok = True)
+        with open(args.save, 'w') as f:
+            json.dump(dict(
+                args = {k: v for k, v in vars(args).items() if k not in ('child', 'save', 'compare')},
+                inputs = inputs,
+                python = sys.version,
+                platform = platform.platform(),
+                commit = git_commit(),
+                time = time.strftime('%Y-%m-%dT%H:%M:%S'),
+                results = results,
+            ), f, indent = 2)
+        print(f'\nSaved to {args.save}')
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
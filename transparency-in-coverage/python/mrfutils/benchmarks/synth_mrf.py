@@ -0,0 +1,355 @@
+"""
+Deterministic synthetic MRFs for the benchmarks
+
+>>> python3 synth_mrf.py in-network.json.gz --items 20000 --rates 4 --groups 2 --npis 20 --references 5000
+>>> python3 synth_mrf.py in-network.json.gz --placement last
+>>> python3 synth_mrf.py in-network.json.gz --remote .5 --base-url http://127.0.0.1:8000 --ref-dir refs
+>>> python3 synth_mrf.py index.json.gz --toc --plans 1000 --files 5
+
+The same arguments (and --seed) always give the same bytes, gzipped or not,
+so a file can be regenerated instead of being kept around.
+
+In-network files have `--items` items, each with `--rates` negotiated rates
+of `--prices` prices. Where the provider groups go depends on --placement:
+
+    first    provider_references before in_network (the usual layout)
+    last     provider_references after in_network
+    inline   no provider_references: each rate has `--groups` groups inline
+
+With references, there are `--references` of them, each with `--groups`
+groups, and each rate points to `--groups` of them. Every group has
+`--npis` NPIs.
+
+With --remote, that fraction of the references is a `location` under
+--base-url instead, and the reference files are written to --ref-dir.
+serve() serves a directory over HTTP for them.
+
+Billing codes and NPIs are drawn from fixed pools (CODES and NPI_POOL NPIs
+from NPI_BASE), so write_filters() can make code and NPI filters that keep
+about a given fraction of the file.
+"""
+import argparse
+import contextlib
+import csv
+import functools
+import gzip
+import http.server
+import io
+import json
+import os
+import random
+import threading
+
+PLACEMENTS = ('first', 'last', 'inline')
+
+NPI_BASE = 1_000_000_000
+NPI_POOL = 200_000
+
+# 2,000 CPT codes and 500 HCPCS codes
+CODES = (
+    [('CPT', str(code)) for code in range(10_000, 12_000)]
+    + [('HCPCS', f'A{code:04d}') for code in range(500)]
+)
+
+TIN_POOL = 20_000
+
+DEFAULTS = dict(
+    items = 2_000,
+    rates = 4,
+    prices = 2,
+    groups = 2,
+    npis = 10,
+    references = 1_000,
+    placement = 'first',
+    remote = 0.,
+    seed = 0,
+)
+
+HEADER = {
+    'reporting_entity_name': 'Synthetic Health',
+    'reporting_entity_type': 'health insurance issuer',
+    'plan_name': 'Synthetic PPO',
+    'plan_id_type': 'ein',
+    'plan_id': '12-3456789',
+    'plan_market_type': 'group',
+    'last_updated_on': '2023-01-01',
+    'version': '1.0.0',
+}
+
+NEGOTIATED_TYPES = ('negotiated', 'fee schedule', 'derived', 'percentage')
+SERVICE_CODES = ('01', '11', '21', '22', '23', '24', '81')
+
+
+def dumps(obj) -> str:
+    return json.dumps(obj, separators = (',', ':'))
+
+
+@contextlib.contextmanager
+def open_out(path: str):
+    """Text file at path, gzipped if it ends in .gz, with
+    nothing in it that changes from run to run"""
+    if not path.endswith('.gz'):
+        with open(path, 'w', buffering = 2**20) as f:
+            yield f
+        return
+
+    with open(path, 'wb') as raw:
+        with gzip.GzipFile(fileobj = raw, mode = 'wb', filename = '', mtime = 0) as gz:
+            with io.TextIOWrapper(gz, encoding = 'utf-8', write_through = False) as f:
+                yield f
+
+
+def make_group(rnd: random.Random, npis: int) -> dict:
+    return {
+        'npi': [NPI_BASE + rnd.randrange(NPI_POOL) for _ in range(npis)],
+        'tin': {'type': 'ein', 'value': f'{rnd.randrange(TIN_POOL):09d}'},
+    }
+
+
+def make_item(rnd: random.Random, i: int, placement: str, rates: int, prices: int, groups: int, npis: int, references: int) -> dict:
+    code_type, code = CODES[rnd.randrange(len(CODES))]
+
+    negotiated_rates = []
+    for _ in range(rates):
+        rate = {}
+        if placement == 'inline':
+            rate['provider_groups'] = [make_group(rnd, npis) for _ in range(groups)]
+        else:
+            rate['provider_references'] = rnd.sample(range(references), min(groups, references))
+
+        rate['negotiated_prices'] = [
+            {
+                'negotiated_type': rnd.choice(NEGOTIATED_TYPES),
+                'negotiated_rate': round(rnd.uniform(5, 5_000), 2),
+                'expiration_date': '9999-12-31',
+                'service_code': sorted(rnd.sample(SERVICE_CODES, 2)),
+                'billing_class': rnd.choice(('professional', 'institutional')),
+                'billing_code_modifier': rnd.choice(([], ['26'], ['TC'])),
+            }
+            for _ in range(prices)
+        ]
+        negotiated_rates.append(rate)
+
+    return {
+        'negotiation_arrangement': 'ffs',
+        'name': f'Synthetic service {i}',
+        'billing_code_type': code_type,
+        'billing_code_type_version': '2023',
+        'billing_code': code,
+        'description': f'Synthetic description of {code_type} {code}',
+        'negotiated_rates': negotiated_rates,
+    }
+
+
+def write_references(f, rnd: random.Random, references: int, groups: int, npis: int, remote: float, base_url: str | None, ref_dir: str | None) -> None:
+    f.write('"provider_references":[')
+    for group_id in range(references):
+        if group_id:
+            f.write(',')
+
+        provider_groups = [make_group(rnd, npis) for _ in range(groups)]
+        if remote and rnd.random() < remote:
+            name = f'{group_id}.json'
+            with open(os.path.join(ref_dir, name), 'w') as ref_file:
+                ref_file.write(dumps({'provider_groups': provider_groups}))
+            reference = {'provider_group_id': group_id, 'location': f'{base_url}/{name}'}
+        else:
+            reference = {'provider_group_id': group_id, 'provider_groups': provider_groups}
+
+        f.write(dumps(reference))
+    f.write(']')
+
+
+def write_in_network_file(
+    path: str,
+    items: int = DEFAULTS['items'],
+    rates: int = DEFAULTS['rates'],
+    prices: int = DEFAULTS['prices'],
+    groups: int = DEFAULTS['groups'],
+    npis: int = DEFAULTS['npis'],
+    references: int = DEFAULTS['references'],
+    placement: str = DEFAULTS['placement'],
+    remote: float = DEFAULTS['remote'],
+    base_url: str | None = None,
+    ref_dir: str | None = None,
+    seed: int = DEFAULTS['seed'],
+) -> None:
+    if placement not in PLACEMENTS:
+        raise ValueError(f'placement must be one of {PLACEMENTS}: {placement=}')
+    if remote and (base_url is None or ref_dir is None):
+        raise ValueError('Remote references need base_url and ref_dir')
+    if remote:
+        os.makedirs(ref_dir, exist_ok = True)
+
+    # Separate streams, so the items don't depend on the references
+    ref_rnd = random.Random(f'{seed}-references')
+    item_rnd = random.Random(f'{seed}-items')
+
+    with open_out(path) as f:
+        f.write(dumps(HEADER)[:-1])
+
+        if placement == 'first':
+            f.write(',')
+            write_references(f, ref_rnd, references, groups, npis, remote, base_url, ref_dir)
+
+        f.write(',"in_network":[')
+        for i in range(items):
+            if i:
+                f.write(',')
+            f.write(dumps(make_item(item_rnd, i, placement, rates, prices, groups, npis, references)))
+        f.write(']')
+
+        if placement == 'last':
+            f.write(',')
+            write_references(f, ref_rnd, references, groups, npis, remote, base_url, ref_dir)
+
+        f.write('}')
+
+
+def write_toc_file(
+    path: str,
+    plans: int = 100,
+    files: int = 5,
+    plans_per_structure: int = 3,
+    base_url: str = 'https://example.com/mrf',
+    seed: int = DEFAULTS['seed'],
+    file_pool: int = 0,
+) -> None:
+    """An index.json with `plans` plans, `plans_per_structure` to a
+    reporting structure, each structure with `files` in-network files.
+    With `file_pool`, the files' URLs are drawn from that many, so the
+    same files show up under many structures"""
+    rnd = random.Random(f'{seed}-toc')
+
+    with open_out(path) as f:
+        f.write(dumps({
+            'reporting_entity_name': HEADER['reporting_entity_name'],
+            'reporting_entity_type': HEADER['reporting_entity_type'],
+        })[:-1])
+        f.write(',"reporting_structure":[')
+
+        for n, first_plan in enumerate(range(0, plans, plans_per_structure)):
+            if n:
+                f.write(',')
+            structure = {
+                'reporting_plans': [
+                    {
+                        'plan_name': f'Synthetic plan {p}',
+                        'plan_id_type': 'ein',
+                        'plan_id': f'{rnd.randrange(10**9):09d}',
+                        'plan_market_type': rnd.choice(('group', 'individual')),
+                    }
+                    for p in range(first_plan, min(first_plan + plans_per_structure, plans))
+                ],
+                'in_network_files': [
+                    {
+                        'description': f'In-network rates {n}-{i}',
+                        'location': f'{base_url}/{rnd.randrange(file_pool or 10**6):06d}_in-network-rates.json.gz',
+                    }
+                    for i in range(files)
+                ],
+                'allowed_amount_file': {
+                    'description': 'Allowed amounts',
+                    'location': f'{base_url}/allowed-amounts.json',
+                },
+            }
+            f.write(dumps(structure))
+
+        f.write(']}')
+
+
+def write_filters(out_dir: str, selectivity: float, seed: int = DEFAULTS['seed']) -> tuple[str, str]:
+    """(code file, NPI file) in import_csv_to_set's format, each
+    with about `selectivity` of its pool"""
+    rnd = random.Random(f'{seed}-filters-{selectivity}')
+    os.makedirs(out_dir, exist_ok = True)
+
+    code_file = os.path.join(out_dir, f'codes_{selectivity:g}.csv')
+    with open(code_file, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        for code in rnd.sample(CODES, max(1, round(len(CODES) * selectivity))):
+            writer.writerow(code)
+
+    npi_file = os.path.join(out_dir, f'npis_{selectivity:g}.csv')
+    with open(npi_file, 'w') as f:
+        for n in rnd.sample(range(NPI_POOL), max(1, round(NPI_POOL * selectivity))):
+            f.write(f'{NPI_BASE + n}\n')
+
+    return code_file, npi_file
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serve(directory: str, port: int = 0):
+    """Serves directory over HTTP on a background thread.
+    Yields the base URL"""
+    handler = functools.partial(QuietHandler, directory = directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """The in-network file options, for this script and bench_suite.py"""
+    parser.add_argument('--items', type = int, default = DEFAULTS['items'])
+    parser.add_argument('--rates', type = int, default = DEFAULTS['rates'], help = 'negotiated rates per item')
+    parser.add_argument('--prices', type = int, default = DEFAULTS['prices'], help = 'prices per rate')
+    parser.add_argument('--groups', type = int, default = DEFAULTS['groups'], help = 'provider groups (or references) per rate')
+    parser.add_argument('--npis', type = int, default = DEFAULTS['npis'], help = 'NPIs per group')
+    parser.add_argument('--references', type = int, default = DEFAULTS['references'])
+    parser.add_argument('--remote', type = float, default = DEFAULTS['remote'], help = 'fraction of references that are remote')
+    parser.add_argument('--seed', type = int, default = DEFAULTS['seed'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    add_arguments(parser)
+    parser.add_argument('--placement', choices = PLACEMENTS, default = DEFAULTS['placement'])
+    parser.add_argument('--base-url', help = 'where remote references (or TOC files) are')
+    parser.add_argument('--ref-dir', help = 'where to write remote references')
+    parser.add_argument('--toc', action = 'store_true', help = 'write a table of contents file instead')
+    parser.add_argument('--plans', type = int, default = 100)
+    parser.add_argument('--files', type = int, default = 5, help = 'in-network files per reporting structure')
+    parser.add_argument('--file-pool', type = int, default = 0, help = 'draw the in-network file URLs from this many')
+    args = parser.parse_args()
+
+    if args.toc:
+        write_toc_file(
+            args.path,
+            plans = args.plans,
+            files = args.files,
+            base_url = args.base_url or 'https://example.com/mrf',
+            seed = args.seed,
+            file_pool = args.file_pool,
+        )
+    else:
+        write_in_network_file(
+            args.path,
+            items = args.items,
+            rates = args.rates,
+            prices = args.prices,
+            groups = args.groups,
+            npis = args.npis,
+            references = args.references,
+            placement = args.placement,
+            remote = args.remote,
+            base_url = args.base_url,
+            ref_dir = args.ref_dir,
+            seed = args.seed,
+        )
+    print(f'{args.path}: {os.path.getsize(args.path):,} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,7 @@ else:
 
 # https://www.aapc.com/codes/cpt-codes-range/90935-90940/
 dialysis_code_filter = {
-    ("CPT", "90935"),
-    ("CPT", "90937"),
-    ("CPT", "90940"),
+    ("CPT", "90935..90940"),
 }
 
 if __name__ == "__main__":
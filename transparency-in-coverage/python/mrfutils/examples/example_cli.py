@@ -10,10 +10,17 @@ line argument to do that.
 import argparse
 import logging
 
+from mrfutils.fetcher import ReferenceFetcher, set_fetcher
+from mrfutils.hashers import HASH_MODES, set_hash_mode
 from mrfutils.helpers import import_csv_to_set
+from mrfutils.metrics import INTERVAL, RunStats
 from mrfutils.flatteners import in_network_file_to_csv
+from mrfutils.manifest import Manifest
+from mrfutils.refmap import set_mmap_dir
+from mrfutils.remote import set_cache_dir
+from mrfutils.sinks import SINKS
 
-logging.basicConfig()
+logging.basicConfig(format = '%(asctime)s - %(message)s')
 log = logging.getLogger('mrfutils')
 log.setLevel(logging.DEBUG)
 
@@ -23,9 +30,38 @@ parser.add_argument('-u', '--url')
 parser.add_argument('-o', '--out-dir', default = 'csv_output')
 parser.add_argument('-c', '--code-file')
 parser.add_argument('-n', '--npi-file')
+parser.add_argument('--hash-mode', choices = HASH_MODES, default = 'compat')
+parser.add_argument('--spill', action = 'store_true',
+                    help = 'read the file once even if provider_references come last')
+parser.add_argument('-w', '--workers', type = int, default = 0,
+                    help = 'processes for building rows (0 = build them in this one)')
+parser.add_argument('--format', choices = tuple(SINKS), default = 'csv')
+parser.add_argument('--ref-cache-dir',
+                    help = 'cache remote provider references in this directory')
+parser.add_argument('--input-cache-dir',
+                    help = 'keep a copy of a remote input file in this directory, and read it from there next time')
+parser.add_argument('--ref-mmap-dir',
+                    help = 'keep the provider reference map in a memory-mapped file in this directory')
+parser.add_argument('--checkpoint', type = float, nargs = '?', const = True, default = False,
+                    help = 'save a checkpoint every this many seconds (default 300)')
+parser.add_argument('--resume', action = 'store_true',
+                    help = 'pick up from the last checkpoint in out-dir')
+parser.add_argument('--progress', type = float, nargs = '?', const = INTERVAL, default = None,
+                    help = f'log throughput and an ETA every this many seconds (default {INTERVAL})')
+parser.add_argument('--stats-file',
+                    help = 'write counters and time per stage to this JSON file at the end')
+parser.add_argument('--manifest',
+                    help = 'skip the file if this manifest (a sqlite file) says it was already flattened with the same filters')
+parser.add_argument('--delta', nargs = '?', const = True, default = False,
+                    help = "save the row ids in out-dir. Give an earlier run's out-dir to only write what changed since")
 
 args = parser.parse_args()
 
+set_hash_mode(args.hash_mode)
+set_mmap_dir(args.ref_mmap_dir)
+set_fetcher(ReferenceFetcher(cache_dir = args.ref_cache_dir))
+set_cache_dir(args.input_cache_dir)
+
 url = args.url
 out_dir = args.out_dir
 
@@ -39,10 +75,27 @@ if args.npi_file:
 else:
     npi_filter = None
 
+if args.progress is not None or args.stats_file:
+    stats = RunStats(
+        progress = args.progress is not None,
+        interval = args.progress or INTERVAL,
+        summary_file = args.stats_file,
+    )
+else:
+    stats = None
+
 in_network_file_to_csv(
     file = args.file,
     url = args.url,
     npi_filter = npi_filter,
     code_filter = code_filter,
-    out_dir = out_dir
+    out_dir = out_dir,
+    spill = args.spill,
+    workers = args.workers,
+    out_format = args.format,
+    checkpoint = args.checkpoint,
+    resume = args.resume,
+    stats = stats,
+    manifest = Manifest(args.manifest) if args.manifest else None,
+    delta = args.delta,
 )
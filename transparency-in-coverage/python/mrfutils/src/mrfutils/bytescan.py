@@ -0,0 +1,288 @@
+"""
+Skipping JSON without tokenizing it
+###################################
+
+To skip a value, a tokenizer still has to lex every string and number in
+it. All we really need is the position of the bracket that closes it, and
+that only depends on the brackets, the quotes and the backslashes.
+
+ByteScanner reads the decompressed stream in blocks. For each block it
+drops escape sequences, then complete strings, then everything that isn't a
+bracket, all with C-level bytes/regex operations. If the block doesn't have
+enough closing brackets to get back to depth 0, the whole block is skipped
+with just a depth update. Only the block where the value actually ends gets
+looked at token by token.
+
+The scanner never stops in the middle of a string: a block that ends inside
+a string is cut at the opening quote, and the string is picked up with the
+next block. So the only state carried between blocks is the depth.
+
+Everything else (top-level keys, metadata, references, kept in-network
+items) is small enough, or wanted in full anyway, so the scanner hands back
+raw bytes for json.loads.
+"""
+from __future__ import annotations
+
+import re
+
+from mrfutils.exceptions import InvalidMRF
+
+READ_SIZE = 2**20
+# Blocks start small, so small values don't pay for compacting a big
+# block, and double up to BLOCK_SIZE
+MIN_BLOCK_SIZE = 2**10
+BLOCK_SIZE = 2**16
+
+WS_RE = re.compile(rb'[ \t\n\r]*')
+ESCAPE_RE = re.compile(rb'\\.', re.DOTALL)
+STRING_RE = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+SCALAR_RE = re.compile(rb'[-+0-9.eE]+|true|false|null')
+TOKEN_RE = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]', re.DOTALL)
+
+NOT_BRACKETS = bytes(c for c in range(256) if c not in b'[]{}')
+OPENS = b'[{'
+BACKSLASH = ord('\\')
+
+
+class ByteScanner:
+	"""
+	Walks a JSON document from a file-like object of bytes.
+
+	`buf[pos:]` is what hasn't been read yet. Bytes before `keep` can be
+	thrown away when we read more; capturing a value just means holding
+	`keep` at the value's start.
+	"""
+
+	def __init__(self, f, read_size: int = READ_SIZE, block_size: int = BLOCK_SIZE):
+		self.f = f
+		self.read_size = read_size
+		self.block_size = block_size
+		self.buf = bytearray()
+		self.pos = 0
+		self.keep = 0
+		self.eof = False
+		# How many bytes were thrown away before buf[0]
+		self.offset = 0
+
+	@property
+	def tell(self) -> int:
+		"""Position in the decompressed stream"""
+		return self.offset + self.pos
+
+	def fill(self) -> bool:
+		"""Reads more bytes. Returns False at the end of the stream"""
+		if self.eof:
+			return False
+
+		data = self.f.read(self.read_size)
+		if not data:
+			self.eof = True
+			return False
+
+		if self.keep:
+			del self.buf[:self.keep]
+			self.offset += self.keep
+			self.pos -= self.keep
+			self.keep = 0
+
+		self.buf += data
+		return True
+
+	def need_more(self) -> None:
+		if not self.fill():
+			raise InvalidMRF('File ended in the middle of a JSON value')
+
+	def release(self) -> None:
+		"""Stop capturing: everything before pos can go"""
+		self.keep = self.pos
+
+	def skip_ws(self) -> None:
+		while True:
+			self.pos = WS_RE.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf) or not self.fill():
+				return
+
+	def peek(self) -> int | None:
+		"""The next non-whitespace byte, or None at the end of the stream"""
+		self.skip_ws()
+		if self.pos < len(self.buf):
+			return self.buf[self.pos]
+		return None
+
+	def expect(self, char: bytes) -> None:
+		if self.peek() != char[0]:
+			raise InvalidMRF(f'Expected {char!r} at byte {self.tell}')
+		self.pos += 1
+
+	def read_string(self) -> bytes:
+		if self.peek() != 34:
+			raise InvalidMRF(f'Expected a string at byte {self.tell}')
+
+		while True:
+			m = STRING_RE.match(self.buf, self.pos)
+			if m:
+				self.pos = m.end()
+				return bytes(m[0])
+			self.need_more()
+
+	def read_scalar(self) -> bytes:
+		while True:
+			m = SCALAR_RE.match(self.buf, self.pos)
+			if m and m.end() < len(self.buf):
+				break
+			# A number (or true, false, null) can be cut in half at
+			# the end of the buffer. The longest literal is 5 bytes
+			if not m and len(self.buf) - self.pos >= len(b'false'):
+				raise InvalidMRF(f'Bad JSON value at byte {self.tell}')
+			if not self.fill():
+				if not m:
+					raise InvalidMRF(f'Bad JSON value at byte {self.tell}')
+				break
+
+		self.pos = m.end()
+		return bytes(m[0])
+
+	def last_real_quote(self, start: int, end: int) -> int:
+		"""Index of the last quote in buf[start:end] that isn't escaped"""
+		buf = self.buf
+		i = buf.rfind(b'"', start, end)
+		while i >= start:
+			j = i - 1
+			while j >= start and buf[j] == BACKSLASH:
+				j -= 1
+			if (i - 1 - j) % 2 == 0:
+				return i
+			i = buf.rfind(b'"', start, i)
+		raise InvalidMRF(f'Lost track of a string at byte {self.offset + start}')
+
+	def close_container(self, depth: int = 1, capture: bool = False) -> None:
+		"""Moves pos to just past the bracket that brings `depth` open
+		containers back to 0. Unless we're capturing, the bytes that
+		were skipped don't stay in the buffer"""
+		block_size = MIN_BLOCK_SIZE
+		while True:
+			buf = self.buf
+			pos = self.pos
+			n = len(buf)
+
+			while pos < n:
+				end = min(pos + block_size, n)
+				block_size = min(2 * block_size, self.block_size)
+				block = buf[pos:end]
+				if b'\\' in block:
+					block = ESCAPE_RE.sub(b'', block)
+
+				n_quotes = block.count(b'"')
+				if n_quotes % 2:
+					# The block ends inside a string. Cut it at that
+					# string's opening quote
+					cut = self.last_real_quote(pos, end)
+					if cut == pos:
+						m = STRING_RE.match(buf, pos)
+						if m is None:
+							break
+						pos = m.end()
+						continue
+					end = cut
+					block = buf[pos:end]
+					if b'\\' in block:
+						block = ESCAPE_RE.sub(b'', block)
+
+				if n_quotes:
+					# What's left is strings with no escapes in them,
+					# so every other piece is inside a string
+					block = b''.join(block.split(b'"')[::2])
+				brackets = block.translate(None, NOT_BRACKETS)
+
+				closes = brackets.count(b']') + brackets.count(b'}')
+				if closes < depth:
+					depth += len(brackets) - 2 * closes
+					pos = end
+					continue
+
+				# The end might be in this block. Go token by token
+				for m in TOKEN_RE.finditer(buf, pos, end):
+					char = buf[m.start()]
+					if char == 34:
+						continue
+					if char in OPENS:
+						depth += 1
+						continue
+					depth -= 1
+					if depth == 0:
+						self.pos = m.end()
+						return
+				pos = end
+
+			self.pos = pos
+			if not capture:
+				self.release()
+			self.need_more()
+
+	def skip_value(self) -> None:
+		"""Skips the next value. Not for use while capturing"""
+		char = self.peek()
+		if char is None:
+			raise InvalidMRF('Expected a JSON value, got the end of the file')
+
+		self.release()
+		if char in OPENS:
+			self.pos += 1
+			self.close_container()
+		elif char == 34:
+			self.read_string()
+		else:
+			self.read_scalar()
+
+	def read_value(self) -> bytes:
+		"""Raw bytes of the next value"""
+		char = self.peek()
+		if char is None:
+			raise InvalidMRF('Expected a JSON value, got the end of the file')
+
+		if char == 34:
+			return self.read_string()
+		if char not in OPENS:
+			return self.read_scalar()
+
+		# Reading more moves the value to the start of
+		# the buffer, so keep always points at the value
+		self.keep = self.pos
+		self.pos += 1
+		self.close_container(capture = True)
+		value = bytes(self.buf[self.keep:self.pos])
+		self.release()
+		return value
+
+	def gen_keys(self):
+		"""Yields each key of the object that starts here, with pos at
+		the key's value. The caller has to read or skip the value"""
+		self.expect(b'{')
+		char = self.peek()
+		while True:
+			if char == ord('}'):
+				self.pos += 1
+				return
+			if char == ord(','):
+				self.pos += 1
+				self.skip_ws()
+			key = self.read_string()
+			self.expect(b':')
+			self.skip_ws()
+			yield key
+			char = self.peek()
+
+	def gen_array(self):
+		"""Yields once per item of the array that starts here, with pos
+		at the item. The caller has to read or skip the item"""
+		self.expect(b'[')
+		char = self.peek()
+		while True:
+			if char == ord(']'):
+				self.pos += 1
+				return
+			if char == ord(','):
+				self.pos += 1
+				self.skip_ws()
+			yield
+			char = self.peek()
@@ -0,0 +1,246 @@
+"""
+Checkpoints for long runs
+#########################
+
+Flattening a 200GB in-network file takes hours, and a crash near the end
+used to mean starting over, with a partly written copy of the rows left
+in the CSVs to be appended to.
+
+With checkpoints on, every `interval` seconds the flattener:
+
+1. flushes the sinks, and asks each one for its state (for CSVs, the size
+   of every table's file; for Parquet, the finished parts; databases just
+   commit, since their inserts are idempotent)
+2. writes the number of in-network items whose rows are all in the sinks,
+   next to the sink states, to out_dir/.checkpoint-<file id>/state.json
+
+The reference map is pickled next to it once, at the start.
+
+Resuming truncates every output back to the last checkpoint, loads the
+reference map instead of reading (and fetching) the references again, and
+skips the items that were already written. The file is read again up to
+that point, but nothing is built, hashed or written for the skipped items,
+which is most of the time a run takes. The checkpoint is deleted when the
+run finishes.
+
+A checkpoint is only resumed with the same URL, filters and output format
+it was written with. Deduplication (`dedup = True`) starts over on resume,
+so some rows from before the checkpoint may be written again.
+
+Usage:
+>>> in_network_file_to_csv(..., checkpoint = True)
+>>> # ... crash ...
+>>> in_network_file_to_csv(..., checkpoint = True, resume = True)
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from typing import Iterable, Iterator
+
+from mrfutils import metrics
+from mrfutils.hashers import get_hash_mode
+from mrfutils.refmap import CompactReferenceMap, seal
+
+log = logging.getLogger('mrfutils')
+
+# Seconds between checkpoints
+INTERVAL = 300
+
+VERSION = 1
+
+STATE_FILE = 'state.json'
+REF_MAP_FILE = 'ref_map.pickle'
+
+
+def fingerprint(*options) -> str:
+	"""A hash of everything that changes which rows get written"""
+	h = hashlib.sha256()
+	for option in options:
+		if isinstance(option, (set, frozenset)):
+			option = sorted(map(repr, option))
+		elif isinstance(option, dict):
+			option = sorted(
+				(repr(k), sorted(map(repr, v)) if isinstance(v, (set, frozenset)) else repr(v))
+				for k, v in option.items()
+			)
+		h.update(repr(option).encode())
+		h.update(b'\0')
+	return h.hexdigest()
+
+
+def write_atomic(path: str, data: bytes) -> None:
+	"""Writes data to path so that a crash leaves either the old file
+	or the new one"""
+	fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), suffix = '.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, path)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+
+
+class Checkpointer:
+	"""
+	Saves and restores checkpoints for one file. The writers call
+	track() (or skip() and advance()) on the items they write.
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		file_id,
+		sinks: dict,
+		options: str,
+		interval: float | None = None,
+	):
+		self.dir = os.path.join(out_dir, f'.checkpoint-{file_id}')
+		self.sinks = sinks
+		self.options = options
+		self.interval = INTERVAL if interval is None else interval
+
+		# Items whose rows are all in the sinks
+		self.items = 0
+		# Items to skip because they were written before the resume
+		self.to_skip = 0
+		self.ref_map = None
+		self.saved_ref_map = False
+		self.last_save = time.monotonic()
+
+	@property
+	def state_file(self) -> str:
+		return os.path.join(self.dir, STATE_FILE)
+
+	@property
+	def ref_map_file(self) -> str:
+		return os.path.join(self.dir, REF_MAP_FILE)
+
+	def load_state(self) -> dict | None:
+		try:
+			with open(self.state_file) as f:
+				state = json.load(f)
+		except FileNotFoundError:
+			return None
+
+		if state.get('version') != VERSION:
+			raise ValueError(f'Checkpoint in {self.dir} is from another version of mrfutils')
+		if state['options'] != self.options:
+			raise ValueError(
+				f'Checkpoint in {self.dir} was written with different options '
+				'(URL, filters, output format, hash mode or delta). Delete it to start over.'
+			)
+		return state
+
+	def resume(self) -> bool:
+		"""Truncates the outputs to the last checkpoint and loads
+		it. Returns False if there's no checkpoint to resume"""
+		state = self.load_state()
+		if state is None:
+			log.info('No checkpoint to resume, starting from the beginning')
+			return False
+
+		for name, sink_state in state['sinks']:
+			self.sinks[name].restore(sink_state)
+
+		self.items = self.to_skip = state['items']
+
+		if state['ref_map']:
+			with open(self.ref_map_file, 'rb') as f:
+				ref_map = pickle.load(f)
+			if isinstance(ref_map, CompactReferenceMap):
+				ref_map = seal(ref_map)
+			self.ref_map = ref_map
+			self.saved_ref_map = True
+
+		log.info(f'Resuming after {self.items} in-network items')
+		return True
+
+	def save(self) -> None:
+		with metrics.stage('checkpoint'):
+			os.makedirs(self.dir, exist_ok = True)
+
+			if self.ref_map is not None and not self.saved_ref_map:
+				write_atomic(self.ref_map_file, pickle.dumps(self.ref_map, pickle.HIGHEST_PROTOCOL))
+				self.saved_ref_map = True
+
+			state = dict(
+				version = VERSION,
+				options = self.options,
+				items = self.items,
+				ref_map = self.saved_ref_map,
+				# Names can be None, which JSON keys can't
+				sinks = [[name, sink.checkpoint()] for name, sink in self.sinks.items()],
+				saved = time.time(),
+			)
+			write_atomic(self.state_file, json.dumps(state).encode())
+
+			self.last_save = time.monotonic()
+			log.debug(f'Checkpoint after {self.items} in-network items')
+
+	def start(self, ref_map) -> None:
+		"""Called by the writer with the reference map, before
+		the first item"""
+		if self.ref_map is None:
+			self.ref_map = ref_map
+		if not self.saved_ref_map:
+			self.save()
+
+	def skip(self, items: Iterable) -> Iterator:
+		"""Drops the items that were written before the resume"""
+		items = iter(items)
+		while self.to_skip:
+			try:
+				next(items)
+			except StopIteration:
+				return
+			self.to_skip -= 1
+		yield from items
+
+	def advance(self, n: int) -> None:
+		"""n more items are in the sinks"""
+		self.items += n
+		if time.monotonic() - self.last_save >= self.interval:
+			self.save()
+
+	def track(self, items: Iterable) -> Iterator:
+		"""skip(), then advance() as each item is done. For writers
+		that finish an item before they ask for the next one"""
+		for item in self.skip(items):
+			yield item
+			self.advance(1)
+
+	def finish(self) -> None:
+		"""The run is done and the sinks are closed"""
+		shutil.rmtree(self.dir, ignore_errors = True)
+
+
+def checkpoint_options(
+	url: str,
+	code_filter: set | None,
+	npi_filter: set | None,
+	tenants: dict | None,
+	tenant_code_filters: dict | None,
+	out_format: str,
+	delta: bool | str = False,
+) -> str:
+	return fingerprint(
+		VERSION,
+		url,
+		code_filter,
+		npi_filter,
+		tenants,
+		tenant_code_filters,
+		out_format,
+		get_hash_mode(),
+		delta,
+	)
@@ -0,0 +1,185 @@
+"""
+Filtering in-network items by code
+##################################
+
+A code filter is a set of `(billing_code_type, billing_code)` tuples, the
+rows of a codes.csv. Besides exact codes, a code can be
+
+- a range, `('CPT', '90935..90940')`. If both ends are digits the codes
+  are compared as numbers, otherwise as strings of the same length (so
+  `('HCPCS', 'J0120..J0135')` works too). A hyphen isn't a range: codes
+  like the NDC `00002-3227` are matched exactly
+- a prefix, `('HCPCS', 'J*')`, or `('MS-DRG', '*')` for every code of
+  a type
+
+and a rule can be on another field of the item instead of the code,
+`('billing_code_type_version', '2023')`, for any of ITEM_FIELDS. An item
+passes if its code matches any of the code rules (or there aren't any),
+and every field with rules has one of the values given. Items that aren't
+'ffs' are skipped unless there's a negotiation_arrangement rule. Items
+without a code or a field aren't filtered on it.
+
+The rules are compiled into a CodeFilter once per file. The parsers check
+an item against it when it sets one of the item's top-level fields that
+the filter looks at (CodeFilter.keys), and only the rule for that field:
+the code rules run once per item, when it has both its billing_code and
+billing_code_type. Once an item fails, the rest of it is skipped without
+being built.
+
+Usage:
+>>> code_filter = {('CPT', '90935..90940'), ('billing_code_type_version', '2023')}
+>>> in_network_file_to_csv(..., code_filter = code_filter)
+"""
+from __future__ import annotations
+
+import re
+from typing import Iterable
+
+from mrfutils import metrics
+
+CODE_KEYS = ('billing_code', 'billing_code_type')
+
+# Fields other than the code that rules can be on
+ITEM_FIELDS = ('negotiation_arrangement', 'billing_code_type_version')
+
+# Kept if there isn't a negotiation_arrangement rule
+DEFAULT_ARRANGEMENTS = frozenset({'ffs'})
+
+RANGE = re.compile(r'([0-9A-Za-z]+)\.\.([0-9A-Za-z]+)')
+
+
+def parse_range(code: str) -> tuple | None:
+	"""(low, high, numeric) if code is a range"""
+	match = RANGE.fullmatch(code)
+	if not match:
+		return None
+	low, high = match.groups()
+	if low.isdigit() and high.isdigit():
+		low, high = int(low), int(high)
+		return (low, high, True) if low <= high else None
+	if len(low) != len(high) or low > high:
+		return None
+	return low, high, False
+
+
+class CodeFilter:
+
+	def __init__(self, rules: Iterable):
+		self.rules = frozenset(rules)
+
+		self.codes = set()
+		self.prefixes: dict[str, tuple] = {}
+		self.ranges: dict[str, list] = {}
+		self.fields: dict[str, set] = {}
+
+		for rule in self.rules:
+			if not (isinstance(rule, tuple) and len(rule) == 2):
+				# e.g. a one-column codes.csv. These never matched
+				self.codes.add(rule)
+				continue
+
+			code_type, code = rule
+			if code_type in ITEM_FIELDS and isinstance(code, str):
+				self.fields.setdefault(code_type, set()).add(code)
+				continue
+
+			# A code always matches itself, whatever else it is
+			self.codes.add(rule)
+			if not isinstance(code, str):
+				continue
+			if code.endswith('*'):
+				self.prefixes[code_type] = self.prefixes.get(code_type, ()) + (code[:-1],)
+			elif (code_range := parse_range(code)) is not None:
+				self.ranges.setdefault(code_type, []).append(code_range)
+
+		self.has_codes = bool(self.codes or self.prefixes or self.ranges)
+		self.fields.setdefault('negotiation_arrangement', DEFAULT_ARRANGEMENTS)
+
+		# The top-level fields of an item that can get it skipped
+		self.keys = frozenset((CODE_KEYS if self.has_codes else ()) + tuple(self.fields))
+
+	def __repr__(self) -> str:
+		# Part of the checkpoint and manifest options
+		return f'CodeFilter({sorted(map(repr, self.rules))})'
+
+	def __contains__(self, code: tuple) -> bool:
+		return self.match_code(*code)
+
+	def match_code(self, code_type: str, code) -> bool:
+		code = str(code)
+		if (code_type, code) in self.codes:
+			return True
+
+		prefixes = self.prefixes.get(code_type)
+		if prefixes and code.startswith(prefixes):
+			return True
+
+		for low, high, numeric in self.ranges.get(code_type, ()):
+			if numeric:
+				if code.isdigit() and low <= int(code) <= high:
+					return True
+			elif len(code) == len(low) and low <= code <= high:
+				return True
+
+		return False
+
+	def skips(self, item: dict, key: str) -> bool:
+		"""Checks the rule for a field the item just got (one of
+		self.keys). Returns True, and counts it, if the item fails"""
+		if key in CODE_KEYS:
+			code = item.get('billing_code')
+			code_type = item.get('billing_code_type')
+			if code and code_type and not self.match_code(code_type, code):
+				metrics.count('items_skipped_code')
+				return True
+			return False
+
+		value = item[key]
+		if value and str(value) not in self.fields[key]:
+			if key == 'negotiation_arrangement':
+				metrics.count('items_skipped_arrangement')
+			else:
+				metrics.count('items_skipped_field')
+			return True
+		return False
+
+	def matches(self, item: dict) -> bool:
+		"""Whether a whole item passes, without counting it"""
+		if self.has_codes and not self.match_code(item.get('billing_code_type'), item.get('billing_code')):
+			return False
+		for key, values in self.fields.items():
+			value = item.get(key)
+			if value and str(value) not in values:
+				return False
+		return True
+
+
+def compile_code_filter(code_filter: set | CodeFilter | None) -> CodeFilter:
+	if isinstance(code_filter, CodeFilter):
+		return code_filter
+	return CodeFilter(code_filter or ())
+
+
+def union_code_filters(code_filters: Iterable[set | CodeFilter | None]) -> set | None:
+	"""The rules of a filter that passes every item any of the
+	filters pass, or None if that doesn't need any"""
+	compiled = [compile_code_filter(code_filter) for code_filter in code_filters]
+
+	rules = set()
+	if all(code_filter.has_codes for code_filter in compiled):
+		for code_filter in compiled:
+			rules.update(
+				rule for rule in code_filter.rules
+				if not (isinstance(rule, tuple) and len(rule) == 2 and rule[0] in ITEM_FIELDS)
+			)
+
+	# A field is only filtered if every filter has rules for it
+	for key in ITEM_FIELDS:
+		if not all(key in code_filter.fields for code_filter in compiled):
+			continue
+		values = set().union(*(code_filter.fields[key] for code_filter in compiled))
+		if key == 'negotiation_arrangement' and values == DEFAULT_ARRANGEMENTS:
+			continue
+		rules.update((key, value) for value in values)
+
+	return rules or None
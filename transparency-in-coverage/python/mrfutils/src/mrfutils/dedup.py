@@ -0,0 +1,219 @@
+"""
+Dropping duplicate rows before they're written
+##############################################
+
+The flattener writes the same code, tin, npi_tin, rate_metadata and rate
+rows over and over. Every row already has a hash id (or a key made of hash
+ids), so we can remember what we wrote and skip it the next time.
+
+Small tables (code, tin, rate_metadata, file...) are tracked exactly in a
+set. The tables that grow with the size of the file (rate, tin_rate_file,
+npi_tin) are tracked in a Bloom filter with a fixed size, so memory stays
+bounded no matter how big the file is. The catch is that a Bloom filter
+can have false positives: with the defaults, about 1 in a million unique
+rows would be dropped once the filter is at capacity. Pass
+`bloom_tables = ()` if you'd rather have exact sets for everything.
+
+Usage:
+>>> with DedupSink(CSVSink(out_dir)) as sink:
+>>>     sink.write('code', code_row)
+>>> sink.suppressed
+{'code': 12, ...}
+"""
+from __future__ import annotations
+
+import logging
+import math
+
+log = logging.getLogger('mrfutils')
+
+# To distinguish data from rows
+Row = dict
+
+# The columns that identify a row. For most tables this is just the id
+DEDUP_KEYS = {
+	'file':          ('id',),
+	'code':          ('id',),
+	'rate_metadata': ('id',),
+	'rate':          ('id',),
+	'tin':           ('id',),
+	'tin_rate_file': ('tin_id', 'rate_id', 'file_id'),
+	'npi_tin':       ('npi', 'tin_id'),
+	'toc':           ('id',),
+	'toc_plan':      ('id',),
+	'toc_file':      ('id',),
+	'toc_plan_file': ('link', 'toc_plan_id', 'toc_file_id'),
+}
+
+BLOOM_TABLES = ('rate', 'tin_rate_file', 'npi_tin')
+
+# Rows per Bloom filter before the error rate starts to climb.
+# 50M rows at 1e-6 is about 180MB per table
+BLOOM_CAPACITY = 50_000_000
+BLOOM_ERROR_RATE = 1e-6
+
+MASK_64 = 2**64 - 1
+
+
+def mix64(x: int) -> int:
+	"""splitmix64 finalizer. Spreads keys (especially small ints
+	like NPIs) evenly over 64 bits"""
+	x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & MASK_64
+	x = (x ^ (x >> 27)) * 0x94d049bb133111eb & MASK_64
+	return x ^ (x >> 31)
+
+
+class BloomFilter:
+
+	def __init__(
+		self,
+		capacity: int = BLOOM_CAPACITY,
+		error_rate: float = BLOOM_ERROR_RATE,
+	):
+		if not 0 < error_rate < 1:
+			raise ValueError(f'Error rate must be in (0, 1): {error_rate=}')
+
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.n_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+		self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+		self.bits = bytearray((self.n_bits + 7) // 8)
+		self.n_items = 0
+
+	def add(self, key: int) -> bool:
+		"""Adds a 64-bit key. Returns True if the key was
+		(probably) already there"""
+		h1 = mix64(key)
+		h2 = mix64(h1) | 1
+		n_bits = self.n_bits
+		bits = self.bits
+
+		seen = True
+		for i in range(self.n_hashes):
+			pos = (h1 + i * h2) % n_bits
+			byte, bit = pos >> 3, 1 << (pos & 7)
+			if not bits[byte] & bit:
+				bits[byte] |= bit
+				seen = False
+
+		if not seen:
+			self.n_items += 1
+
+		return seen
+
+	@property
+	def saturated(self) -> bool:
+		return self.n_items > self.capacity
+
+
+class RowDeduper:
+	"""
+	Remembers the keys of rows that have been written. One deduper can be
+	shared by several sinks (e.g. one per tenant) by giving each sink its
+	own namespace, so there's only one set of Bloom filters to size.
+	"""
+
+	def __init__(
+		self,
+		bloom_tables: tuple = BLOOM_TABLES,
+		capacity: int = BLOOM_CAPACITY,
+		error_rate: float = BLOOM_ERROR_RATE,
+	):
+		self.bloom_tables = set(bloom_tables)
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.blooms: dict[str, BloomFilter] = {}
+		self.sets: dict[str, set] = {}
+
+	def seen(self, table_name: str, row: Row, namespace: int = 0) -> bool:
+		"""Marks the row as written. Returns True if it
+		had already been written"""
+		cols = DEDUP_KEYS[table_name]
+		if len(cols) == 1:
+			key = (namespace, row[cols[0]])
+		else:
+			key = (namespace, *(row[col] for col in cols))
+
+		if table_name in self.bloom_tables:
+			bloom = self.blooms.get(table_name)
+			if bloom is None:
+				bloom = BloomFilter(self.capacity, self.error_rate)
+				self.blooms[table_name] = bloom
+				log.info(
+					f'Allocated {len(bloom.bits) // 2**20}MB Bloom filter '
+					f'for {table_name} ({bloom.n_hashes} hashes)'
+				)
+			# Tuples of ints hash the same way in every process
+			return bloom.add(hash(key) & MASK_64)
+
+		keys = self.sets.setdefault(table_name, set())
+		if key in keys:
+			return True
+		keys.add(key)
+		return False
+
+
+class DedupSink:
+	"""Wraps another sink and only passes through rows it hasn't seen"""
+
+	def __init__(
+		self,
+		sink,
+		deduper: RowDeduper | None = None,
+		namespace: int = 0,
+	):
+		self.sink = sink
+		self.deduper = deduper or RowDeduper()
+		self.namespace = namespace
+		self.suppressed: dict[str, int] = {}
+
+	def write(self, table_name: str, row_data: list[Row] | Row) -> None:
+		seen = self.deduper.seen
+
+		if isinstance(row_data, dict):
+			if seen(table_name, row_data, self.namespace):
+				self.suppressed[table_name] = self.suppressed.get(table_name, 0) + 1
+				return
+			self.sink.write(table_name, row_data)
+			return
+
+		rows = [row for row in row_data if not seen(table_name, row, self.namespace)]
+
+		if n_dupes := len(row_data) - len(rows):
+			self.suppressed[table_name] = self.suppressed.get(table_name, 0) + n_dupes
+			if not rows:
+				return
+
+		self.sink.write(table_name, rows)
+
+	def flush(self) -> None:
+		self.sink.flush()
+
+	def checkpoint(self) -> dict:
+		return self.sink.checkpoint()
+
+	def restore(self, state: dict) -> None:
+		self.sink.restore(state)
+
+	def table_bytes(self) -> dict:
+		return self.sink.table_bytes()
+
+	def close(self) -> None:
+		self.sink.close()
+
+		for table_name, n in sorted(self.suppressed.items()):
+			log.info(f'Suppressed {n} duplicate {table_name} rows')
+
+		for table_name, bloom in self.deduper.blooms.items():
+			if bloom.saturated:
+				log.warning(
+					f'Bloom filter for {table_name} is over capacity '
+					f'({bloom.n_items} > {bloom.capacity}). Some unique '
+					'rows may have been dropped. Raise the capacity.'
+				)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -0,0 +1,262 @@
+"""
+Month-over-month deltas
+#######################
+
+Most of an insurer's rates are the same from one month to the next, but
+every run writes all of them again, and loading a month means loading
+every row.
+
+In delta mode the flattener keeps an id store in out_dir/ids: for each of
+the tables that grow with the size of the file (rate, tin_rate_file and
+npi_tin, the Bloom tables in mrfutils.dedup), the key of every row the
+run produced, as a sorted array of unique uint64 saved with numpy
+(<table>.npy). The key of a rate row is its id. For tin_rate_file and
+npi_tin, whose rows are identified by several columns, it's a 64-bit hash
+of those columns (DELTA_KEYS, row_keys).
+
+A tin_rate_file row's key is its primary key, (rate_id, tin_id), without
+the file_id: files are usually renamed every month (dated filenames), and
+that would make every row look new. So a tin_rate_file row that's
+unchanged isn't written again even if it now comes from another file;
+rewrite file_id on the rows you keep if you need it to be current.
+
+Given the out_dir of the previous run, the flattener memory-maps its id
+store and only writes the rows whose key isn't in it: the rows that were
+added. Lookups are a binary search (np.searchsorted) per batch of rows,
+so only the pages of the store that are needed are read. When the run is
+done, the keys that were in the previous store but not this run's are
+saved to out_dir/removed/<table>.npy. The other tables are small and are
+written in full, as usual.
+
+While a run goes, the keys are appended to out_dir/ids/<table>.keys, so
+they don't have to fit in memory and are cut back with the outputs when a
+run resumes from a checkpoint (mrfutils.checkpoint). They're sorted into
+the store when the sink is closed.
+
+A file skipped by a Manifest (mrfutils.manifest) writes nothing, so it has
+no id store: point the next run at the out_dir it was last written to.
+
+This needs numpy: pip install mrfutils[fast]
+
+Usage:
+>>> in_network_file_to_csv(url, 'jan', delta = True)
+>>> in_network_file_to_csv(url, 'feb', delta = 'jan')
+>>> removed = np.load('feb/removed/rate.npy')
+"""
+from __future__ import annotations
+
+import logging
+import os
+from array import array
+
+from mrfutils import metrics
+from mrfutils.dedup import BLOOM_TABLES, Row
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+log = logging.getLogger('mrfutils')
+
+DELTA_TABLES = BLOOM_TABLES
+
+# The columns that identify a row from one run to the next. Unlike
+# DEDUP_KEYS, tin_rate_file's doesn't include the file_id
+DELTA_KEYS = {
+	'rate': ('id',),
+	'tin_rate_file': ('rate_id', 'tin_id'),
+	'npi_tin': ('npi', 'tin_id'),
+}
+
+STORE_DIR = 'ids'
+REMOVED_DIR = 'removed'
+
+# Keys held in memory before they're appended to the .keys file
+BUFFER_SIZE = 2**16
+
+
+def mix64_array(x: np.ndarray) -> np.ndarray:
+	"""mrfutils.dedup.mix64, for a uint64 array"""
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+
+def row_keys(table_name: str, rows: list[Row]) -> np.ndarray:
+	"""The uint64 key of each row. Use this to match the rows already
+	loaded against out_dir/removed/<table>.npy"""
+	cols = DELTA_KEYS[table_name]
+	n = len(rows)
+
+	keys = np.fromiter((row[cols[0]] for row in rows), np.uint64, n)
+	if len(cols) == 1:
+		return keys
+
+	with np.errstate(over = 'ignore'):
+		keys = mix64_array(keys)
+		for col in cols[1:]:
+			keys = mix64_array(keys ^ np.fromiter((row[col] for row in rows), np.uint64, n))
+	return keys
+
+
+def store_path(out_dir: str, table_name: str) -> str:
+	return f'{out_dir}/{STORE_DIR}/{table_name}.npy'
+
+
+def load_store(out_dir: str, table_name: str) -> np.ndarray:
+	"""A run's keys for a table, memory-mapped"""
+	path = store_path(out_dir, table_name)
+	if not os.path.exists(path):
+		raise FileNotFoundError(f'No id store for {table_name} in {out_dir}. Was it written with delta = True?')
+	return np.load(path, mmap_mode = 'r')
+
+
+def contains(store: np.ndarray, keys: np.ndarray) -> np.ndarray:
+	"""Whether each key is in the sorted store"""
+	if not len(store):
+		return np.zeros(len(keys), bool)
+	pos = np.searchsorted(store, keys)
+	pos[pos == len(store)] = 0
+	return store[pos] == keys
+
+
+def save_array(path: str, keys: np.ndarray) -> None:
+	# So a crash leaves either the old file or the new one
+	tmp = f'{path}.tmp'
+	with open(tmp, 'wb') as f:
+		np.save(f, keys)
+	os.replace(tmp, path)
+
+
+class DiffSink:
+	"""
+	Wraps another sink. Records the key of every rate, tin_rate_file
+	and npi_tin row, and only passes through the ones that aren't in
+	the previous run's store (all of them if there isn't one)
+	"""
+
+	def __init__(self, sink, out_dir: str, previous: str | None = None):
+		if np is None:
+			raise ImportError('Delta mode needs numpy: pip install mrfutils[fast]')
+
+		self.sink = sink
+		self.out_dir = out_dir
+		self.previous = previous
+
+		os.makedirs(f'{out_dir}/{STORE_DIR}', exist_ok = True)
+		self.stores = {}
+		if previous is not None:
+			self.stores = {table_name: load_store(previous, table_name) for table_name in DELTA_TABLES}
+
+		self.buffers = {table_name: array('Q') for table_name in DELTA_TABLES}
+		self.key_files = {
+			table_name: open(self.keys_path(table_name), 'ab')
+			for table_name in DELTA_TABLES
+		}
+
+	def keys_path(self, table_name: str) -> str:
+		return f'{self.out_dir}/{STORE_DIR}/{table_name}.keys'
+
+	def write(self, table_name: str, row_data: list[Row] | Row) -> None:
+		if table_name not in self.buffers:
+			self.sink.write(table_name, row_data)
+			return
+
+		rows = [row_data] if isinstance(row_data, dict) else row_data
+		if not rows:
+			return
+
+		keys = row_keys(table_name, rows)
+		buffer = self.buffers[table_name]
+		buffer.frombytes(keys.tobytes())
+		if len(buffer) >= BUFFER_SIZE:
+			self.flush_keys(table_name)
+
+		store = self.stores.get(table_name)
+		if store is None:
+			self.sink.write(table_name, row_data)
+			return
+
+		old = contains(store, keys)
+		if n_old := int(old.sum()):
+			metrics.count('rows_unchanged', n_old)
+			if n_old == len(rows):
+				return
+			rows = [row for row, is_old in zip(rows, old.tolist()) if not is_old]
+
+		self.sink.write(table_name, rows)
+
+	def flush_keys(self, table_name: str) -> None:
+		buffer = self.buffers[table_name]
+		if buffer:
+			buffer.tofile(self.key_files[table_name])
+			del buffer[:]
+
+	def flush(self) -> None:
+		self.sink.flush()
+
+	def checkpoint(self) -> dict:
+		for table_name, f in self.key_files.items():
+			self.flush_keys(table_name)
+			f.flush()
+		return dict(
+			sink = self.sink.checkpoint(),
+			keys = {table_name: f.tell() for table_name, f in self.key_files.items()},
+		)
+
+	def restore(self, state: dict) -> None:
+		"""Cuts the keys back to the checkpoint. Only call
+		this before anything is written"""
+		self.sink.restore(state['sink'])
+		for table_name, size in state['keys'].items():
+			f = self.key_files[table_name]
+			f.truncate(size)
+			f.seek(size)
+
+	def table_bytes(self) -> dict:
+		return self.sink.table_bytes()
+
+	def close_keys(self) -> None:
+		for table_name, f in self.key_files.items():
+			self.flush_keys(table_name)
+			f.close()
+		self.key_files = {}
+
+	def close(self) -> None:
+		if not self.key_files:
+			return
+		self.sink.close()
+		self.close_keys()
+
+		if self.previous is not None:
+			os.makedirs(f'{self.out_dir}/{REMOVED_DIR}', exist_ok = True)
+
+		for table_name in DELTA_TABLES:
+			keys_path = self.keys_path(table_name)
+			keys = np.unique(np.fromfile(keys_path, np.uint64))
+			save_array(store_path(self.out_dir, table_name), keys)
+			os.remove(keys_path)
+
+			store = self.stores.get(table_name)
+			if store is None:
+				continue
+
+			removed = store[~contains(keys, store)]
+			save_array(f'{self.out_dir}/{REMOVED_DIR}/{table_name}.npy', removed)
+			metrics.count('rows_removed', len(removed))
+			n_added = len(keys) - (len(store) - len(removed))
+			log.info(f'{table_name}: {n_added:,} rows added, {len(removed):,} removed since {self.previous}')
+		self.stores = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		if exc_type is None:
+			self.close()
+			return
+		# Not a whole run: keep the keys for a resume,
+		# but don't make a store of them
+		self.sink.close()
+		self.close_keys()
@@ -0,0 +1,483 @@
+"""
+The basic_parse engine
+######################
+
+`ijson.parse` builds a dotted prefix string ('in_network.item.negotiated_
+rates.item...') for every event, and the default engine compares those
+prefixes and feeds every event through an ijson.ObjectBuilder. This engine
+reads `ijson.basic_parse` events instead and keeps track of where it is by
+counting start_*/end_* events. Objects are built with a plain loop and
+rejected in-network items are skipped by depth, without building anything.
+
+The output is the same as the default engine's, including the file
+structures described in flatteners._get_reference_map:
+
+1. provider_references before in_network: one pass
+2. provider_references after in_network: in_network is skipped on the first
+   pass and read on a second pass, once the references are known
+3. no provider_references: same as (2), with an empty reference map
+
+With `spill = True`, (2) and (3) also take one pass: the in-network items
+are spilled to disk and replayed at the end (see mrfutils.spill).
+
+With an index (see mrfutils.gzindex), the engine seeks straight to each
+section it needs instead.
+
+The 'byte_skip' engine (ByteSkipEngine) runs the same passes without
+ijson: see mrfutils.bytescan. It's the one to use with a code filter that
+throws away most of the file.
+
+Usage:
+>>> in_network_file_to_csv(..., engine = 'basic_parse')
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+from typing import Generator, Iterator
+
+import ijson
+
+from mrfutils import flatteners, metrics
+from mrfutils.bytescan import OPENS, ByteScanner
+from mrfutils.codefilter import CodeFilter, compile_code_filter
+from mrfutils.exceptions import InvalidMRF
+from mrfutils.gzindex import MRFIndex
+from mrfutils.helpers import JSONOpen
+from mrfutils.spill import SpillStore
+
+log = logging.getLogger('mrfutils')
+
+START_EVENTS = ('start_map', 'start_array')
+END_EVENTS = ('end_map', 'end_array')
+
+
+def clean(value):
+	"""Same cleanup gen_in_network_items does on every value"""
+	if type(value) is str:
+		value = value.strip()
+		if value == '':
+			value = None
+	return value
+
+
+def skip_value(events: Iterator, event: str) -> None:
+	"""Skips the value that starts with `event`"""
+	if event not in START_EVENTS:
+		return
+
+	depth = 1
+	for event, _ in events:
+		if event in START_EVENTS:
+			depth += 1
+		elif event in END_EVENTS:
+			depth -= 1
+			if depth == 0:
+				return
+
+
+def build_value(
+	events: Iterator,
+	event: str,
+	value,
+	strip: bool = False,
+):
+	"""Builds the value that starts with (event, value)"""
+	if event == 'start_map':
+		top = {}
+	elif event == 'start_array':
+		top = []
+	else:
+		return clean(value) if strip else value
+
+	root = top
+	stack = []
+	key = None
+
+	for event, value in events:
+		if strip and type(value) is str:
+			value = clean(value)
+
+		if event == 'map_key':
+			key = value
+			continue
+
+		if event in END_EVENTS:
+			if not stack:
+				return root
+			top, key = stack.pop()
+			continue
+
+		if event == 'start_map':
+			value = {}
+		elif event == 'start_array':
+			value = []
+
+		if type(top) is dict:
+			top[key] = value
+		else:
+			top.append(value)
+
+		if event in START_EVENTS:
+			stack.append((top, key))
+			top = value
+
+	raise InvalidMRF('File ended in the middle of a value')
+
+
+def build_in_network_item(
+	events: Iterator,
+	code_filter: CodeFilter,
+) -> dict | None:
+	"""
+	Builds one in-network item (the start_map has been consumed).
+	Returns None if the item got skipped. The filter only looks at
+	the item's top-level fields, so it's checked when one of the
+	fields it looks at is set.
+	"""
+	watched = code_filter.keys
+
+	item = {}
+	key = None
+
+	for event, value in events:
+		if event == 'map_key':
+			key = clean(value)
+
+		elif event == 'end_map':
+			return item
+
+		elif event in START_EVENTS:
+			item[key] = build_value(events, event, value, strip = True)
+
+		else:
+			item[key] = clean(value)
+			if key in watched and code_filter.skips(item, key):
+				skip_value(events, 'start_map')
+				return None
+
+	raise InvalidMRF('File ended in the middle of an in-network item')
+
+
+def gen_array_items(events: Iterator, event: str) -> Generator:
+	"""Yields the (event, value) that starts each item
+	of the array that starts with `event`"""
+	if event != 'start_array':
+		skip_value(events, event)
+		return
+
+	for event, value in events:
+		if event == 'end_array':
+			return
+		yield event, value
+
+
+def gen_in_network_items(
+	events: Iterator,
+	event: str,
+	code_filter: set | CodeFilter | None,
+) -> Generator:
+	code_filter = compile_code_filter(code_filter)
+	for event, value in gen_array_items(events, event):
+		if event != 'start_map':
+			skip_value(events, event)
+			continue
+
+		in_network_item = build_in_network_item(events, code_filter)
+		if in_network_item is not None:
+			yield in_network_item
+
+
+def gen_references(events: Iterator, event: str) -> Generator:
+	for event, value in gen_array_items(events, event):
+		reference = build_value(events, event, value)
+		if isinstance(reference, dict):
+			yield reference
+
+
+class BasicParseEngine:
+	"""
+	Usage:
+	>>> engine = BasicParseEngine(file, code_filter, npi_filter[, spill, index, swap, ref_map])
+	>>> for item in engine.in_network_items():
+	>>>     ...
+	>>> engine.metadata
+
+	in_network_items() yields code-filtered in-network items with their
+	provider references swapped in (but not NPI filtered -- that's still
+	process_in_network's job). `metadata` is filled in as the top-level
+	fields go by. With `swap = False` the items come out as they are in
+	the file, and `ref_map` is set by the time the first one comes out.
+	Pass a `ref_map` to use it instead of reading the references (when
+	resuming from a checkpoint).
+
+	The passes only use make_stream, value_start, gen_top_level, skip,
+	build, read_references and gen_items, so another engine only has to
+	override those.
+	"""
+
+	def __init__(
+		self,
+		file: str,
+		code_filter: set | CodeFilter | None,
+		npi_filter: set | None,
+		spill: bool = False,
+		index: MRFIndex | None = None,
+		swap: bool = True,
+		ref_map: dict | None = None,
+	):
+		self.file = file
+		self.code_filter = compile_code_filter(code_filter)
+		self.npi_filter = npi_filter
+		self.spill = spill
+		self.index = index
+		self.swap = swap
+		self.metadata = {}
+		self.ref_map = ref_map
+		self.spilled = None
+
+	def make_stream(self, f) -> Iterator:
+		return metrics.count_events(ijson.basic_parse(f, use_float = True))
+
+	def value_start(self, events: Iterator) -> tuple:
+		"""The start of the value the stream is at"""
+		return next(events)
+
+	@contextlib.contextmanager
+	def open_stream(self):
+		with JSONOpen(self.file) as f:
+			yield self.make_stream(f)
+
+	@contextlib.contextmanager
+	def open_section(self, key: str):
+		"""Yields (stream, start) for the value of a top-level key"""
+		with self.index.open_section(key) as f:
+			stream = self.make_stream(f)
+			yield stream, self.value_start(stream)
+
+	def gen_top_level(self, events: Iterator) -> Generator:
+		"""Yields (key, start) for each top-level key, where
+		start is the (event, value) that starts the key's value"""
+		for event, _ in events:
+			if event != 'start_map':
+				raise InvalidMRF('MRF is not a JSON object')
+			break
+
+		for event, key in events:
+			if event == 'end_map':
+				return
+			yield key, next(events)
+
+	def skip(self, events: Iterator, start: tuple) -> None:
+		skip_value(events, start[0])
+
+	def build(self, events: Iterator, start: tuple):
+		return build_value(events, *start)
+
+	def read_references(self, events: Iterator, start: tuple) -> None:
+		references = gen_references(events, start[0])
+		self.ref_map = flatteners.get_reference_map_from_references(
+			references, self.npi_filter
+		)
+
+	def gen_items(self, events: Iterator, start: tuple) -> Generator:
+		return gen_in_network_items(events, start[0], self.code_filter)
+
+	def swap_references(self, items: Iterator) -> Iterator:
+		if not self.swap:
+			return items
+		return flatteners.swap_references(items, self.ref_map)
+
+	def first_pass(self, stream) -> Generator:
+		"""Reads everything in file order. Returns True if in_network
+		got read (i.e. the references came first)"""
+		completed = False
+
+		for key, start in self.gen_top_level(stream):
+			if key == 'provider_references':
+				if self.ref_map is None:
+					self.read_references(stream, start)
+				else:
+					self.skip(stream, start)
+
+			elif key == 'in_network':
+				if self.ref_map is None and self.spill and self.spilled is None:
+					self.spilled = SpillStore()
+					self.spilled.extend(self.gen_items(stream, start))
+					continue
+
+				if self.ref_map is None or completed:
+					self.skip(stream, start)
+					continue
+
+				items = self.gen_items(stream, start)
+				yield from self.swap_references(items)
+				completed = True
+
+			elif not completed:
+				self.metadata[key] = self.build(stream, start)
+
+			else:
+				self.skip(stream, start)
+
+		return completed
+
+	def second_pass(self, stream) -> Generator:
+		"""Only reads in_network, with the references
+		from the first pass"""
+		for key, start in self.gen_top_level(stream):
+			if key != 'in_network':
+				self.skip(stream, start)
+				continue
+
+			items = self.gen_items(stream, start)
+			yield from self.swap_references(items)
+			return
+
+	def indexed_pass(self) -> Generator:
+		"""Only reads the sections we need, in the order we need them"""
+		for key in self.index.metadata_keys('in_network'):
+			with self.open_section(key) as (stream, start):
+				self.metadata[key] = self.build(stream, start)
+
+		if self.ref_map is None:
+			self.ref_map = {}
+			if 'provider_references' in self.index.sections:
+				with self.open_section('provider_references') as (stream, start):
+					self.read_references(stream, start)
+
+		if 'in_network' not in self.index.sections:
+			return
+
+		with self.open_section('in_network') as (stream, start):
+			items = self.gen_items(stream, start)
+			yield from self.swap_references(items)
+
+	def in_network_items(self) -> Generator:
+		if self.index is not None:
+			yield from self.indexed_pass()
+			return
+
+		try:
+			with self.open_stream() as stream:
+				completed = yield from self.first_pass(stream)
+
+			if completed:
+				return
+
+			# The references came after in_network, or there weren't any
+			if self.ref_map is None:
+				self.ref_map = {}
+
+			if self.spilled is not None:
+				items = self.spilled.replay()
+				yield from self.swap_references(items)
+				return
+
+			with self.open_stream() as stream:
+				yield from self.second_pass(stream)
+
+		finally:
+			if self.spilled is not None:
+				self.spilled.close()
+
+
+def clean_value(value):
+	"""clean() applied to every string (and key) in a value"""
+	type_ = type(value)
+	if type_ is str:
+		return clean(value)
+	if type_ is dict:
+		return {clean(k): clean_value(v) for k, v in value.items()}
+	if type_ is list:
+		return [clean_value(v) for v in value]
+	return value
+
+
+class ByteSkipEngine(BasicParseEngine):
+	"""
+	Same passes as BasicParseEngine, over a bytescan.ByteScanner instead
+	of ijson events. Rejected in-network items (and everything else that
+	gets skipped) are skipped without tokenizing them. What's kept is
+	handed to json.loads, so a kept item is parsed once, in C.
+
+	In an in-network item, the container values are only skipped over
+	(but kept in the buffer) until the item is known to be kept. The skip
+	rules only look at the top-level scalars, same as build_in_network_item.
+
+	Usage:
+	>>> in_network_file_to_csv(..., engine = 'byte_skip')
+	"""
+
+	def make_stream(self, f) -> ByteScanner:
+		return ByteScanner(f)
+
+	def value_start(self, scanner: ByteScanner) -> None:
+		return None
+
+	def gen_top_level(self, scanner: ByteScanner) -> Generator:
+		if scanner.peek() != ord('{'):
+			raise InvalidMRF('MRF is not a JSON object')
+
+		for key in scanner.gen_keys():
+			yield json.loads(key), None
+
+	def skip(self, scanner: ByteScanner, start = None) -> None:
+		scanner.skip_value()
+
+	def build(self, scanner: ByteScanner, start = None):
+		return json.loads(scanner.read_value())
+
+	def gen_array_items(self, scanner: ByteScanner) -> Generator:
+		"""Yields once per item, with the scanner at the item.
+		Skips the value if it isn't an array"""
+		if scanner.peek() != ord('['):
+			scanner.skip_value()
+			return
+
+		yield from scanner.gen_array()
+
+	def read_references(self, scanner: ByteScanner, start = None) -> None:
+		references = (
+			reference
+			for _ in self.gen_array_items(scanner)
+			if isinstance(reference := self.build(scanner), dict)
+		)
+		self.ref_map = flatteners.get_reference_map_from_references(
+			references, self.npi_filter
+		)
+
+	def read_in_network_item(self, scanner: ByteScanner) -> dict | None:
+		"""Reads the in-network item at the scanner.
+		Returns None if it got skipped"""
+		scanner.keep = scanner.pos
+		top = {}
+		watched = self.code_filter.keys
+
+		for key in scanner.gen_keys():
+			if scanner.peek() in OPENS:
+				scanner.pos += 1
+				scanner.close_container(capture = True)
+				continue
+
+			key = clean(json.loads(key))
+			top[key] = clean(json.loads(scanner.read_value()))
+			if key in watched and self.code_filter.skips(top, key):
+				scanner.release()
+				scanner.close_container()
+				return None
+
+		item = json.loads(scanner.buf[scanner.keep:scanner.pos])
+		scanner.release()
+		return clean_value(item)
+
+	def gen_items(self, scanner: ByteScanner, start = None) -> Generator:
+		for _ in self.gen_array_items(scanner):
+			if scanner.peek() != ord('{'):
+				scanner.skip_value()
+				continue
+
+			item = self.read_in_network_item(scanner)
+			if item is not None:
+				yield item
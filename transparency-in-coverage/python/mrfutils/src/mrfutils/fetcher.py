@@ -0,0 +1,289 @@
+"""
+Fetching remote provider references
+###################################
+
+Provider references can be links (`location`) to JSON files instead of
+being inline. There can be tens of thousands of them in one MRF, and the
+same links show up again in the insurer's other files.
+
+ReferenceFetcher gets them:
+
+- with at most `concurrency` connections open, and at most `per_host` to
+  any one host
+- with a timeout on every request
+- retrying connection errors, timeouts and 408/429/5xx responses up to
+  `retries` times, with exponential backoff and full jitter (and
+  respecting Retry-After)
+- from an on-disk cache, if it's given a `cache_dir`. Cached responses
+  are revalidated with If-None-Match/If-Modified-Since, so a 304 costs a
+  round trip but no download. Entries younger than `max_age` seconds
+  aren't revalidated at all. Entries are written atomically, so any
+  number of runs and processes can share one cache directory.
+
+Anything that still fails raises FetchError. Counts of what happened are
+kept in `fetcher.stats`.
+
+The flattener uses the fetcher returned by get_fetcher(). To change it:
+
+>>> set_fetcher(ReferenceFetcher(cache_dir = 'ref_cache', per_host = 4))
+>>> in_network_file_to_csv(...)
+>>> get_fetcher().stats
+FetchStats(downloaded=1200, cached=0, revalidated=38000, failed=2, ...)
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from mrfutils.exceptions import FetchError
+
+log = logging.getLogger('mrfutils')
+
+CONCURRENCY = 64
+PER_HOST = 16
+RETRIES = 4
+
+# Seconds. The n-th retry waits a random time between
+# 0 and min(MAX_BACKOFF, BACKOFF * 2**n)
+BACKOFF = .5
+MAX_BACKOFF = 30
+
+TIMEOUT = aiohttp.ClientTimeout(total = 120, sock_connect = 30)
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class FetchStats:
+
+	FIELDS = ('downloaded', 'cached', 'revalidated', 'retries', 'failed', 'bytes')
+
+	def __init__(self):
+		for field in self.FIELDS:
+			setattr(self, field, 0)
+
+		# Host -> number of failed URLs
+		self.failed_hosts: dict[str, int] = {}
+
+	def fail(self, url: str) -> None:
+		self.failed += 1
+		host = urlsplit(url).netloc
+		self.failed_hosts[host] = self.failed_hosts.get(host, 0) + 1
+
+	def as_dict(self) -> dict:
+		return {field: getattr(self, field) for field in self.FIELDS}
+
+	def __repr__(self) -> str:
+		fields = ', '.join(f'{k}={v}' for k, v in self.as_dict().items())
+		return f'FetchStats({fields})'
+
+
+class ReferenceCache:
+	"""
+	One file per URL, named after the URL's hash: a line of JSON
+	with the URL and its validators, then the body.
+	"""
+
+	def __init__(self, cache_dir: str):
+		self.dir = Path(cache_dir)
+		self.dir.mkdir(parents = True, exist_ok = True)
+
+	def path(self, url: str) -> Path:
+		key = hashlib.sha256(url.encode()).hexdigest()
+		return self.dir / key[:2] / f'{key}.ref'
+
+	def load(self, url: str) -> tuple[dict, bytes] | None:
+		"""(header, body) or None if it isn't cached"""
+		try:
+			with open(self.path(url), 'rb') as f:
+				header = json.loads(f.readline())
+				body = f.read()
+		except (OSError, ValueError):
+			return None
+
+		# Hash collision, or some other file
+		if header.get('url') != url:
+			return None
+		return header, body
+
+	def store(self, url: str, body: bytes, etag: str | None, last_modified: str | None) -> None:
+		header = dict(
+			url = url,
+			etag = etag,
+			last_modified = last_modified,
+			stored = time.time(),
+		)
+		path = self.path(url)
+		path.parent.mkdir(exist_ok = True)
+
+		# Write then rename, so readers never see half a file
+		fd, tmp = tempfile.mkstemp(dir = path.parent, suffix = '.tmp')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(json.dumps(header).encode() + b'\n')
+				f.write(body)
+			os.replace(tmp, path)
+		except BaseException:
+			os.unlink(tmp)
+			raise
+
+
+def retry_after(response: aiohttp.ClientResponse) -> float | None:
+	"""Retry-After in seconds, if it's given in seconds"""
+	try:
+		return float(response.headers['Retry-After'])
+	except (KeyError, ValueError):
+		return None
+
+
+class ReferenceFetcher:
+
+	def __init__(
+		self,
+		cache_dir: str | None = None,
+		concurrency: int = CONCURRENCY,
+		per_host: int = PER_HOST,
+		retries: int = RETRIES,
+		backoff: float = BACKOFF,
+		max_backoff: float = MAX_BACKOFF,
+		timeout: aiohttp.ClientTimeout = TIMEOUT,
+		max_age: float | None = None,
+	):
+		self.cache = ReferenceCache(cache_dir) if cache_dir else None
+		self.concurrency = concurrency
+		self.per_host = per_host
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+		self.max_age = max_age
+
+		self.stats = FetchStats()
+		self.session = None
+
+	async def __aenter__(self) -> ReferenceFetcher:
+		# Sessions belong to an event loop, and every
+		# asyncio.run gets a new one: open one per use
+		connector = aiohttp.TCPConnector(
+			limit = self.concurrency,
+			limit_per_host = self.per_host,
+		)
+		self.session = aiohttp.ClientSession(
+			connector = connector,
+			timeout = self.timeout,
+		)
+		return self
+
+	async def __aexit__(self, *exc) -> None:
+		await self.session.close()
+		self.session = None
+
+	def delay(self, attempt: int) -> float:
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+	async def get(self, url: str, headers: dict) -> tuple[int, dict, bytes]:
+		"""(status, headers, body), retrying what's worth retrying"""
+		for attempt in range(self.retries + 1):
+			last_try = attempt == self.retries
+			wait = None
+			try:
+				async with self.session.get(url, headers = headers) as response:
+					if response.status not in RETRY_STATUSES:
+						body = await response.read()
+						return response.status, response.headers, body
+
+					reason = f'HTTP {response.status}'
+					wait = retry_after(response)
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				reason = repr(e)
+
+			if last_try:
+				raise FetchError(f'{url}: {reason} after {self.retries + 1} attempts')
+
+			if wait is None:
+				wait = self.delay(attempt)
+			else:
+				wait = min(wait, self.max_backoff)
+
+			log.debug(f'Retrying {url} in {wait:.1f}s: {reason}')
+			self.stats.retries += 1
+			await asyncio.sleep(wait)
+
+	async def fetch_bytes(self, url: str) -> bytes:
+		cached = self.cache.load(url) if self.cache else None
+
+		headers = {}
+		if cached:
+			header, body = cached
+			if self.max_age is not None and time.time() - header['stored'] < self.max_age:
+				self.stats.cached += 1
+				return body
+			if header['etag']:
+				headers['If-None-Match'] = header['etag']
+			if header['last_modified']:
+				headers['If-Modified-Since'] = header['last_modified']
+
+		status, response_headers, data = await self.get(url, headers)
+
+		if status == 304 and cached:
+			self.stats.revalidated += 1
+			return body
+
+		if status != 200:
+			raise FetchError(f'{url}: HTTP {status}')
+
+		self.stats.downloaded += 1
+		self.stats.bytes += len(data)
+
+		if self.cache:
+			self.cache.store(
+				url,
+				data,
+				response_headers.get('ETag'),
+				response_headers.get('Last-Modified'),
+			)
+		return data
+
+	async def fetch(self, url: str) -> dict:
+		"""The reference at url, parsed. Raises FetchError"""
+		if self.session is None:
+			raise RuntimeError('Use the fetcher as `async with fetcher:`')
+
+		try:
+			data = await self.fetch_bytes(url)
+			reference = json.loads(data)
+		except FetchError:
+			self.stats.fail(url)
+			raise
+		except ValueError as e:
+			self.stats.fail(url)
+			raise FetchError(f'{url}: invalid JSON: {e}') from e
+
+		log.debug(f'Opened remote provider reference: {url}')
+		return reference
+
+
+default_fetcher = None
+
+
+def get_fetcher() -> ReferenceFetcher:
+	global default_fetcher
+	if default_fetcher is None:
+		default_fetcher = ReferenceFetcher()
+	return default_fetcher
+
+
+def set_fetcher(fetcher: ReferenceFetcher | None) -> None:
+	"""The fetcher the flattener uses for remote references
+	(None for the default)"""
+	global default_fetcher
+	default_fetcher = fetcher
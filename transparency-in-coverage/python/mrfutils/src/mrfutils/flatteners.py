@@ -36,23 +36,42 @@ NOTES: There's more than one way to go about this.
 as they are and write them later. But this way if you have a custom code -- NPI
 mapping you can optionally delete NPI numbers contingent on which billing code
 you're looking at.
-* Possible room for optimization: basic_parse instead of parse. You'd probably
-need to write a +1/-1 tracker every time you hit a start_map/end_map event, so
-that you can track your depth in the JSON tree.
+* basic_parse instead of parse: this is the 'basic_parse' engine in
+mrfutils.engines. It tracks its depth in the JSON tree with a +1/-1 counter
+on every start_*/end_* event instead of relying on ijson's prefixes.
+* Skipping without parsing: the 'byte_skip' engine finds the end of a
+rejected in-network item by counting brackets in the raw bytes (see
+mrfutils.bytescan) instead of tokenizing it.
 
 Anything tagged #HOTFIX is a quick fix for a broken implementation of an MRF
 """
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import itertools
 from typing import Generator
 
-import aiohttp
 import ijson
 
 from mrfutils.helpers import *
+from mrfutils import engines, metrics, pipeline, toc
+from mrfutils.bytescan import ByteScanner
+from mrfutils.checkpoint import Checkpointer, checkpoint_options
+from mrfutils.codefilter import CodeFilter, compile_code_filter
+from mrfutils.dedup import DedupSink, RowDeduper
+from mrfutils.delta import DiffSink
+from mrfutils.exceptions import FetchError
+from mrfutils.fetcher import ReferenceFetcher, get_fetcher
+from mrfutils.gzindex import MRFIndex, get_index
+from mrfutils.manifest import Manifest, manifest_options
+from mrfutils.metrics import RunStats, StatsSink
+from mrfutils.npifilter import NPIFilter, convert_npis, filter_npis
+from mrfutils.refmap import CompactReferenceMap, seal
 from mrfutils.schema.schema import SCHEMA
+from mrfutils.sinks import CSVSink, make_sink
+from mrfutils.spill import SpillStore
+from mrfutils.tenants import TenantIndex
 
 # You can remove this if necessary, but be warned
 # Right now this only works with python 3.9/3.10
@@ -62,12 +81,20 @@ from mrfutils.schema.schema import SCHEMA
 # assert ijson.backend in ('yajl2_c', 'yajl2_cffi')
 
 log = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s - %(message)s')
-log.setLevel(logging.DEBUG)
 
 # To distinguish data from rows
 Row = dict
 
+ENGINES = ('parse', 'basic_parse', 'byte_skip')
+
+# Names, not classes, since mrfutils.engines imports this module
+ENGINE_CLASSES = {
+	'basic_parse': 'BasicParseEngine',
+	'byte_skip':   'ByteSkipEngine',
+}
+
+CONTAINER_EVENTS = ('start_map', 'start_array', 'end_map', 'end_array')
+
 # TODO handle npi_set and code_set in a custom data class
 
 def extract_filename_from_url(url: str) -> str:
@@ -108,7 +135,7 @@ def file_row_from_url(
 		filename = filename,
 	)
 
-	file_row = append_hash(file_row, 'id')
+	file_row = append_hash(file_row, 'id', 'file')
 	file_row['url'] = url
 
 	return file_row
@@ -127,7 +154,7 @@ def code_row_from_dict(in_network_item: dict) -> Row:
 	# ideally, because these fields aren't optional, we should do
 	# in_network_item[key]
 	code_row = {key : in_network_item.get(key) for key in keys}
-	code_row = append_hash(code_row, 'id')
+	code_row = append_hash(code_row, 'id', 'code')
 
 	return code_row
 
@@ -162,7 +189,7 @@ def rate_metadata_rate_tuple_from_dict(
 			else:
 				rate_metadata_row[key] = json.dumps(sorted_value)
 
-	rate_metadata_row = append_hash(rate_metadata_row, 'id')
+	rate_metadata_row = append_hash(rate_metadata_row, 'id', 'rate_metadata')
 	negotiated_rate = rate_item['negotiated_rate']
 
 	return rate_metadata_row, negotiated_rate
@@ -215,7 +242,7 @@ def rate_rows_from_mixed(
 			negotiated_rate = negotiated_rate
 		)
 
-		rate_row = append_hash(rate_row, 'id')
+		rate_row = append_hash(rate_row, 'id', 'rate')
 		rate_rows.append(rate_row)
 
 	return rate_rows
@@ -233,7 +260,7 @@ def tin_rows_and_npi_tin_rows_from_dict(
 			tin_type = group['tin']['type'],
 			tin_value = group['tin']['value']
 		)
-		tin_row = append_hash(tin_row, 'id')
+		tin_row = append_hash(tin_row, 'id', 'tin')
 		tin_rows.append(tin_row)
 
 		for npi in group['npi']:
@@ -249,40 +276,36 @@ def tin_rows_and_npi_tin_rows_from_dict(
 def write_in_network_item(
 	file_id: str,
 	in_network_item: dict,
-	out_dir
+	sink: CSVSink,
 ) -> None:
 
 	code_row = code_row_from_dict(in_network_item)
-	write_table(code_row, 'code', out_dir)
+	sink.write('code', code_row)
 
 	for rate in in_network_item['negotiated_rates']:
 
 		rate_metadata_combined_rows = rate_metadata_combined_rows_from_dict(rate)
 		rate_metadata_rows = [a[0] for a in rate_metadata_combined_rows]
-		write_table(rate_metadata_rows, 'rate_metadata', out_dir)
+		sink.write('rate_metadata', rate_metadata_rows)
 
 		rate_rows = rate_rows_from_mixed(
 			code_row = code_row,
 			rate_metadata_combined_rows = rate_metadata_combined_rows,
 		)
-		write_table(rate_rows, 'rate', out_dir)
+		sink.write('rate', rate_rows)
 
 		groups = rate['provider_groups']
 
 		tin_rows, npi_tin_rows = tin_rows_and_npi_tin_rows_from_dict(groups)
-		write_table(tin_rows, 'tin', out_dir)
-		write_table(npi_tin_rows, 'npi_tin', out_dir)
+		sink.write('tin', tin_rows)
+		sink.write('npi_tin', npi_tin_rows)
 
 		tin_rate_file_rows = tin_rate_file_rows_from_mixed(
 			rate_rows = rate_rows,
 			tin_rows = tin_rows,
 			file_id = file_id
 		)
-		write_table(tin_rate_file_rows, 'tin_rate_file', out_dir)
-
-	code_type = in_network_item['billing_code_type']
-	code = in_network_item['billing_code']
-	log.debug(f'Wrote {code_type} {code}')
+		sink.write('tin_rate_file', tin_rate_file_rows)
 
 
 def process_arr(func, arr, *args, **kwargs):
@@ -292,28 +315,24 @@ def process_arr(func, arr, *args, **kwargs):
 			processed_arr.append(processed_item)
 	return processed_arr
 
-# experimental mod
-from array import array
 def process_group(group: dict, npi_filter: set) -> dict | None:
 	try:
-		group['npi'] = [int(n) for n in group['npi']]
+		npis = group['npi']
 	except KeyError:
 		# I was alerted that sometimes this key is capitalized
 		# HOTFIX
-		group['npi'] = [int(n) for n in group['NPI']]
-
-	group['npi'] = array('L', group['npi'])
+		npis = group['NPI']
 
+	# Long lists are converted and filtered with numpy, see npifilter.py
 	if not npi_filter:
+		group['npi'] = convert_npis(npis)
 		return group
 
-	group['npi'] = [n for n in group['npi'] if n in npi_filter]
+	group['npi'] = filter_npis(npis, npi_filter)
 
 	if not group['npi']:
 		return
 
-	group['npi'] = array('L', group['npi'])
-
 	return group
 
 
@@ -399,8 +418,12 @@ def ffwd(
 
 def gen_in_network_items(
 	parser: Generator,
-	code_filter: set,
+	code_filter: set | CodeFilter | None,
 ) -> Generator:
+	code_filter = compile_code_filter(code_filter)
+	# The prefixes of the item fields the filter looks at
+	watched = {f'in_network.item.{key}': key for key in code_filter.keys}
+
 	builder = ijson.ObjectBuilder()
 	for prefix, event, value in parser:
 
@@ -411,9 +434,9 @@ def gen_in_network_items(
 
 		builder.event(event, value)
 
-		# This line can be commented out! but it's faster with it in
-		if hasattr(builder, 'value') and len(builder.value) > 0:
-			skip_item_by_code(parser, builder, code_filter)
+		if prefix in watched and event not in CONTAINER_EVENTS:
+			skip_item_by_code(parser, builder, code_filter, watched[prefix])
+			continue
 
 		if (prefix, event) == ('in_network.item', 'end_map'):
 			in_network_item = builder.value.pop()
@@ -439,46 +462,26 @@ def gen_references(parser: Generator) -> Generator:
 def skip_item_by_code(
 	parser: Generator,
 	builder: ijson.ObjectBuilder,
-	code_filter: set,
+	code_filter: CodeFilter,
+	key: str,
 ):
 	"""
 	This stops us from having to build in-network objects (which are large)
-	when their billing codes or arrangement don't fit the filter. It's kind of a
-	hack which is why I bundled these changes into one function.
+	when their billing codes or other fields don't fit the filter. Called
+	when the item being built gets `key`, one of the fields the filter
+	looks at.
 	"""
-	item = builder.value[-1]
-	code_type = item.get('billing_code_type')
-	code = item.get('billing_code')
-
-	if code and code_type and code_filter:
-		if (code_type, str(code)) not in code_filter:
-			log.debug(f'Skipping {code_type} {code}: filtered out')
-			ffwd(parser, to_prefix='in_network.item', to_event='end_map')
-			builder.value.pop()
-			builder.containers.pop()
-			return
-
-	arrangement = item.get('negotiation_arrangement')
-	if arrangement and arrangement != 'ffs':
-		log.debug(f"Skipping item: arrangement: {arrangement} not 'ffs'")
+	if code_filter.skips(builder.value[-1], key):
 		ffwd(parser, to_prefix='in_network.item', to_event='end_map')
 		builder.value.pop()
 		builder.containers.pop()
-		return
 
 
 async def fetch_remote_reference(
-	session: aiohttp.client.ClientSession,
+	fetcher: ReferenceFetcher,
 	url: str,
 ):
-	response = await session.get(url)
-	assert response.status == 200
-
-	log.debug(f'Opened remote provider reference: {url}')
-
-	data = await response.read()
-	reference = json.loads(data)
-	return reference
+	return await fetcher.fetch(url)
 
 
 # TODO I hate this function name
@@ -486,24 +489,33 @@ async def fetch_remote_reference(
 # smaller funcs
 async def append_processed_remote_reference(
 	queue: asyncio.Queue,
-	processed_references: list[dict],
+	reference_map: CompactReferenceMap,
 	npi_filter: set,
 ):
 	while True:
+		# Get a "work item" out of the queue.
+		fetcher, url, group_id = await queue.get()
 		try:
-			# Get a "work item" out of the queue.
-			session, url, group_id = await queue.get()
-
-			reference = await fetch_remote_reference(session, url)
+			reference = await fetch_remote_reference(fetcher, url)
+			metrics.count('references_fetched')
 			reference['provider_group_id'] = group_id
 			reference = process_reference(reference, npi_filter)
 
 			if reference:
-				processed_references.append(reference)
-
-		except AssertionError:
-			# Response status was 404 or something
-			log.debug('Encountered bad response status')
+				reference_map.add(group_id, reference['provider_groups'])
+
+		except FetchError as e:
+			# Retries are used up, or it's a 404 or something.
+			# The rates that use this reference will be missing
+			# its groups
+			log.warning(f'Could not fetch provider reference {group_id}: {e}')
+			metrics.count('references_failed')
+		except Exception as e:
+			# A reference that isn't shaped like one. Don't let it
+			# end the worker, or queue.join() waits forever
+			log.warning(f'Could not process provider reference {group_id} from {url}: {e!r}')
+			fetcher.stats.fail(url)
+			metrics.count('references_failed')
 		finally:
 			# Notify the queue that the "work item" has been processed.
 			queue.task_done()
@@ -522,37 +534,50 @@ async def make_reference_map(
 	}
 	where each provider group has been filtered to only contain
 	the NPIs contained in `npi_filter`.
+
+	The map is a CompactReferenceMap (see refmap.py): references
+	go into it as they're processed, so the parsed groups don't
+	pile up in memory.
+
+	Remote references are fetched with get_fetcher() (see
+	fetcher.py).
 	"""
 	# Create a queue that we will use to store our "workload".
 	queue: asyncio.Queue = asyncio.Queue()
 
-	# Tasks hold the consumers. reference is appended to
-	# by consumers and by the main loop of this function
+	fetcher = get_fetcher()
+	failed = fetcher.stats.failed
+
+	# Tasks hold the consumers. reference_map is added to
+	# by consumers and by the main loop of this function.
+	# The fetcher limits how many requests are in flight
 	tasks = []
-	processed_references: list[dict] = []
+	reference_map = CompactReferenceMap()
 
-	for i in range(200):
-		coro = append_processed_remote_reference(queue, processed_references, npi_filter)
+	for i in range(fetcher.concurrency):
+		coro = append_processed_remote_reference(queue, reference_map, npi_filter)
 		task = asyncio.create_task(coro)
 		tasks.append(task)
 
-	async with aiohttp.client.ClientSession() as session:
+	async with fetcher:
 		for reference in references:
 			if url := reference.get('location'):
 				group_id = reference['provider_group_id']
-				queue.put_nowait((session, url, group_id))
+				queue.put_nowait((fetcher, url, group_id))
 				continue
 
+			metrics.count('references')
 			reference = process_reference(reference, npi_filter)
 			if reference:
-				processed_references.append(reference)
+				reference_map.add(reference['provider_group_id'], reference['provider_groups'])
+			metrics.tick()
 
 		# Block until all items in the queue have been received and processed
 		await queue.join()
 
-	# To understand why this sleep is here, see:
-	# https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
-	await asyncio.sleep(.250)
+		# To understand why this sleep is here, see:
+		# https://docs.aiohttp.org/en/stable/client_advanced.html#graceful-shutdown
+		await asyncio.sleep(.250)
 
 	# Cancel our worker tasks
 	for task in tasks:
@@ -561,10 +586,12 @@ async def make_reference_map(
 	# Wait until all worker tasks are cancelled.
 	await asyncio.gather(*tasks, return_exceptions=True)
 
-	reference_map = {
-		reference['provider_group_id']: reference['provider_groups']
-		for reference in processed_references
-	}
+	if failed := fetcher.stats.failed - failed:
+		log.warning(f'{failed} remote provider references could not be fetched')
+	log.debug(f'Remote provider references: {fetcher.stats}')
+
+	reference_map = seal(reference_map)
+	metrics.set_value('ref_map_size', len(reference_map))
 	return reference_map
 
 
@@ -605,12 +632,20 @@ async def _get_reference_map(parser, npi_filter) -> dict:
 
 def get_reference_map(parser, npi_filter):
 	"""Wrapper to turn _get_reference_map into a sync function"""
-	return asyncio.run(_get_reference_map(parser, npi_filter))
+	with metrics.stage('references'):
+		return asyncio.run(_get_reference_map(parser, npi_filter))
+
+
+def get_reference_map_from_references(references: Generator, npi_filter):
+	"""Same as get_reference_map, for when you've already
+	got the references (e.g. from the basic_parse engine)"""
+	with metrics.stage('references'):
+		return asyncio.run(make_reference_map(references, npi_filter))
 
 
 def swap_references(
 	in_network_items: Generator,
-	reference_map: dict,
+	reference_map: CompactReferenceMap | dict | None,
 ) -> Generator:
 	"""Takes the provider reference ID in the rate
 	and replaces it with the corresponding provider
@@ -641,7 +676,22 @@ def swap_references(
 
 def start_parser(filename) -> Generator:
 	with JSONOpen(filename) as f:
-		yield from ijson.parse(f, use_float = True)
+		yield from metrics.count_events(ijson.parse(f, use_float = True))
+
+
+def gen_section_events(f, key: str, use_float: bool = True) -> Generator:
+	"""Parses the value that f starts at (the value of the top-level
+	`key`) with the prefixes it would have in the whole file"""
+	for prefix, event, value in metrics.count_events(ijson.parse(f, use_float = use_float)):
+		yield (f'{key}.{prefix}' if prefix else key), event, value
+
+		if prefix == '' and event not in ('start_map', 'start_array'):
+			return
+
+
+def read_section(index: MRFIndex, key: str, use_float: bool = True):
+	with index.open_section(key) as f:
+		return next(ijson.items(f, '', use_float = use_float))
 
 
 def in_network_file_to_csv(
@@ -650,6 +700,19 @@ def in_network_file_to_csv(
 	file:        str | None = None,
 	code_filter: set | None = None,
 	npi_filter:  set | None = None,
+	tenants:     dict | None = None,
+	tenant_code_filters: dict | None = None,
+	dedup:       bool | RowDeduper = False,
+	engine:      str = 'parse',
+	spill:       bool = False,
+	gz_index:    bool = False,
+	workers:     int = 0,
+	out_format:  str = 'csv',
+	checkpoint:  bool | float = False,
+	resume:      bool = False,
+	stats:       RunStats | None = None,
+	manifest:    Manifest | None = None,
+	delta:       bool | str = False,
 ) -> None:
 	"""
 	Writes MRF content to a flat file CSV in a specific schema.
@@ -658,27 +721,224 @@ def in_network_file_to_csv(
 
 	As of 1/2/2023 the filename is extracted from the URL, so this
 	isn't an optional parameter.
+
+	`code_filter` is a set of (billing code type, billing code) tuples.
+	Codes can be ranges or prefixes, and rules can be on other fields of
+	the item (see mrfutils.codefilter).
+
+	Multi-filter mode: pass `tenants`, a map of tenant name to NPI set
+	(and optionally `tenant_code_filters`, a map of tenant name to code
+	set) to parse the file once and write each tenant's rows to
+	`out_dir/<tenant name>`. `npi_filter` is ignored in this mode and
+	`code_filter` applies to tenants without their own code set.
+
+	Pass `dedup = True` to skip rows that were already written during this
+	run (see mrfutils.dedup), or pass a RowDeduper to size the filters
+	yourself.
+
+	`engine` picks the JSON parsing engine: 'parse' (the default),
+	'basic_parse' or 'byte_skip' (see mrfutils.engines). They all write
+	the same rows.
+
+	Pass `spill = True` to read the file only once when provider_references
+	come after in_network or are missing: the in-network items are kept on
+	disk until the references are read (see mrfutils.spill), instead of
+	parsing (and downloading) the file a second time.
+
+	Pass `gz_index = True` to build a random access index next to a local
+	.json.gz the first time it's read, and to seek straight to the
+	sections we need on every run after that (see mrfutils.gzindex).
+
+	Pass `workers = N` to swap references, filter NPIs and build rows in
+	a pool of N processes while this one parses (see mrfutils.pipeline).
+
+	`out_format` is 'csv' (the default) or one of the others in
+	mrfutils.sinks.SINKS, e.g. 'parquet', or 'parquet-decimal' for
+	negotiated_rate as decimal128(9, 2) instead of float64.
+
+	Pass `checkpoint = True` (or a number of seconds between checkpoints)
+	to save checkpoints in out_dir while the file is written, and
+	`resume = True` to pick up from the last one after a crash (see
+	mrfutils.checkpoint).
+
+	Pass a RunStats as `stats` to count what the run reads, skips and
+	writes, time each stage, and report progress (see mrfutils.metrics).
+
+	Pass a Manifest as `manifest` to skip the file if the same content
+	was already flattened with the same filters, under this URL or
+	another (see mrfutils.manifest).
+
+	Pass `delta = True` to save the ids of the rate, tin_rate_file and
+	npi_tin rows in out_dir, and `delta = <an earlier out_dir>` to do that
+	and only write the rows that aren't in that run's ids, plus a list of
+	the ones that were removed (see mrfutils.delta).
 	"""
+	if engine not in ENGINES:
+		raise ValueError(f'Engine must be one of {ENGINES}: {engine=}')
+
+	tenant_index = None
+	if tenants:
+		tenant_index = TenantIndex(tenants, tenant_code_filters, code_filter)
+		npi_filter = tenant_index.npi_filter
+		code_filter = tenant_index.code_filter
+
 	if npi_filter:
 		log.debug('Converting npi_filter to ints from strings')
-		npi_filter = set(int(n) for n in list(npi_filter))
+		npi_filter = NPIFilter(int(n) for n in list(npi_filter))
 
 	assert url is not None
 	assert validate_url(url)
-	make_dir(out_dir)
 
 	if file is None: file = url
 
+	# Before anything reads the file
+	source = None
+	if manifest is not None:
+		manifest_key = manifest_options(code_filter, npi_filter, tenants, tenant_code_filters, out_format)
+		source, skip = manifest.check(url, file, manifest_key)
+		if skip:
+			with metrics.activate(stats):
+				metrics.count('manifest_skipped')
+			return
+
+	make_dir(out_dir)
+
+	if dedup is True:
+		dedup = RowDeduper()
+
+	index = get_index(file) if gz_index else None
+
+	checkpointer = None
+
+	with contextlib.ExitStack() as stack:
+		# Entered first so it finishes after the sinks are closed
+		stack.enter_context(metrics.activate(stats))
+
+		if tenant_index is None:
+			sinks = {None: make_sink(out_format, out_dir)}
+		else:
+			sinks = {}
+			for name in tenant_index.names:
+				make_dir(f'{out_dir}/{name}')
+				sinks[name] = make_sink(out_format, f'{out_dir}/{name}')
+
+		for namespace, name in enumerate(sinks):
+			if stats is not None:
+				sinks[name] = StatsSink(sinks[name], stats)
+			if delta:
+				sink_dir = out_dir if name is None else f'{out_dir}/{name}'
+				previous = None
+				if delta is not True:
+					previous = delta if name is None else f'{delta}/{name}'
+				sinks[name] = DiffSink(sinks[name], sink_dir, previous)
+			if dedup:
+				sinks[name] = DedupSink(sinks[name], dedup, namespace)
+			stack.enter_context(sinks[name])
+
+		file_row = file_row_from_url(url)
+		file_row['url'] = url
+		file_id = file_row['id']
+
+		# Set when resuming, so we don't read the references again
+		ref_map = None
+
+		# checkpoint = 0 means after every item
+		if checkpoint is not False or resume:
+			options = checkpoint_options(
+				url,
+				code_filter,
+				npi_filter,
+				tenants,
+				tenant_code_filters,
+				out_format,
+				delta,
+			)
+			# checkpoint = True means the default interval
+			interval = None if isinstance(checkpoint, bool) else checkpoint
+			checkpointer = Checkpointer(out_dir, file_id, sinks, options, interval)
+			if resume and checkpointer.resume():
+				ref_map = checkpointer.ref_map
+
+		if workers:
+			writer = pipeline.PoolWriter(file_id, sinks, npi_filter, tenant_index, workers, checkpointer = checkpointer)
+		else:
+			writer = pipeline.SerialWriter(file_id, sinks, npi_filter, tenant_index, checkpointer)
+
+		# Whatever isn't in another stage is reading the file
+		with metrics.stage('parse'):
+			if engine in ENGINE_CLASSES:
+				engine_class = getattr(engines, ENGINE_CLASSES[engine])
+				parser = engine_class(file, code_filter, npi_filter, spill, index, swap = False, ref_map = ref_map)
+				# The reference map is ready once the first item is
+				_, items = peek(parser.in_network_items())
+				writer.write(items, parser.ref_map)
+				metadata = parser.metadata
+			elif index is not None:
+				metadata = _indexed_in_network_file_to_csv(
+					index = index,
+					writer = writer,
+					code_filter = code_filter,
+					npi_filter = npi_filter,
+					ref_map = ref_map,
+				)
+			else:
+				metadata = _in_network_file_to_csv(
+					file = file,
+					writer = writer,
+					code_filter = code_filter,
+					npi_filter = npi_filter,
+					spill = spill,
+					ref_map = ref_map,
+				)
+
+		file_row.update(metadata)
+		for sink in sinks.values():
+			sink.write('file', file_row)
+
+	# Only once the sinks are closed: if we crash before this, resuming
+	# cuts the outputs back to the last checkpoint and writes the rest
+	if checkpointer is not None:
+		checkpointer.finish()
+
+	if source is not None:
+		manifest.record(source, manifest_key, file_id, out_dir)
+
+
+def write_in_network_items(
+	file_id: str,
+	in_network_items: Generator,
+	sinks: dict,
+	npi_filter: set | None,
+	tenant_index: TenantIndex | None,
+) -> None:
+	"""Takes in-network items with their references swapped in,
+	filters them by NPI and writes them to the right sink(s)"""
+	for item in process_in_network(in_network_items, npi_filter):
+		metrics.count('items_kept')
+		if tenant_index is None:
+			write_in_network_item(file_id, item, sinks[None])
+			continue
+
+		for name, tenant_item in tenant_index.route(item):
+			write_in_network_item(file_id, tenant_item, sinks[name])
+
+
+def _in_network_file_to_csv(
+	file: str,
+	writer: pipeline.SerialWriter,
+	code_filter: set | None,
+	npi_filter: set | None,
+	spill: bool = False,
+	ref_map: dict | None = None,
+) -> dict:
+	"""The 'parse' engine. Returns the file metadata. If there's a
+	ref_map, the references in the file are skipped"""
 	completed = False
-	ref_map = None
+	spilled = None
 
 	metadata = ijson.ObjectBuilder()
 	parser = start_parser(file)
 
-	file_row = file_row_from_url(url)
-	file_row['url'] = url
-	file_id = file_row['id']
-
 	while True:
 		# This loop runs as long as there's a parser.
 		# We don't use
@@ -695,13 +955,20 @@ def in_network_file_to_csv(
 		except StopIteration:
 			if completed: break
 			if ref_map is None: ref_map = {}
+			if spilled is not None:
+				with spilled:
+					writer.write(spilled.replay(), ref_map)
+				break
 			parser = start_parser(file)
 			ffwd(parser, to_prefix='', to_value='in_network')
 			prefix, event, value = ('', 'map_key', 'in_network')
 			prepend(('', 'map_key', 'in_network'), parser)
 
 		if value == 'provider_references':
-			ref_map = get_reference_map(parser, npi_filter)
+			if ref_map is None:
+				ref_map = get_reference_map(parser, npi_filter)
+			else:
+				ffwd(parser, to_prefix = 'provider_references', to_event = 'end_array')
 
 		# There are four things that need to come before in_network
 		# 1. reporting_entity_name
@@ -709,87 +976,82 @@ def in_network_file_to_csv(
 		# 3. provider_references
 		# 4. last_updated_on
 		elif value == 'in_network':
+			if ref_map is None and spill and spilled is None:
+				# Hold on to the items until we've got the references
+				spilled = SpillStore()
+				spilled.extend(gen_in_network_items(parser, code_filter))
+				continue
+
 			if ref_map is None:
 				ffwd(parser, to_prefix = 'in_network', to_event = 'end_array')
 				continue
 
 			filtered_items = gen_in_network_items(parser, code_filter)
-			swapped_items = swap_references(filtered_items, ref_map)
-
-			for item in process_in_network(swapped_items, npi_filter):
-				write_in_network_item(file_id, item, out_dir)
+			writer.write(filtered_items, ref_map)
 
 			completed = True
 
 		elif not completed:
 			metadata.event(event, value)
 
-	file_row.update(metadata.value)
-	write_table(file_row, 'file', out_dir)
-
-### TOOLS FOR PROCESSING INDEX FILES
-
-def gen_plan_file(parser):
-	plan_file = ijson.ObjectBuilder()
-	for prefix, event, value in parser:
-		plan_file.event(event, value)
-
-		if (prefix, event) == ('reporting_structure.item', 'end_map'):
-			yield plan_file.value
-			plan_file = ijson.ObjectBuilder()
-
-		elif (prefix, event, value) == ('reporting_structure', 'end_array', None):
-			return
-
-def write_plan_file(plan_file, toc_id, out_dir):
-
-	if not plan_file.get('in_network_files'):
-		return
-
-	toc_plan_file_link = dicthasher(plan_file)
-	plan_rows = []
-	file_rows = []
-
-	for plan in plan_file['reporting_plans']:
-
-		plan_row = append_hash(plan, 'id')
-		plan_row['toc_id'] = toc_id
-
-		write_table(plan_row, 'toc_plan', out_dir)
-		plan_rows.append(plan_row)
+	return metadata.value
+
+
+def _indexed_in_network_file_to_csv(
+	index: MRFIndex,
+	writer: pipeline.SerialWriter,
+	code_filter: set | None,
+	npi_filter: set | None,
+	ref_map: dict | None = None,
+) -> dict:
+	"""The 'parse' engine with a gzip index: seeks to each
+	section instead of reading the file in order"""
+	metadata = {
+		key: read_section(index, key)
+		for key in index.metadata_keys('in_network')
+	}
 
-	for file in plan_file['in_network_files']:
+	if ref_map is None:
+		ref_map = {}
+		if 'provider_references' in index.sections:
+			with index.open_section('provider_references') as f:
+				parser = gen_section_events(f, 'provider_references')
+				ref_map = get_reference_map(parser, npi_filter)
 
-		url = file['location']
-		file_row = dict(
-			filename = extract_filename_from_url(url)
-		)
-		file_row = append_hash(file_row, 'id')
+	if 'in_network' in index.sections:
+		with index.open_section('in_network') as f:
+			parser = gen_section_events(f, 'in_network')
+			filtered_items = gen_in_network_items(parser, code_filter)
+			writer.write(filtered_items, ref_map)
 
-		file_row['toc_id'] = toc_id
-		file_row['url'] = url
-		file_row['description'] = file['description']
+	return metadata
 
-		write_table(file_row, 'toc_file', out_dir)
-		file_rows.append(file_row)
+### TOOLS FOR PROCESSING INDEX FILES
 
-	print(len(plan_rows))
-	print(len(file_rows))
+TOC_ENGINES = ('parse', 'byte_skip')
 
-	for plan_row in plan_rows:
-		for file_row in file_rows:
-			toc_plan_file_row = dict(
-				link = toc_plan_file_link,
-				toc_file_id = file_row['id'],
-				toc_plan_id = plan_row['id'],
-			)
-			write_table(toc_plan_file_row, 'toc_plan_file', out_dir)
 
 def toc_file_to_csv(
 	url: str,
 	out_dir: str,
 	file:        str | None = None,
+	gz_index:    bool = False,
+	out_format:  str = 'csv',
+	engine:      str = 'parse',
+	stats:       RunStats | None = None,
 ) -> None:
+	"""Pass `gz_index = True` to seek straight to reporting_structure
+	with a gzip index. `out_format` is 'csv', 'parquet', ... (see
+	in_network_file_to_csv).
+
+	Plans and in-network files are read one at a time, and written once
+	each no matter how many reporting structures list them (see
+	mrfutils.toc). `engine` is 'parse' (the default) or 'byte_skip',
+	which is faster. Pass a RunStats as `stats` to count and time the
+	run (see mrfutils.metrics)."""
+	if engine not in TOC_ENGINES:
+		raise ValueError(f'Engine must be one of {TOC_ENGINES}: {engine=}')
+
 	assert url is not None
 	assert validate_url(url)
 	make_dir(out_dir)
@@ -797,21 +1059,53 @@ def toc_file_to_csv(
 	if file is None:
 		file = url
 
-	with JSONOpen(file) as f:
+	index = get_index(file) if gz_index else None
+
+	with contextlib.ExitStack() as stack:
+		stack.enter_context(metrics.activate(stats))
+
+		sink = make_sink(out_format, out_dir)
+		if stats is not None:
+			sink = StatsSink(sink, stats)
+		stack.enter_context(sink)
 
-		parser = ijson.parse(f)
 		toc_row = dict(
 			filename = extract_filename_from_url(url)
 		)
-		toc_row = append_hash(toc_row, 'id')
+		toc_row = append_hash(toc_row, 'id', 'toc')
 		toc_row['url'] = url
-		toc_id = toc_row['id']
-		metadata = ijson.ObjectBuilder()
-		for prefix, event, value in parser:
-			if (prefix, event, value) == ('reporting_structure', 'start_array', None):
-				for plan_file in gen_plan_file(parser):
-					write_plan_file(plan_file, toc_id, out_dir)
+		writer = toc.TOCWriter(toc_row['id'], sink)
+
+		with metrics.stage('parse'):
+			if index is not None:
+				metadata = _indexed_toc_file_to_csv(index, writer, engine)
+			elif engine == 'byte_skip':
+				with JSONOpen(file) as f:
+					metadata = toc.write_toc_bytes(f, writer)
 			else:
-				metadata.event(event, value)
-	toc_row.update(metadata.value)
-	write_table(toc_row, 'toc', out_dir)
+				with JSONOpen(file) as f:
+					metadata = toc.write_toc_events(f, writer)
+
+		toc_row.update(metadata)
+		sink.write('toc', toc_row)
+
+
+def _indexed_toc_file_to_csv(
+	index: MRFIndex,
+	writer: toc.TOCWriter,
+	engine: str = 'parse',
+) -> dict:
+	"""Returns the top-level fields"""
+	if 'reporting_structure' in index.sections:
+		with index.open_section('reporting_structure') as f:
+			if engine == 'byte_skip':
+				toc.write_structure_bytes(ByteScanner(f), writer)
+			else:
+				parser = gen_section_events(f, 'reporting_structure', use_float = False)
+				if next(parser) == ('reporting_structure', 'start_array', None):
+					toc.write_structure_events(parser, writer)
+
+	return {
+		key: read_section(index, key, use_float = False)
+		for key in index.metadata_keys('reporting_structure')
+	}
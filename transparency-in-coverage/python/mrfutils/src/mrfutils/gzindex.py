@@ -0,0 +1,228 @@
+"""
+Random access into local .json.gz MRFs
+######################################
+
+gzip can't be read from the middle: to get to the in_network array you
+have to decompress everything before it. A zran-style index saves the
+decompressor's state (its 32KB window) every `spacing` bytes, so that
+decompression can restart from the nearest saved point instead of from
+byte 0. The index is built once, by reading the file once, and saved next
+to the file. We use indexed_gzip for the zlib side of this:
+
+>>> pip install mrfutils[index]
+
+Along with the gzip index we save where each top-level key's value starts
+and ends (provider_references, in_network, reporting_structure...) and
+where every in_network item starts, all as offsets in the decompressed
+stream:
+
+	<file>.json.gz.idx        indexed_gzip seek points
+	<file>.json.gz.idx.json   top-level offsets and item offsets
+
+An index is only used if the file's size and modification time haven't
+changed since it was built.
+
+Usage:
+>>> index = MRFIndex.load_or_build('in-network.json.gz')
+>>> with index.open_section('in_network') as f:
+>>>     ...  # f is just the in_network array
+"""
+from __future__ import annotations
+
+import contextlib
+import json
+import logging
+import os
+from urllib.parse import urlparse
+
+from mrfutils import metrics
+from mrfutils.bytescan import ByteScanner
+from mrfutils.exceptions import InvalidMRF
+
+try:
+	import indexed_gzip
+except ImportError:
+	indexed_gzip = None
+
+log = logging.getLogger('mrfutils')
+
+INDEX_SUFFIX = '.idx'
+SECTIONS_SUFFIX = '.idx.json'
+
+# Bytes of decompressed data between seek points. Each
+# point costs 32KB in the index file
+SPACING = 4 * 2**20
+
+VERSION = 1
+
+
+class SectionReader:
+	"""Reads at most `size` bytes from f. A parser that's handed a
+	section of the file then sees a complete JSON document"""
+
+	def __init__(self, f, size: int):
+		self.f = f
+		self.left = size
+
+	def read(self, size: int = -1) -> bytes:
+		if size < 0 or size > self.left:
+			size = self.left
+		data = self.f.read(size)
+		self.left -= len(data)
+		metrics.count('decompressed_bytes', len(data))
+		return data
+
+
+def require_indexed_gzip() -> None:
+	if indexed_gzip is None:
+		raise ImportError(
+			'gzip indexes need indexed_gzip: pip install mrfutils[index]'
+		)
+
+
+def file_stamp(file: str) -> dict:
+	stat = os.stat(file)
+	return dict(size = stat.st_size, mtime_ns = stat.st_mtime_ns)
+
+
+def scan_offsets(f) -> tuple[dict, list[int]]:
+	"""Walks the document once. Returns the (start, end) offsets of
+	each top-level value and the offsets of the in_network items"""
+	scanner = ByteScanner(f)
+	sections = {}
+	items = []
+
+	if scanner.peek() != ord('{'):
+		raise InvalidMRF('MRF is not a JSON object')
+
+	for key in scanner.gen_keys():
+		key = json.loads(key)
+		start = scanner.tell
+
+		if key == 'in_network' and scanner.peek() == ord('['):
+			for _ in scanner.gen_array():
+				items.append(scanner.tell)
+				scanner.skip_value()
+		else:
+			scanner.skip_value()
+
+		sections[key] = (start, scanner.tell)
+
+	return sections, items
+
+
+class MRFIndex:
+
+	def __init__(
+		self,
+		file: str,
+		sections: dict,
+		items: list[int],
+		stamp: dict,
+		spacing: int = SPACING,
+	):
+		self.file = file
+		self.sections = sections
+		self.items = items
+		self.stamp = stamp
+		self.spacing = spacing
+
+	@property
+	def index_file(self) -> str:
+		return self.file + INDEX_SUFFIX
+
+	@property
+	def sections_file(self) -> str:
+		return self.file + SECTIONS_SUFFIX
+
+	@classmethod
+	def build(cls, file: str, spacing: int = SPACING) -> MRFIndex:
+		"""Reads the whole file once and saves the index next to it"""
+		require_indexed_gzip()
+		if not file.endswith('.json.gz'):
+			raise ValueError(f'Can only index local .json.gz files: {file=}')
+
+		log.info(f'Building gzip index for {file}')
+		stamp = file_stamp(file)
+
+		with indexed_gzip.IndexedGzipFile(file, spacing = spacing) as f:
+			sections, items = scan_offsets(f)
+			f.build_full_index()
+			f.export_index(file + INDEX_SUFFIX)
+
+		index = cls(file, sections, items, stamp, spacing)
+		with open(index.sections_file, 'w') as f:
+			json.dump(dict(
+				version = VERSION,
+				stamp = stamp,
+				spacing = spacing,
+				sections = sections,
+				items = items,
+			), f)
+
+		log.info(f'Indexed {len(sections)} sections and {len(items)} in_network items')
+		return index
+
+	@classmethod
+	def load(cls, file: str) -> MRFIndex | None:
+		"""The saved index, or None if there isn't an
+		up-to-date one"""
+		index_file = file + INDEX_SUFFIX
+		sections_file = file + SECTIONS_SUFFIX
+		if not (os.path.exists(index_file) and os.path.exists(sections_file)):
+			return None
+
+		with open(sections_file) as f:
+			saved = json.load(f)
+
+		if saved.get('version') != VERSION or saved['stamp'] != file_stamp(file):
+			log.info(f'Index for {file} is out of date')
+			return None
+
+		return cls(file, saved['sections'], saved['items'], saved['stamp'], saved['spacing'])
+
+	@classmethod
+	def load_or_build(cls, file: str, spacing: int = SPACING) -> MRFIndex:
+		return cls.load(file) or cls.build(file, spacing)
+
+	@contextlib.contextmanager
+	def open(self, offset: int = 0):
+		"""The decompressed file, starting at `offset`"""
+		require_indexed_gzip()
+		with indexed_gzip.IndexedGzipFile(
+			self.file,
+			index_file = self.index_file,
+			spacing = self.spacing,
+		) as f:
+			f.seek(offset)
+			yield f
+
+	@contextlib.contextmanager
+	def open_section(self, key: str):
+		"""Just the value of the top-level key"""
+		start, end = self.sections[key]
+		with self.open(start) as f:
+			yield SectionReader(f, end - start)
+
+	def metadata_keys(self, section: str) -> list[str]:
+		"""The top-level keys a full pass would put in the metadata:
+		everything but the big sections, and if the references come
+		before `section`, only the keys before `section`"""
+		keys = list(self.sections)
+		if section in keys and 'provider_references' in keys[:keys.index(section)]:
+			keys = keys[:keys.index(section)]
+
+		return [
+			key for key in keys
+			if key not in ('provider_references', section)
+		]
+
+
+def get_index(file: str) -> MRFIndex | None:
+	"""Loads or builds the index for a local .json.gz.
+	Returns None for anything else"""
+	if urlparse(file).scheme in ('http', 'https') or not file.endswith('.json.gz'):
+		log.info('Only local .json.gz files can be indexed. Reading from the start')
+		return None
+
+	return MRFIndex.load_or_build(file)
@@ -0,0 +1,188 @@
+"""
+Row ids
+#######
+
+Every row id is a hash of the row. The original recipe (`dicthasher` in
+helpers) is
+
+>>> int.from_bytes(sha256(json.dumps(row, sort_keys=True))[:8], 'little')
+
+which is slow mostly because of json.dumps: it builds a new encoder and
+sorts the keys for every row. Rows from the same table almost always have
+the same keys, so RowHasher works out the key order (and the JSON text
+around each value) once per key layout and only encodes the values.
+
+There are two modes:
+
+* 'compat' produces the exact same ids as dicthasher, so they match the
+  ids already in our Dolt tables. This is the default.
+* 'fast' encodes the values in SCHEMA column order with ascii() instead
+  of JSON and hashes with xxh3 (if `xxhash` is installed) or blake2b. The
+  ids are NOT the same as the compat ids, so don't mix the two modes in
+  one database.
+
+Usage:
+>>> with hash_mode('fast'):
+>>>     in_network_file_to_csv(...)
+
+or call set_hash_mode('fast') once at the start of your script.
+"""
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import math
+from operator import itemgetter
+
+from mrfutils.schema.schema import SCHEMA
+
+try:
+	from json.encoder import c_encode_basestring_ascii as encode_str
+except ImportError:
+	from json.encoder import encode_basestring_ascii as encode_str
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+HASH_MODES = ('compat', 'fast')
+
+
+def json_value(value) -> str:
+	"""Encodes a value exactly like json.dumps(sort_keys=True)
+	would inside an object"""
+	type_ = type(value)
+
+	if type_ is str:
+		return encode_str(value)
+
+	if value is None:
+		return 'null'
+
+	if type_ is int:
+		return int.__repr__(value)
+
+	if type_ is float:
+		if math.isfinite(value):
+			return float.__repr__(value)
+		if value != value:
+			return 'NaN'
+		return 'Infinity' if value > 0 else '-Infinity'
+
+	if type_ is bool:
+		return 'true' if value else 'false'
+
+	# Lists, nested objects, int/float subclasses, etc.
+	return json.dumps(value, sort_keys=True)
+
+
+class RowHasher:
+
+	def __init__(self, mode: str = 'compat', n_bytes: int = 8):
+		if mode not in HASH_MODES:
+			raise ValueError(f'Hash mode must be one of {HASH_MODES}: {mode=}')
+
+		if mode == 'fast' and n_bytes != 8:
+			raise ValueError('Fast mode only makes 8 byte ids')
+
+		self.mode = mode
+		self.n_bytes = n_bytes
+
+		# (table_name, keys) -> (function that gets the values in
+		# order, text the values get formatted into)
+		self.layouts: dict[tuple, tuple] = {}
+
+		if mode == 'compat':
+			self.encode = self.encode_compat
+			self.digest = self.digest_compat
+		else:
+			self.encode = self.encode_fast
+			self.digest = self.digest_fast
+
+	def layout(self, row: dict, table_name: str | None) -> tuple:
+		keys = tuple(row)
+		layout = self.layouts.get((table_name, keys))
+		if layout is not None:
+			return layout
+
+		if self.mode == 'compat':
+			ordered = sorted(keys)
+			template = ', '.join(f'{encode_str(key)}: %s' for key in ordered)
+			template = '{' + template + '}'
+		else:
+			columns = SCHEMA.get(table_name, [])
+			ordered = [key for key in columns if key in row]
+			ordered += sorted(key for key in keys if key not in columns)
+			# The key names go in front so that the same values under
+			# different columns don't collide
+			template = ascii(tuple(ordered))
+
+		if len(ordered) == 1:
+			key = ordered[0]
+			getter = lambda row: (row[key],)
+		else:
+			getter = itemgetter(*ordered)
+
+		layout = (getter, template)
+		self.layouts[(table_name, keys)] = layout
+		return layout
+
+	def encode_compat(self, row: dict, table_name: str | None) -> bytes:
+		getter, template = self.layout(row, table_name)
+		text = template % tuple(map(json_value, getter(row)))
+		# json.dumps escapes everything outside ASCII
+		return text.encode('ascii')
+
+	def encode_fast(self, row: dict, table_name: str | None) -> bytes:
+		getter, template = self.layout(row, table_name)
+		# ascii() of a tuple of str/int/float/None is unambiguous,
+		# runs in C and is the same on every Python version
+		return (template + ascii(getter(row))).encode('ascii')
+
+	def digest_compat(self, data: bytes) -> int:
+		hash_s = hashlib.sha256(data).digest()[:self.n_bytes]
+		return int.from_bytes(hash_s, 'little')
+
+	if xxhash is not None:
+		def digest_fast(self, data: bytes) -> int:
+			return xxhash.xxh3_64_intdigest(data)
+	else:
+		def digest_fast(self, data: bytes) -> int:
+			hash_s = hashlib.blake2b(data, digest_size = 8).digest()
+			return int.from_bytes(hash_s, 'little')
+
+	def __call__(self, row: dict, table_name: str | None = None) -> int:
+		if not row:
+			raise Exception("Hashed dictionary can't be empty")
+
+		return self.digest(self.encode(row, table_name))
+
+
+hasher = RowHasher()
+
+
+def hash_row(row: dict, table_name: str | None = None) -> int:
+	return hasher(row, table_name)
+
+
+def set_hash_mode(mode: str) -> None:
+	global hasher
+	hasher = RowHasher(mode)
+
+
+def get_hash_mode() -> str:
+	return hasher.mode
+
+
+@contextlib.contextmanager
+def hash_mode(mode: str):
+	"""Temporarily switch the hash mode"""
+	global hasher
+	old_hasher = hasher
+	hasher = RowHasher(mode)
+	try:
+		yield hasher
+	finally:
+		hasher = old_hasher
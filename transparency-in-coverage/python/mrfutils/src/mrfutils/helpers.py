@@ -1,5 +1,6 @@
+from __future__ import annotations
+
 import csv
-import gzip
 import hashlib
 import json
 import logging
@@ -8,9 +9,11 @@ from itertools import chain
 from pathlib import Path
 from urllib.parse import urlparse
 
-import requests
-
+from mrfutils import metrics
 from mrfutils.exceptions import InvalidMRF
+from mrfutils.hashers import hash_row
+from mrfutils.inflate import open_mrf_gzip
+from mrfutils.remote import GZIP_ENCODINGS, RemoteReader, cache_path, cached_copy
 
 log = logging.getLogger('mrfutils')
 log.setLevel(logging.INFO)
@@ -43,13 +46,28 @@ class JSONOpen:
 	or
 	>>> with JSONOpen(some_json_url) as f:
 	including both zipped and unzipped files.
+
+	.json.gz files are inflated with the fastest backend that's installed,
+	on a background thread (see mrfutils.inflate). Pass `backend` and/or
+	`threaded` to override that.
+
+	URLs are read with a RemoteReader, which picks up where it left off
+	when the connection drops, and can keep a copy of the file on disk
+	for next time (see mrfutils.remote).
+
+	While a RunStats is active (see mrfutils.metrics), the bytes read
+	are counted.
 	"""
 
-	def __init__(self, filename):
+	def __init__(self, filename, backend: str | None = None, threaded: bool | None = None):
 		self.filename = filename
+		self.backend = backend
+		self.threaded = threaded
 		self.f = None
 		self.r = None
 		self.is_remote = None
+		# Of the file as it is on disk or on the wire
+		self.size = None
 
 		parsed_url = urlparse(self.filename)
 		self.suffix = ''.join(Path(parsed_url.path).suffixes)
@@ -65,41 +83,89 @@ class JSONOpen:
 		self.is_remote = parsed_url.scheme in ('http', 'https')
 
 	def __enter__(self):
+		filename = self.filename
+		if self.is_remote:
+			cached = cached_copy(self.filename, self.suffix)
+			if cached is not None:
+				log.info(f'Reading {self.filename} from {cached}')
+				filename = cached
+
 		if (
 			self.is_remote
-			# endswith is used to protect against the case
-			# where the filename contains lots of dots
-			# insurer.stuff.json.gz
-			and self.suffix.endswith('.json.gz')
+			and filename == self.filename
 		):
-			self.s = requests.Session()
-			self.r = self.s.get(self.filename, stream=True)
-			self.f = gzip.GzipFile(fileobj=self.r.raw)
+			self.r = RemoteReader(
+				self.filename,
+				tee = cache_path(self.filename, self.suffix),
+			)
+			if (
+				# endswith is used to protect against the case
+				# where the filename contains lots of dots
+				# insurer.stuff.json.gz
+				self.suffix.endswith('.json.gz')
+				# A .json sent gzipped
+				or self.r.content_encoding in GZIP_ENCODINGS
+			):
+				self.f = open_mrf_gzip(
+					fileobj = self.r,
+					backend = self.backend,
+					threaded = self.threaded,
+				)
+			else:
+				self.f = self.r
 
 		elif (
-			self.is_remote
-			and self.suffix.endswith('.json')
+			self.suffix == '.json.gz'
+			or (self.is_remote and self.suffix.endswith('.json.gz'))
+			# The cached copy of a .json that was sent gzipped
+			or filename.endswith('.json.gz')
 		):
-			self.s = requests.Session()
-			self.r = self.s.get(self.filename, stream=True)
-			self.r.raw.decode_content = True
-			self.f = self.r.raw
+			self.f = open_mrf_gzip(
+				filename = filename,
+				backend = self.backend,
+				threaded = self.threaded,
+			)
 
-		elif self.suffix == '.json.gz':
-			self.f = gzip.open(self.filename, 'rb')
+		else:
+			self.f = open(filename, 'rb')
 
+		if self.r is not None:
+			self.size = self.r.size
 		else:
-			self.f = open(self.filename, 'rb')
+			self.size = os.path.getsize(filename)
 
 		log.info(f'Opened file: {self.filename}')
+		if metrics.active is not None:
+			return metrics.active.open_input(self, self.f)
 		return self.f
 
+	def position(self) -> int | None:
+		"""How many bytes of the file (before inflating) have been
+		read, or None if we can't tell"""
+		if self.r is not None:
+			return self.r.pos
+
+		# Under the ThreadedReader and the GzipFile
+		f = getattr(self.f, 'f', self.f)
+		f = getattr(f, 'fileobj', f)
+		try:
+			return f.tell()
+		except (AttributeError, OSError, ValueError):
+			return None
+
 	def __exit__(self, exc_type, exc_val, exc_tb):
-		if self.is_remote:
-			self.s.close()
-			self.r.close()
+		if metrics.active is not None:
+			metrics.active.close_input(self)
+
+		if self.f is not self.r:
+			self.f.close()
 
-		self.f.close()
+		if self.r is not None:
+			# Read to the end so the copy in the cache is complete,
+			# unless we're here because something went wrong
+			if exc_type is None:
+				self.r.drain()
+			self.r.close()
 
 
 def import_csv_to_set(filename: str):
@@ -136,9 +202,10 @@ def dicthasher(data: dict, n_bytes = 8) -> int:
 	return hash_i
 
 
-def append_hash(item: dict, name: str) -> dict:
-
-	hash_ = dicthasher(item)
+def append_hash(item: dict, name: str, table_name: str | None = None) -> dict:
+	"""Same as item[name] = dicthasher(item) in the default hash mode.
+	See mrfutils.hashers for the fast mode"""
+	hash_ = hash_row(item, table_name)
 	item[name] = hash_
 
 	return item
@@ -149,7 +216,7 @@ def filename_hasher(filename: str) -> int:
 	# retrieve/only/this_part_of_the_file.json(.gz)
 	filename = Path(filename).stem.split('.')[0]
 	file_row = {'filename': filename}
-	filename_hash = dicthasher(file_row)
+	filename_hash = hash_row(file_row, 'file')
 
 	return filename_hash
 
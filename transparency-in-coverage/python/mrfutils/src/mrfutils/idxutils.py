@@ -3,7 +3,6 @@ import logging
 from mrfutils.helpers import JSONOpen
 
 log = logging.getLogger('mrfutils')
-log.setLevel(logging.DEBUG)
 
 def gen_in_network_links(index_loc,):
     """
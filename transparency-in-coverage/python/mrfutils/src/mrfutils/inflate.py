@@ -0,0 +1,289 @@
+"""
+Decompressing .json.gz files
+############################
+
+Inflating is about a third of the time it takes to flatten a file, and by
+default it happens on the same thread as the parser, so the two add up.
+Two things help:
+
+1. A faster inflate. These backends all produce the same bytes:
+
+	'isal'     ISA-L's igzip (pip install isal)
+	'zlib_ng'  zlib-ng (pip install zlib-ng)
+	'pigz'     an external `pigz -dc` process (needs pigz on the PATH)
+	'zlib'     the standard library's gzip module
+
+   'auto' picks the first one in that order that's installed. A file
+   that's cut short or corrupt raises with every backend: EOFError, or an
+   OSError (gzip.BadGzipFile), never just a short stream.
+
+2. Inflating in the background. ThreadedReader runs the decompressor on its
+   own thread and hands the parser large chunks through a bounded queue.
+   zlib, ISA-L and zlib-ng all release the GIL while they inflate, so
+   decompression overlaps with parsing. With 'pigz' the inflating already
+   happens in another process.
+
+JSONOpen uses both by default. To change that for the whole run:
+
+>>> set_inflate_backend('zlib')
+>>> set_threaded(False)
+
+`python benchmarks/bench_inflate.py --file some.json.gz` prints MB/s for
+every backend that's installed.
+"""
+from __future__ import annotations
+
+import gzip
+import logging
+import queue
+import shutil
+import subprocess
+import threading
+
+try:
+	from isal import igzip
+except ImportError:
+	igzip = None
+
+try:
+	from zlib_ng import gzip_ng
+except ImportError:
+	gzip_ng = None
+
+log = logging.getLogger('mrfutils')
+
+BACKENDS = ('isal', 'zlib_ng', 'pigz', 'zlib')
+
+PIGZ_COMMAND = ('pigz', '-dc')
+
+# The reader thread hands over CHUNK_SIZE bytes at a time and
+# gets at most MAX_CHUNKS ahead of the parser
+CHUNK_SIZE = 4 * 2**20
+MAX_CHUNKS = 8
+
+COPY_SIZE = 2**20
+
+default_backend = 'auto'
+default_threaded = True
+
+
+def available_backends() -> list[str]:
+	available = []
+	if igzip is not None:
+		available.append('isal')
+	if gzip_ng is not None:
+		available.append('zlib_ng')
+	if shutil.which(PIGZ_COMMAND[0]):
+		available.append('pigz')
+	available.append('zlib')
+	return available
+
+
+def resolve_backend(backend: str | None = None) -> str:
+	backend = backend or default_backend
+
+	if backend == 'auto':
+		return available_backends()[0]
+
+	if backend not in BACKENDS:
+		raise ValueError(f"Backend must be 'auto' or one of {BACKENDS}: {backend=}")
+
+	if backend not in available_backends():
+		raise ImportError(f'Inflate backend {backend} is not installed')
+
+	return backend
+
+
+def set_inflate_backend(backend: str) -> None:
+	global default_backend
+	if backend != 'auto':
+		resolve_backend(backend)
+	default_backend = backend
+
+
+def set_threaded(threaded: bool) -> None:
+	global default_threaded
+	default_threaded = threaded
+
+
+class PipeReader:
+	"""Reads the stdout of `pigz -dc`. If we're given a file object
+	instead of a filename, a thread copies it to pigz's stdin. If pigz
+	fails, the read that gets to the end of its output raises"""
+
+	def __init__(self, filename: str | None = None, fileobj = None):
+		if filename is not None:
+			self.proc = subprocess.Popen(
+				[*PIGZ_COMMAND, filename],
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+			)
+			self.feeder = None
+		else:
+			self.proc = subprocess.Popen(
+				PIGZ_COMMAND,
+				stdin = subprocess.PIPE,
+				stdout = subprocess.PIPE,
+				stderr = subprocess.PIPE,
+			)
+			self.feeder = threading.Thread(
+				target = self.feed,
+				args = (fileobj,),
+				daemon = True,
+			)
+			self.feeder.start()
+
+	def feed(self, fileobj) -> None:
+		try:
+			while data := fileobj.read(COPY_SIZE):
+				self.proc.stdin.write(data)
+		except (BrokenPipeError, ValueError):
+			# pigz was closed before it read everything
+			pass
+		finally:
+			try:
+				self.proc.stdin.close()
+			except BrokenPipeError:
+				pass
+
+	def read(self, size: int = -1) -> bytes:
+		data = self.proc.stdout.read(size)
+		if size is None or size < 0 or (size and not data):
+			self.check()
+		return data
+
+	def check(self) -> None:
+		"""At the end of pigz's output: raises if it failed, like
+		the other backends do on a bad file"""
+		code = self.proc.wait()
+		if code != 0:
+			error = self.proc.stderr.read().decode(errors = 'replace').strip()
+			raise gzip.BadGzipFile(f'{PIGZ_COMMAND[0]} exited with code {code}: {error}')
+
+	def close(self) -> None:
+		if self.proc.poll() is None:
+			self.proc.kill()
+		self.proc.stdout.close()
+		self.proc.stderr.close()
+		self.proc.wait()
+		if self.feeder is not None:
+			self.feeder.join()
+
+
+def open_gzip(filename: str | None = None, fileobj = None, backend: str | None = None):
+	"""A file object with the decompressed contents of a gzip file
+	(by name) or of a file object of gzipped bytes"""
+	backend = resolve_backend(backend)
+
+	if backend == 'pigz':
+		return PipeReader(filename, fileobj)
+
+	module = {
+		'isal': igzip,
+		'zlib_ng': gzip_ng,
+		'zlib': gzip,
+	}[backend]
+
+	if filename is not None:
+		return module.open(filename, 'rb')
+	return module.GzipFile(fileobj = fileobj, mode = 'rb')
+
+
+class ThreadedReader:
+	"""
+	Reads f on a background thread. The thread reads `chunk_size`
+	bytes at a time into a queue of at most `max_chunks` chunks;
+	read() takes them off the queue. Errors on the thread are raised
+	by read().
+	"""
+
+	def __init__(self, f, chunk_size: int = CHUNK_SIZE, max_chunks: int = MAX_CHUNKS):
+		self.f = f
+		self.chunk_size = chunk_size
+		self.chunks = queue.Queue(max_chunks)
+		self.buf = b''
+		self.pos = 0
+		self.done = False
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target = self.fill, daemon = True)
+		self.thread.start()
+
+	def fill(self) -> None:
+		try:
+			while not self.stopped.is_set():
+				chunk = self.f.read(self.chunk_size)
+				self.put(chunk)
+				if not chunk:
+					return
+		except Exception as e:
+			self.put(e)
+
+	def put(self, item) -> None:
+		# Don't block forever if the reader went away
+		while not self.stopped.is_set():
+			try:
+				self.chunks.put(item, timeout = .1)
+				return
+			except queue.Full:
+				continue
+
+	def next_chunk(self) -> bool:
+		if self.done:
+			return False
+
+		chunk = self.chunks.get()
+		if isinstance(chunk, Exception):
+			self.done = True
+			raise chunk
+
+		if not chunk:
+			self.done = True
+			return False
+
+		self.buf = chunk
+		self.pos = 0
+		return True
+
+	def read(self, size: int = -1) -> bytes:
+		if size is None or size < 0:
+			parts = [self.buf[self.pos:]]
+			while self.next_chunk():
+				parts.append(self.buf)
+			self.buf, self.pos = b'', 0
+			return b''.join(parts)
+
+		if self.pos >= len(self.buf) and not self.next_chunk():
+			return b''
+
+		data = self.buf[self.pos:self.pos + size]
+		self.pos += len(data)
+		return data
+
+	def close(self) -> None:
+		self.stopped.set()
+		# Unblock the thread if it's waiting on a full queue
+		while True:
+			try:
+				self.chunks.get_nowait()
+			except queue.Empty:
+				break
+		self.thread.join()
+		self.f.close()
+
+
+def open_mrf_gzip(
+	filename: str | None = None,
+	fileobj = None,
+	backend: str | None = None,
+	threaded: bool | None = None,
+):
+	"""What JSONOpen uses: open_gzip, on a background thread
+	unless threaded is False"""
+	f = open_gzip(filename, fileobj, backend)
+
+	if threaded is None:
+		threaded = default_threaded
+
+	if threaded:
+		return ThreadedReader(f)
+	return f
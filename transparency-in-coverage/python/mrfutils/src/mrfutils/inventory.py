@@ -0,0 +1,332 @@
+"""
+Downloader inventories
+######################
+
+The scripts in python/downloaders list an insurer's in-network files and
+save each URL with its size to a sqlite file (aetna_data.db, ...), which
+is what mrfutils.scheduler reads. They used to each have a copy of the
+same loop: a HEAD for every URL at once, an f-string INSERT and a commit
+per row. On a big insurer that floods the host and spends most of its
+time syncing the database.
+
+Inventory is the sqlite file. Its tables keep the old
+`(url PRIMARY KEY UNIQUE, size)` columns, plus the ETag and Last-Modified
+the server sent, when the URL was probed, and the error if it failed
+(older files get the new columns added). Rows are written in batches,
+one transaction per batch.
+
+SizeProber gets the sizes:
+
+- with at most `concurrency` requests in flight, and at most `per_host`
+  to any one host
+- with a timeout on every request
+- retrying connection errors, timeouts and 408/429/5xx responses up to
+  `retries` times, with exponential backoff and full jitter (and
+  respecting Retry-After), like mrfutils.fetcher
+- with a one-byte GET (Range: bytes=0-0) for servers that don't allow HEAD
+
+URLs that are already in the inventory are skipped, so a run that was
+cut short picks up where it left off. URLs that failed are stored with
+size -1 and their error, and are tried again next time.
+
+Usage:
+>>> with Inventory('aetna_data.db') as inventory:
+>>>     fetch_url_sizes(inventory, urls)
+>>>     print(inventory.total_size())
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import re
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Iterable
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from mrfutils.exceptions import FetchError
+from mrfutils.fetcher import RETRY_STATUSES, retry_after
+
+log = logging.getLogger('mrfutils')
+
+TABLE = 'in_network_files'
+
+CONCURRENCY = 32
+PER_HOST = 8
+RETRIES = 4
+
+# Seconds. The n-th retry waits a random time between
+# 0 and min(MAX_BACKOFF, BACKOFF * 2**n)
+BACKOFF = .5
+MAX_BACKOFF = 30
+
+TIMEOUT = aiohttp.ClientTimeout(total = 60, sock_connect = 30)
+
+# Rows per transaction
+BATCH_SIZE = 1_000
+
+# Size when the server doesn't say, or the probe failed
+UNKNOWN_SIZE = -1
+
+# Responses to HEAD from servers that only allow GET
+NO_HEAD_STATUSES = {403, 405, 501}
+
+# Columns added to the downloaders' (url, size) tables
+COLUMNS = {
+	'etag': 'TEXT',
+	'last_modified': 'TEXT',
+	'probed': 'REAL',
+	'error': 'TEXT',
+}
+
+
+class Inventory:
+	"""
+	A downloader's sqlite file. Tables are created (or get
+	the new columns) the first time they're used
+	"""
+
+	def __init__(self, path: str, batch_size: int = BATCH_SIZE):
+		self.path = path
+		self.batch_size = batch_size
+		self.con = sqlite3.connect(path)
+		self.tables = set()
+
+	def ensure_table(self, table: str) -> None:
+		if table in self.tables:
+			return
+		if not re.fullmatch(r'\w+', table):
+			raise ValueError(f'Not a table name: {table=}')
+
+		with self.con:
+			self.con.execute(f'CREATE TABLE IF NOT EXISTS {table} (url PRIMARY KEY UNIQUE, size)')
+			have = {row[1] for row in self.con.execute(f'PRAGMA table_info({table})')}
+			for column, kind in COLUMNS.items():
+				if column not in have:
+					self.con.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+		self.tables.add(table)
+
+	def known(self, table: str = TABLE) -> set[str]:
+		"""The URLs that are stored, and didn't fail"""
+		self.ensure_table(table)
+		return {url for url, in self.con.execute(f'SELECT url FROM {table} WHERE error IS NULL')}
+
+	def add(self, rows: Iterable[tuple | dict], table: str = TABLE) -> int:
+		"""Stores rows, a batch per transaction. A row is (url, size)
+		or a dict with url, size, and any of etag, last_modified, probed
+		and error. Rows replace what's stored for the same URL. Returns
+		the number of rows"""
+		self.ensure_table(table)
+		n = 0
+		batch = []
+		for row in rows:
+			if not isinstance(row, dict):
+				url, size = row
+				row = dict(url = url, size = size)
+			batch.append(row)
+			if len(batch) >= self.batch_size:
+				n += self.write(batch, table)
+				batch = []
+		if batch:
+			n += self.write(batch, table)
+		return n
+
+	def write(self, batch: list[dict], table: str) -> int:
+		with self.con:
+			self.con.executemany(
+				f"""INSERT INTO {table} (url, size, etag, last_modified, probed, error)
+				VALUES (:url, :size, :etag, :last_modified, :probed, :error)
+				ON CONFLICT (url) DO UPDATE SET
+					size = excluded.size,
+					etag = excluded.etag,
+					last_modified = excluded.last_modified,
+					probed = excluded.probed,
+					error = excluded.error""",
+				[
+					dict(dict.fromkeys(('etag', 'last_modified', 'probed', 'error')), **row)
+					for row in batch
+				],
+			)
+		return len(batch)
+
+	def total_size(self, table: str = TABLE) -> int:
+		"""Bytes, of the files whose size is known"""
+		self.ensure_table(table)
+		total, = self.con.execute(f'SELECT SUM(size) FROM {table} WHERE size >= 0').fetchone()
+		return total or 0
+
+	def close(self) -> None:
+		self.con.close()
+
+	def __enter__(self) -> Inventory:
+		return self
+
+	def __exit__(self, *exc) -> None:
+		self.close()
+
+
+def content_range_size(value: str | None) -> int | None:
+	"""The total in `Content-Range: bytes 0-0/<total>`"""
+	match = re.fullmatch(r'bytes \d+-\d+/(\d+)', value or '')
+	return int(match.group(1)) if match else None
+
+
+class SizeProber:
+
+	def __init__(
+		self,
+		concurrency: int = CONCURRENCY,
+		per_host: int = PER_HOST,
+		retries: int = RETRIES,
+		backoff: float = BACKOFF,
+		max_backoff: float = MAX_BACKOFF,
+		timeout: aiohttp.ClientTimeout = TIMEOUT,
+	):
+		self.concurrency = concurrency
+		self.per_host = per_host
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+
+		self.session = None
+		self.host_limits = None
+		self.retried = 0
+
+	async def __aenter__(self) -> SizeProber:
+		# Sessions belong to an event loop: open one per use
+		self.session = aiohttp.ClientSession(
+			connector = aiohttp.TCPConnector(limit = self.concurrency, limit_per_host = self.per_host),
+			timeout = self.timeout,
+		)
+		# Taken before the request, so time spent waiting
+		# for a turn doesn't count against the timeout
+		self.host_limits = defaultdict(lambda: asyncio.Semaphore(self.per_host))
+		return self
+
+	async def __aexit__(self, *exc) -> None:
+		await self.session.close()
+		self.session = None
+
+	def delay(self, attempt: int) -> float:
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+	async def request(self, method: str, url: str, headers: dict) -> tuple[int, dict]:
+		"""(status, headers), retrying what's worth retrying"""
+		for attempt in range(self.retries + 1):
+			last_try = attempt == self.retries
+			wait = None
+			try:
+				async with self.host_limits[urlsplit(url).netloc]:
+					async with self.session.request(method, url, headers = headers, allow_redirects = True) as response:
+						if response.status not in RETRY_STATUSES:
+							return response.status, response.headers
+						reason = f'HTTP {response.status}'
+						wait = retry_after(response)
+			except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+				reason = repr(e)
+
+			if last_try:
+				raise FetchError(f'{url}: {reason} after {self.retries + 1} attempts')
+
+			if wait is None:
+				wait = self.delay(attempt)
+			else:
+				wait = min(wait, self.max_backoff)
+
+			log.debug(f'Retrying {url} in {wait:.1f}s: {reason}')
+			self.retried += 1
+			await asyncio.sleep(wait)
+
+	async def probe(self, url: str) -> dict:
+		"""An inventory row for url. Raises FetchError"""
+		if self.session is None:
+			raise RuntimeError('Use the prober as `async with prober:`')
+
+		status, headers = await self.request('HEAD', url, {'Accept-Encoding': 'identity'})
+		if status in NO_HEAD_STATUSES:
+			status, headers = await self.request('GET', url, {'Accept-Encoding': 'identity', 'Range': 'bytes=0-0'})
+
+		if status == 206:
+			size = content_range_size(headers.get('Content-Range'))
+		elif status == 200:
+			length = headers.get('Content-Length')
+			size = int(length) if length and length.isdigit() else None
+		else:
+			raise FetchError(f'{url}: HTTP {status}')
+
+		return dict(
+			url = url,
+			size = UNKNOWN_SIZE if size is None else size,
+			etag = headers.get('ETag'),
+			last_modified = headers.get('Last-Modified'),
+			probed = time.time(),
+		)
+
+
+async def probe_sizes(
+	inventory: Inventory,
+	urls: Iterable[str],
+	table: str = TABLE,
+	prober: SizeProber | None = None,
+	resume: bool = True,
+) -> dict:
+	"""Probes the urls that aren't in the inventory yet (all of
+	them if not resume) and stores them as they come back. Returns
+	counts of what happened"""
+	prober = prober or SizeProber()
+	urls = list(dict.fromkeys(urls))
+	skip = inventory.known(table) if resume else set()
+	todo = [url for url in urls if url not in skip]
+	counts = dict(probed = 0, failed = 0, skipped = len(urls) - len(todo), retries = 0)
+
+	queue = asyncio.Queue()
+	for url in todo:
+		queue.put_nowait(url)
+	results = []
+
+	async def worker():
+		while True:
+			try:
+				url = queue.get_nowait()
+			except asyncio.QueueEmpty:
+				return
+			try:
+				row = await prober.probe(url)
+				counts['probed'] += 1
+			except FetchError as e:
+				row = dict(url = url, size = UNKNOWN_SIZE, probed = time.time(), error = str(e))
+				counts['failed'] += 1
+				log.warning(str(e))
+			results.append(row)
+			if len(results) >= inventory.batch_size:
+				flush()
+
+	def flush():
+		if results:
+			inventory.add(results[:], table)
+			results.clear()
+
+	start = time.monotonic()
+	async with prober:
+		try:
+			await asyncio.gather(*(worker() for _ in range(min(prober.concurrency, len(todo)))))
+		finally:
+			# What's been probed is kept, even if we're interrupted
+			flush()
+
+	counts['retries'] = prober.retried
+	log.info(
+		f'Probed {counts["probed"]:,} URLs in {time.monotonic() - start:,.1f}s: '
+		f'{counts["failed"]:,} failed, {counts["skipped"]:,} already in {inventory.path}'
+	)
+	return counts
+
+
+def fetch_url_sizes(inventory: Inventory, urls: Iterable[str], table: str = TABLE, **kwargs) -> dict:
+	"""probe_sizes, for scripts that aren't async"""
+	return asyncio.run(probe_sizes(inventory, urls, table, **kwargs))
@@ -0,0 +1,285 @@
+"""
+Skipping files we've already flattened
+######################################
+
+A TOC can point at the same bytes under many URLs, and most in-network
+files don't change from one month to the next, but every run downloaded
+and flattened them all again.
+
+A Manifest is a sqlite file with a row for every file that was flattened
+with it: the URL, the size, the ETag and Last-Modified the server sent,
+a fingerprint of the content, the filters and output format (as a hash,
+like mrfutils.checkpoint), and where the rows went.
+
+The fingerprint is a hash of the size and the first and last BLOCK_SIZE
+bytes of the file as it's stored. For a .json.gz the last bytes are the
+gzip trailer, which has the CRC32 and length of the whole uncompressed
+file, so two files with the same fingerprint have the same JSON. Remote
+files are fingerprinted with two range requests, so nothing else is
+downloaded. When the server doesn't do ranges, a file is only recognized
+at the same URL, by its size and its ETag or Last-Modified.
+
+Before a file is opened, in_network_file_to_csv(..., manifest = ...) looks
+it up. If it was flattened with the same filters before, under this URL
+or another one, nothing is read or written: the rows are the ones already
+written to that entry's out_dir (with that entry's file id, if the
+filename is different). The URL is added to the manifest with `same_as`
+set to the URL whose rows it has. Otherwise the file is flattened as
+usual, and its row is added once it's done.
+
+Usage:
+>>> manifest = Manifest('manifest.db')
+>>> in_network_file_to_csv(url, out_dir, manifest = manifest)
+>>> manifest.entry(url)
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+
+import requests
+
+from mrfutils.checkpoint import fingerprint
+from mrfutils.hashers import get_hash_mode
+from mrfutils.helpers import JSONOpen
+from mrfutils.remote import TIMEOUT, cached_copy
+
+log = logging.getLogger('mrfutils')
+
+VERSION = 1
+
+# Bytes from each end of the file
+BLOCK_SIZE = 2**16
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+	url TEXT NOT NULL,
+	options TEXT NOT NULL,
+	size INTEGER,
+	etag TEXT,
+	last_modified TEXT,
+	fingerprint TEXT,
+	file_id TEXT,
+	out_dir TEXT,
+	same_as TEXT,
+	processed REAL,
+	PRIMARY KEY (url, options)
+);
+CREATE INDEX IF NOT EXISTS manifest_fingerprint ON manifest (fingerprint, options);
+"""
+
+COLUMNS = ('url', 'options', 'size', 'etag', 'last_modified', 'fingerprint', 'file_id', 'out_dir', 'same_as', 'processed')
+
+
+class Source:
+	"""What we know about a file without reading it"""
+
+	def __init__(
+		self,
+		url: str,
+		size: int | None = None,
+		etag: str | None = None,
+		last_modified: str | None = None,
+		fingerprint: str | None = None,
+	):
+		self.url = url
+		self.size = size
+		self.etag = etag
+		self.last_modified = last_modified
+		self.fingerprint = fingerprint
+
+
+def content_fingerprint(size: int, head: bytes, tail: bytes) -> str:
+	h = hashlib.sha256(f'{size}\0'.encode())
+	h.update(head)
+	h.update(b'\0')
+	h.update(tail)
+	return h.hexdigest()
+
+
+def local_source(url: str, path: str) -> Source:
+	size = os.path.getsize(path)
+	with open(path, 'rb') as f:
+		head = f.read(BLOCK_SIZE)
+		f.seek(max(0, size - BLOCK_SIZE))
+		tail = f.read(BLOCK_SIZE)
+	return Source(url, size = size, fingerprint = content_fingerprint(size, head, tail))
+
+
+def read_range(session: requests.Session, url: str, byte_range: str) -> tuple[bytes, int] | None:
+	"""(bytes, size of the file), or None if the server
+	sends the whole file instead"""
+	headers = {'Range': f'bytes={byte_range}', 'Accept-Encoding': 'identity'}
+	with session.get(url, headers = headers, stream = True, timeout = TIMEOUT) as response:
+		if response.status_code != 206:
+			return None
+		match = re.fullmatch(r'bytes \d+-\d+/(\d+)', response.headers.get('Content-Range', ''))
+		if not match:
+			return None
+		return response.raw.read(BLOCK_SIZE + 1, decode_content = False), int(match.group(1))
+
+
+def remote_source(url: str) -> Source:
+	"""Raises requests.RequestException if the server
+	can't be reached"""
+	with requests.Session() as session:
+		source = Source(url)
+		response = session.head(url, allow_redirects = True, timeout = TIMEOUT, headers = {'Accept-Encoding': 'identity'})
+		# Some servers only allow GET
+		if response.ok:
+			length = response.headers.get('Content-Length')
+			source.size = int(length) if length and length.isdigit() else None
+			source.etag = response.headers.get('ETag')
+			source.last_modified = response.headers.get('Last-Modified')
+
+		head = read_range(session, url, f'0-{BLOCK_SIZE - 1}')
+		if head is None:
+			return source
+		head, size = head
+		tail = read_range(session, url, f'-{BLOCK_SIZE}') if size > BLOCK_SIZE else (head, size)
+		if tail is None:
+			return source
+
+		source.size = size
+		source.fingerprint = content_fingerprint(size, head, tail[0][-BLOCK_SIZE:])
+		return source
+
+
+def identify(url: str, file: str) -> Source:
+	"""The Source for the file we'd read: `file` if it's local (or a
+	copy of it in the input cache, see mrfutils.remote), the URL if not"""
+	opener = JSONOpen(file)
+	if not opener.is_remote:
+		return local_source(url, file)
+
+	cached = cached_copy(file, opener.suffix)
+	if cached is not None:
+		return local_source(url, cached)
+	source = remote_source(file)
+	source.url = url
+	return source
+
+
+def manifest_options(
+	code_filter: set | None,
+	npi_filter: set | None,
+	tenants: dict | None,
+	tenant_code_filters: dict | None,
+	out_format: str,
+) -> str:
+	"""Everything that changes which rows get written,
+	other than the file"""
+	return fingerprint(
+		VERSION,
+		code_filter,
+		npi_filter,
+		tenants,
+		tenant_code_filters,
+		out_format,
+		get_hash_mode(),
+	)
+
+
+class Manifest:
+
+	def __init__(self, path: str):
+		self.path = path
+		self.con = None
+		self.pid = None
+
+	def connect(self) -> sqlite3.Connection:
+		# A connection can't be shared with a forked process
+		if self.con is None or self.pid != os.getpid():
+			self.con = sqlite3.connect(self.path, timeout = 60)
+			self.con.executescript(SCHEMA)
+			self.pid = os.getpid()
+		return self.con
+
+	def __getstate__(self) -> dict:
+		return dict(path = self.path, con = None, pid = None)
+
+	def lookup(self, source: Source, options: str) -> dict | None:
+		"""The entry of a file with the same content that was
+		flattened with the same options, this URL's if there is one"""
+		con = self.connect()
+		if source.fingerprint is not None:
+			row = con.execute(
+				f"""SELECT {', '.join(COLUMNS)} FROM manifest
+				WHERE fingerprint = ? AND size = ? AND options = ? AND same_as IS NULL
+				ORDER BY url = ? DESC, processed DESC LIMIT 1""",
+				(source.fingerprint, source.size, options, source.url),
+			).fetchone()
+		elif source.size is not None and (source.last_modified or (source.etag and not source.etag.startswith('W/'))):
+			row = con.execute(
+				f"""SELECT {', '.join(COLUMNS)} FROM manifest
+				WHERE url = ? AND options = ? AND size = ? AND same_as IS NULL
+				AND ((etag = ? AND etag NOT LIKE 'W/%') OR last_modified = ?)""",
+				(source.url, options, source.size, source.etag, source.last_modified),
+			).fetchone()
+		else:
+			row = None
+		return dict(zip(COLUMNS, row)) if row else None
+
+	def record(
+		self,
+		source: Source,
+		options: str,
+		file_id: int | None = None,
+		out_dir: str | None = None,
+		same_as: str | None = None,
+	) -> None:
+		con = self.connect()
+		with con:
+			con.execute(
+				f"""INSERT OR REPLACE INTO manifest ({', '.join(COLUMNS)})
+				VALUES ({', '.join('?' * len(COLUMNS))})""",
+				(
+					source.url,
+					options,
+					source.size,
+					source.etag,
+					source.last_modified,
+					source.fingerprint,
+					None if file_id is None else str(file_id),
+					out_dir,
+					same_as,
+					time.time(),
+				),
+			)
+
+	def check(self, url: str, file: str, options: str) -> tuple[Source | None, bool]:
+		"""Looks the file up. Returns its Source (None if we can't
+		tell what's in it) and whether it can be skipped"""
+		try:
+			source = identify(url, file)
+		except (requests.RequestException, OSError) as e:
+			log.warning(f'Not checking the manifest for {url}: {e!r}')
+			return None, False
+
+		entry = self.lookup(source, options)
+		if entry is None:
+			return source, False
+
+		if entry['url'] == url:
+			log.info(f'Skipping {url}: unchanged since it was written to {entry["out_dir"]}')
+		else:
+			log.info(f'Skipping {url}: same content as {entry["url"]}, written to {entry["out_dir"]}')
+			self.record(source, options, entry['file_id'], entry['out_dir'], same_as = entry['url'])
+		return source, True
+
+	def entry(self, url: str) -> dict | None:
+		"""The latest entry for url"""
+		row = self.connect().execute(
+			f'SELECT {", ".join(COLUMNS)} FROM manifest WHERE url = ? ORDER BY processed DESC LIMIT 1',
+			(url,),
+		).fetchone()
+		return dict(zip(COLUMNS, row)) if row else None
+
+	def close(self) -> None:
+		if self.con is not None and self.pid == os.getpid():
+			self.con.close()
+		self.con = None
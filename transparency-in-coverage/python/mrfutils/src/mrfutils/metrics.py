@@ -0,0 +1,421 @@
+"""
+Counters and timers for a run
+#############################
+
+The flattener used to log a line for every in-network item it wrote or
+skipped, which was slow and said nothing about where the time went. Pass it
+a RunStats instead:
+
+>>> stats = RunStats(progress = True, summary_file = 'stats.json')
+>>> in_network_file_to_csv(..., stats = stats)
+>>> stats.counters['items_kept']
+
+While the run goes it counts
+
+	compressed_bytes     read from the file (or the wire), not counted
+	                     when reading through a gzip index
+	decompressed_bytes   of JSON handed to the parser
+	events               parser events ('byte_skip' doesn't make any)
+	items_parsed         in-network items that got past the code filter
+	items_skipped_code   in-network items rejected by the code filter
+	items_skipped_arrangement
+	                     ... and for not being 'ffs'
+	items_skipped_field  ... and by a rule on another field
+	items_kept           items with rows written, after the NPI filter
+	references           inline provider references
+	references_fetched   remote provider references (and _failed)
+	ref_map_size         references in the reference map
+
+plus the rows written to each table (and at the end, the bytes), and the
+seconds spent in each stage: 'references', 'parse' (reading, inflating and
+parsing the in-network items, skipped ones included), 'build' (swapping
+references, filtering NPIs, building and hashing rows) and 'write' (the
+sinks). Stages don't overlap: a stage that starts inside another one stops
+the other one's clock. With workers, 'build' happens in the pool, and is
+reported (summed over the workers) in `worker_stages`; 'wait' is the time
+the main process spends waiting on them.
+
+With `progress` on, a line like
+
+	2.1 GB of 5.3 GB (40%), 61.2 MB/s in, 240.3 MB/s JSON, 3,402,115 events/s,
+	120,000 items (8,204 kept), 3,118,442 rows, ETA 0:00:52
+
+is logged every `interval` seconds. The ETA is for the pass over the file
+that's going on. Pass `callback` to get snapshot() on the same schedule
+instead, and `summary_file` to write the final snapshot as JSON when the
+run ends (whether or not it succeeded).
+
+When no RunStats is active the module-level helpers here do nothing, so
+the flattener calls them unconditionally.
+"""
+from __future__ import annotations
+
+import contextlib
+import datetime
+import json
+import logging
+import time
+from collections import Counter
+from typing import Callable, Iterable, Iterator
+
+log = logging.getLogger('mrfutils')
+
+# Seconds between progress lines
+INTERVAL = 30
+
+# Parser events between updates of the 'events' counter
+EVENT_BATCH = 2**16
+
+# The RunStats of the run that's going on, if any
+active = None
+
+
+class Stage:
+	"""Reusable context manager for RunStats.stage"""
+
+	def __init__(self, stats: RunStats, name: str):
+		self.stats = stats
+		self.name = name
+
+	def __enter__(self):
+		self.stats.push(self.name)
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.stats.pop()
+
+
+class CountingReader:
+	"""Counts the bytes read from f"""
+
+	def __init__(self, f, counters: Counter):
+		self.f = f
+		self.counters = counters
+
+	def read(self, size: int = -1) -> bytes:
+		data = self.f.read(size)
+		self.counters['decompressed_bytes'] += len(data)
+		return data
+
+
+class RunStats:
+
+	def __init__(
+		self,
+		progress: bool = False,
+		interval: float = INTERVAL,
+		callback: Callable[[dict], None] | None = None,
+		summary_file: str | None = None,
+	):
+		self.progress = progress or callback is not None
+		self.interval = interval
+		self.callback = callback or log_progress
+		self.summary_file = summary_file
+
+		self.counters = Counter()
+		self.rows = Counter()
+		self.table_bytes = Counter()
+		# Stage -> seconds
+		self.stages: dict[str, float] = {}
+		self.worker_stages: dict[str, float] = {}
+
+		self.stack = []
+		self.switched = None
+
+		self.started = None
+		self.finished = None
+		self.last_tick = None
+
+		# The input that's open (a JSONOpen), and when it was opened
+		self.input = None
+		self.input_started = None
+
+	def start(self) -> None:
+		self.started = self.switched = self.last_tick = time.perf_counter()
+
+	def count(self, name: str, n: int = 1) -> None:
+		self.counters[name] += n
+
+	def push(self, name: str) -> None:
+		now = time.perf_counter()
+		if self.stack:
+			top = self.stack[-1]
+			self.stages[top] = self.stages.get(top, 0) + now - self.switched
+		self.stack.append(name)
+		self.switched = now
+
+	def pop(self) -> None:
+		now = time.perf_counter()
+		top = self.stack.pop()
+		self.stages[top] = self.stages.get(top, 0) + now - self.switched
+		self.switched = now
+
+	def stage(self, name: str) -> Stage:
+		return Stage(self, name)
+
+	def tick(self) -> None:
+		"""Reports progress if it's been `interval` seconds"""
+		if not self.progress:
+			return
+		now = time.perf_counter()
+		if now - self.last_tick < self.interval:
+			return
+		self.last_tick = now
+		self.callback(self.snapshot())
+
+	def track_items(self, items: Iterable) -> Iterator:
+		"""Times getting each item out of the parser as 'parse'"""
+		items = iter(items)
+		parse = self.stage('parse')
+		while True:
+			with parse:
+				try:
+					item = next(items)
+				except StopIteration:
+					return
+			self.counters['items_parsed'] += 1
+			self.tick()
+			yield item
+
+	def count_events(self, events: Iterable) -> Iterator:
+		n = 0
+		try:
+			for event in events:
+				n += 1
+				yield event
+				if n == EVENT_BATCH:
+					self.counters['events'] += n
+					n = 0
+					self.tick()
+		finally:
+			self.counters['events'] += n
+
+	def open_input(self, source, f):
+		"""Called by JSONOpen. Returns the file object to parse"""
+		self.input = source
+		self.input_started = time.perf_counter()
+		return CountingReader(f, self.counters)
+
+	def close_input(self, source) -> None:
+		if source is not self.input:
+			return
+		self.counters['compressed_bytes'] += source.position() or 0
+		self.input = None
+
+	def merge(self, counters: dict, stages: dict) -> None:
+		"""Adds what a worker counted"""
+		self.counters.update(counters)
+		for name, seconds in stages.items():
+			self.worker_stages[name] = self.worker_stages.get(name, 0) + seconds
+
+	def input_progress(self) -> dict:
+		"""Where we are in the input that's open"""
+		if self.input is None:
+			return {}
+
+		pos = self.input.position()
+		if pos is None:
+			return {}
+
+		progress = dict(position = pos, size = self.input.size)
+		elapsed = time.perf_counter() - self.input_started
+		rate = pos / elapsed if elapsed else 0
+		if self.input.size and rate:
+			progress['eta'] = max(0, self.input.size - pos) / rate
+		return progress
+
+	def snapshot(self) -> dict:
+		end = self.finished or time.perf_counter()
+		elapsed = end - self.started
+
+		stages = dict(self.stages)
+		if self.stack:
+			# Charge the stage that's going on up to now
+			top = self.stack[-1]
+			stages[top] = stages.get(top, 0) + end - self.switched
+
+		counters = dict(self.counters)
+		input_progress = self.input_progress()
+		if input_progress:
+			counters['compressed_bytes'] = (
+				counters.get('compressed_bytes', 0)
+				+ input_progress['position']
+			)
+		counters['items_seen'] = (
+			counters.get('items_parsed', 0)
+			+ counters.get('items_skipped_code', 0)
+			+ counters.get('items_skipped_arrangement', 0)
+			+ counters.get('items_skipped_field', 0)
+		)
+
+		snapshot = dict(
+			elapsed = elapsed,
+			counters = counters,
+			rows = dict(self.rows),
+			stages = stages,
+		)
+		if self.worker_stages:
+			snapshot['worker_stages'] = dict(self.worker_stages)
+		if self.table_bytes:
+			snapshot['table_bytes'] = dict(self.table_bytes)
+		if input_progress:
+			snapshot['input'] = input_progress
+		snapshot['per_second'] = {
+			name: counters.get(name, 0) / elapsed if elapsed else 0
+			for name in ('compressed_bytes', 'decompressed_bytes', 'events', 'items_seen', 'items_kept')
+		}
+		snapshot['per_second']['rows'] = sum(self.rows.values()) / elapsed if elapsed else 0
+		return snapshot
+
+	def finish(self, error: BaseException | None = None) -> None:
+		self.finished = time.perf_counter()
+		snapshot = self.snapshot()
+		log.info(f'Done: {format_progress(snapshot)}')
+
+		if self.summary_file is None:
+			return
+
+		snapshot['completed'] = error is None
+		if error is not None:
+			snapshot['error'] = repr(error)
+		with open(self.summary_file, 'w') as f:
+			json.dump(snapshot, f, indent = 2)
+
+
+@contextlib.contextmanager
+def activate(stats: RunStats | None):
+	"""Makes stats the active RunStats for the duration"""
+	global active
+	if stats is None:
+		yield
+		return
+
+	previous = active
+	active = stats
+	stats.start()
+	try:
+		yield
+	except BaseException as e:
+		stats.finish(e)
+		raise
+	else:
+		stats.finish()
+	finally:
+		active = previous
+
+
+def count(name: str, n: int = 1) -> None:
+	if active is not None:
+		active.counters[name] += n
+
+
+def set_value(name: str, value: int) -> None:
+	if active is not None:
+		active.counters[name] = value
+
+
+def stage(name: str):
+	if active is None:
+		return contextlib.nullcontext()
+	return active.stage(name)
+
+
+def count_events(events: Iterable) -> Iterable:
+	if active is None:
+		return events
+	return active.count_events(events)
+
+
+def track_items(items: Iterable) -> Iterable:
+	if active is None:
+		return items
+	return active.track_items(items)
+
+
+def tick() -> None:
+	if active is not None:
+		active.tick()
+
+
+def format_bytes(n: float) -> str:
+	for unit in ('B', 'KB', 'MB', 'GB'):
+		if n < 1024:
+			return f'{n:.1f} {unit}'
+		n /= 1024
+	return f'{n:.1f} TB'
+
+
+def format_progress(snapshot: dict) -> str:
+	counters = snapshot['counters']
+	per_second = snapshot['per_second']
+	parts = []
+
+	input_progress = snapshot.get('input', {})
+	if input_progress.get('size'):
+		parts.append(
+			f'{format_bytes(input_progress["position"])} of {format_bytes(input_progress["size"])} '
+			f'({input_progress["position"] / input_progress["size"]:.0%})'
+		)
+	else:
+		parts.append(f'{format_bytes(counters.get("compressed_bytes", 0))} read')
+
+	parts.append(f'{format_bytes(per_second["compressed_bytes"])}/s in')
+	parts.append(f'{format_bytes(per_second["decompressed_bytes"])}/s JSON')
+	if counters.get('events'):
+		parts.append(f'{per_second["events"]:,.0f} events/s')
+	parts.append(f'{counters["items_seen"]:,} items ({counters.get("items_kept", 0):,} kept)')
+	parts.append(f'{sum(snapshot["rows"].values()):,} rows')
+
+	if 'eta' in input_progress:
+		parts.append(f'ETA {datetime.timedelta(seconds = round(input_progress["eta"]))}')
+	else:
+		parts.append(f'{datetime.timedelta(seconds = round(snapshot["elapsed"]))} elapsed')
+
+	return ', '.join(parts)
+
+
+def log_progress(snapshot: dict) -> None:
+	log.info(format_progress(snapshot))
+
+
+class StatsSink:
+	"""Wraps a sink to count the rows written to each table, and time
+	the writes. The bytes are added up when it's closed"""
+
+	def __init__(self, sink, stats: RunStats):
+		self.sink = sink
+		self.stats = stats
+		self.write_stage = stats.stage('write')
+		self.start_bytes = sink.table_bytes()
+
+	def write(self, table_name: str, row_data) -> None:
+		self.stats.rows[table_name] += len(row_data) if isinstance(row_data, list) else 1
+		with self.write_stage:
+			self.sink.write(table_name, row_data)
+
+	def flush(self) -> None:
+		self.sink.flush()
+
+	def checkpoint(self) -> dict:
+		return self.sink.checkpoint()
+
+	def restore(self, state: dict) -> None:
+		self.sink.restore(state)
+		self.start_bytes = self.sink.table_bytes()
+
+	def table_bytes(self) -> dict:
+		return self.sink.table_bytes()
+
+	def close(self) -> None:
+		with self.write_stage:
+			self.sink.close()
+
+		for table_name, n in self.sink.table_bytes().items():
+			n -= self.start_bytes.get(table_name, 0)
+			if n:
+				self.stats.table_bytes[table_name] += n
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -0,0 +1,172 @@
+"""
+Converting and filtering NPI lists
+##################################
+
+A provider group's NPIs come out of the parser as a list of ints (or
+strings), and process_group turns them into an array('L') with only the
+NPIs in the filter. Groups of tens of thousands of NPIs are common in
+the big payers' files, and doing that one NPI at a time in Python is most
+of the time it takes to process their provider references.
+
+With numpy installed, long lists are done in a few vectorized steps
+instead:
+
+1. np.fromiter converts the whole list to uint64 at once (lists of
+   strings go through np.array(...).astype)
+2. membership is tested against the filter, compiled once per NPIFilter
+   (in_network_file_to_csv makes one per call, and the compiled filter
+   goes away with it):
+   - if the filter's NPIs span less than BITMAP_MAX_BITS, as a packed
+     bitmap over that span: one lookup per NPI
+   - otherwise, as a sorted array: the NPIs are sorted and np.searchsorted
+     finds each one's place in the filter (searching in order is much
+     faster than searching at random)
+3. the NPIs that passed go back into an array('L') as raw bytes
+
+Lists shorter than VECTOR_MIN, and filters that are plain sets, stay on
+the plain Python path, where
+numpy's per-call overhead would cost more than it saves. Both paths give
+the same arrays.
+
+`python benchmarks/bench_npi_filter.py` compares this with the one-at-a-time
+implementation.
+"""
+from __future__ import annotations
+
+from array import array
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# Shorter lists are converted and filtered in plain Python
+VECTOR_MIN = 256
+
+# Filters spanning more NPIs than this (32MB of bitmap) are
+# searched instead. NPIs are 10 digits, so a bitmap over all
+# of them would be over 1GB, per worker process
+BITMAP_MAX_BITS = 2**28
+
+# array('L') is 64-bit on Linux and macOS, but 32-bit on Windows
+RAW_COPY = array('L').itemsize == 8
+
+
+class CompiledFilter:
+
+	def __init__(self, npi_filter: set):
+		npis = np.fromiter(npi_filter, np.uint64, len(npi_filter))
+		npis.sort()
+		self.npis = npis
+
+		self.bitmap = None
+		if len(npis):
+			self.low = npis[0]
+			self.span = int(npis[-1] - npis[0]) + 1
+			if self.span <= BITMAP_MAX_BITS:
+				offsets = npis - self.low
+				self.bitmap = np.zeros((self.span + 7) // 8, np.uint8)
+				np.bitwise_or.at(self.bitmap, offsets >> 3, (1 << (offsets & 7)).astype(np.uint8))
+
+	def bitmap_mask(self, npis):
+		# NPIs below low wrap around to huge offsets
+		offsets = npis - self.low
+		inside = np.flatnonzero(offsets < self.span)
+		offsets = offsets[inside]
+
+		mask = np.zeros(len(npis), bool)
+		mask[inside] = (self.bitmap[offsets >> 3] >> (offsets & 7).astype(np.uint8)) & 1
+		return mask
+
+	def search_mask(self, npis):
+		order = np.argsort(npis)
+		sorted_npis = npis[order]
+
+		positions = np.searchsorted(self.npis, sorted_npis)
+		# NPIs past the end of the filter can't be in it
+		positions[positions == len(self.npis)] = 0
+
+		mask = np.empty(len(npis), bool)
+		mask[order] = self.npis[positions] == sorted_npis
+		return mask
+
+	def filter(self, npis):
+		"""The uint64 array npis without the NPIs that aren't
+		in the filter, in the same order"""
+		if not len(self.npis):
+			return npis[:0]
+
+		if self.bitmap is not None:
+			return npis[self.bitmap_mask(npis)]
+		return npis[self.search_mask(npis)]
+
+
+class NPIFilter(set):
+	"""
+	A set of int NPIs that compiles itself the first time a long list
+	is filtered with it. Don't change it after that
+	"""
+	__slots__ = ('compiled_filter',)
+
+	def compiled(self) -> CompiledFilter:
+		try:
+			return self.compiled_filter
+		except AttributeError:
+			self.compiled_filter = CompiledFilter(self)
+			return self.compiled_filter
+
+	def __reduce__(self):
+		# Workers compile their own
+		return NPIFilter, (list(self),)
+
+
+def to_array(npis) -> array:
+	if RAW_COPY:
+		out = array('L')
+		out.frombytes(npis.tobytes())
+		return out
+	return array('L', npis.tolist())
+
+
+def vectorize(npis):
+	"""npis as a uint64 array, or None if they can't be converted
+	the same way int() would convert them"""
+	try:
+		return np.fromiter(npis, np.uint64, len(npis))
+	except OverflowError:
+		# Negative, or too big. Let array('L') raise it
+		return None
+	except (ValueError, TypeError):
+		pass
+
+	# Strings, probably
+	try:
+		arr = np.asarray(npis)
+		if arr.dtype.kind != 'U':
+			return None
+		return arr.astype(np.uint64)
+	except (ValueError, TypeError, OverflowError):
+		return None
+
+
+def convert_npis(npis) -> array:
+	"""array('L', [int(n) for n in npis])"""
+	if np is not None and len(npis) >= VECTOR_MIN:
+		arr = vectorize(npis)
+		if arr is not None:
+			return to_array(arr)
+
+	return array('L', [int(n) for n in npis])
+
+
+def filter_npis(npis, npi_filter: set) -> array:
+	"""array('L') of the NPIs in npis (converted like convert_npis)
+	that are in npi_filter"""
+	if np is not None and len(npis) >= VECTOR_MIN and isinstance(npi_filter, NPIFilter):
+		arr = vectorize(npis)
+		if arr is not None:
+			return to_array(npi_filter.compiled().filter(arr))
+
+	# Convert first, so bad NPIs raise even if they'd be filtered out
+	npis = array('L', [int(n) for n in npis])
+	return array('L', [n for n in npis if n in npi_filter])
@@ -0,0 +1,216 @@
+"""
+Writing in-network items, on one core or many
+##############################################
+
+Once the parser has an in-network item (and the reference map), the rest
+of the work doesn't depend on the file: swap the references in, filter the
+NPIs, build the rows and hash them. The writers here take the parser's
+items and do that.
+
+SerialWriter does it all in this process, like the flattener always has.
+
+PoolWriter sends batches of items to a pool of processes. Each worker gets
+the reference map (and the filters) once, when it starts, so only the raw
+items go over the pipe. Workers hand back the rows they built and the main
+process writes them to the sinks in the same order the items came in, so
+the output is the same as SerialWriter's, dedup included. The parser and
+the sink writes stay in the main process; everything else runs in parallel.
+
+Usage:
+>>> in_network_file_to_csv(..., workers = 16)
+"""
+from __future__ import annotations
+
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator
+
+from mrfutils import flatteners, metrics
+from mrfutils.checkpoint import Checkpointer
+from mrfutils.hashers import get_hash_mode, set_hash_mode
+from mrfutils.tenants import TenantIndex
+
+log = logging.getLogger('mrfutils')
+
+# Items per task. Big enough that pickling overhead doesn't
+# dominate, small enough to keep every worker busy
+BATCH_SIZE = 64
+
+# Batches in flight per worker
+BATCHES_PER_WORKER = 4
+
+
+class SerialWriter:
+
+	def __init__(
+		self,
+		file_id: str,
+		sinks: dict,
+		npi_filter: set | None,
+		tenant_index: TenantIndex | None,
+		checkpointer: Checkpointer | None = None,
+	):
+		self.file_id = file_id
+		self.sinks = sinks
+		self.npi_filter = npi_filter
+		self.tenant_index = tenant_index
+		self.checkpointer = checkpointer
+
+	def write(self, in_network_items: Iterable, ref_map: dict | None) -> None:
+		"""Takes in-network items as they come out of the parser"""
+		in_network_items = metrics.track_items(in_network_items)
+
+		if self.checkpointer is not None:
+			self.checkpointer.start(ref_map)
+			# Each item is written before the next one is read
+			in_network_items = self.checkpointer.track(in_network_items)
+
+		with metrics.stage('build'):
+			self.write_items(in_network_items, ref_map)
+
+	def write_items(self, in_network_items: Iterable, ref_map: dict | None) -> None:
+		swapped_items = flatteners.swap_references(in_network_items, ref_map)
+		flatteners.write_in_network_items(
+			self.file_id,
+			swapped_items,
+			self.sinks,
+			self.npi_filter,
+			self.tenant_index,
+		)
+
+
+class RowBuffer:
+	"""A sink that just remembers what was written to it"""
+
+	def __init__(self, name: str | None, rows: list):
+		self.name = name
+		self.rows = rows
+
+	def write(self, table_name: str, row_data) -> None:
+		self.rows.append((self.name, table_name, row_data))
+
+
+# The worker's copy of the writer's state, set once by init_worker
+worker_state = {}
+
+
+def init_worker(
+	ref_map: dict | None,
+	file_id: str,
+	npi_filter: set | None,
+	tenant_index: TenantIndex | None,
+	hash_mode: str,
+	collect_stats: bool = False,
+) -> None:
+	set_hash_mode(hash_mode)
+
+	if collect_stats:
+		# Sent back with every batch, see process_batch
+		metrics.active = metrics.RunStats()
+		metrics.active.start()
+
+	rows = []
+	if tenant_index is None:
+		sinks = {None: RowBuffer(None, rows)}
+	else:
+		sinks = {name: RowBuffer(name, rows) for name in tenant_index.names}
+
+	worker_state.update(
+		writer = SerialWriter(file_id, sinks, npi_filter, tenant_index),
+		ref_map = ref_map,
+		rows = rows,
+	)
+
+
+def process_batch(in_network_items: list[dict]) -> tuple[list[tuple], tuple | None]:
+	"""Returns (sink name, table name, row data) for every write, and
+	what was counted while building them (if stats are on)"""
+	rows = worker_state['rows']
+	with metrics.stage('build'):
+		worker_state['writer'].write_items(in_network_items, worker_state['ref_map'])
+
+	batch_rows = rows.copy()
+	rows.clear()
+
+	stats = metrics.active
+	if stats is None:
+		return batch_rows, None
+
+	batch_stats = (dict(stats.counters), stats.stages)
+	stats.counters.clear()
+	stats.stages = {}
+	return batch_rows, batch_stats
+
+
+def gen_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+	items = iter(items)
+	while batch := list(itertools.islice(items, batch_size)):
+		yield batch
+
+
+class PoolWriter(SerialWriter):
+
+	def __init__(
+		self,
+		file_id: str,
+		sinks: dict,
+		npi_filter: set | None,
+		tenant_index: TenantIndex | None,
+		workers: int,
+		batch_size: int = BATCH_SIZE,
+		checkpointer: Checkpointer | None = None,
+	):
+		super().__init__(file_id, sinks, npi_filter, tenant_index, checkpointer)
+		self.workers = workers
+		self.batch_size = batch_size
+
+	def write(self, in_network_items: Iterable, ref_map: dict | None) -> None:
+		in_network_items = metrics.track_items(in_network_items)
+
+		if self.checkpointer is not None:
+			self.checkpointer.start(ref_map)
+			in_network_items = self.checkpointer.skip(in_network_items)
+
+		initargs = (
+			ref_map,
+			self.file_id,
+			self.npi_filter,
+			self.tenant_index,
+			get_hash_mode(),
+			metrics.active is not None,
+		)
+
+		with ProcessPoolExecutor(
+			max_workers = self.workers,
+			initializer = init_worker,
+			initargs = initargs,
+		) as pool:
+			# Bounded, so the parser can't run ahead of
+			# the workers and fill up memory
+			max_pending = self.workers * BATCHES_PER_WORKER
+			pending = deque()
+
+			for batch in gen_batches(in_network_items, self.batch_size):
+				pending.append((pool.submit(process_batch, batch), len(batch)))
+				if len(pending) >= max_pending:
+					self.write_rows(*pending.popleft())
+
+			while pending:
+				self.write_rows(*pending.popleft())
+
+	def write_rows(self, future, n_items: int) -> None:
+		with metrics.stage('wait'):
+			batch_rows, batch_stats = future.result()
+
+		if batch_stats is not None:
+			metrics.active.merge(*batch_stats)
+
+		for name, table_name, row_data in batch_rows:
+			self.sinks[name].write(table_name, row_data)
+
+		# Rows are written in item order, so every item up
+		# to the end of this batch is in the sinks
+		if self.checkpointer is not None:
+			self.checkpointer.advance(n_items)
@@ -0,0 +1,268 @@
+"""
+A compact provider reference map
+################################
+
+The reference map used to be a dict of provider_group_id -> list of group
+dicts, each with its own tin dict and NPI array. That's several hundred
+bytes of Python objects per group before counting a single NPI, and files
+with hundreds of thousands of references need tens of GB for it.
+
+CompactReferenceMap keeps everything in a handful of flat arrays, CSR
+style:
+
+	ref_offsets[slot:slot + 2]   -> range of the reference's groups
+	group_tins[group]            -> number of the group's TIN
+	npi_offsets[group:group + 2] -> range of the group's NPIs in `npis`
+
+All NPIs live in one uint32 array (uint64 if an NPI doesn't fit). TINs are
+interned: each distinct TIN is stored once, as a type code and a value
+string.
+
+Once all references are in, seal() sorts the provider_group_ids into an
+array that's binary-searched for the slot, and drops the lookup tables
+only needed while adding. swap_references only ever calls .get(id, []).
+The groups of a reference are built when it's asked for, and the last
+CACHE_SIZE references looked up are kept, since the same ones tend to
+come up again and again. Each TIN dict is built once and shared by every
+group with that TIN. So the dicts held at any time are bounded by the
+cache, not by the number of references.
+
+The arrays can also be moved to a memory-mapped temporary file once the map
+is sealed, so the OS can page them out:
+
+>>> set_mmap_dir('/mnt/scratch')
+"""
+from __future__ import annotations
+
+import bisect
+import mmap
+import tempfile
+from array import array
+from collections import OrderedDict
+
+# Arrays that get moved to the memory-mapped file
+ARRAYS = (
+	'ref_offsets',
+	'group_tins',
+	'npi_offsets',
+	'npis',
+	'tin_types',
+	'sorted_ids',
+	'sorted_slots',
+)
+
+# References whose groups are kept after they're built
+CACHE_SIZE = 4096
+
+mmap_dir = None
+
+
+def set_mmap_dir(path: str | None) -> None:
+	"""Memory-map reference maps in this directory (None to keep
+	them in memory)"""
+	global mmap_dir
+	mmap_dir = path
+
+
+class CompactReferenceMap:
+
+	def __init__(self):
+		self.ref_offsets = array('Q', [0])
+		self.group_tins = array('I')
+		self.npi_offsets = array('Q', [0])
+		self.npis = array('I')
+
+		# TIN number -> type (as a number in type_names) and value
+		self.tin_types = array('B')
+		self.tin_values: list[str] = []
+		self.type_names: list[str] = []
+
+		# Slot -> provider_group_id, while adding
+		self.ids = array('q')
+		# Ids that aren't 64-bit ints. Not allowed by the
+		# schema, but nothing stops a file from using them
+		self.other_slots: dict = {}
+
+		# Only needed while adding
+		self.tin_numbers: dict[tuple, int] | None = {}
+		self.type_numbers: dict[str, int] | None = {}
+
+		self.sorted_ids = None
+		self.sorted_slots = None
+
+		# Built on lookup: id -> groups (None if it isn't in
+		# the map) for the last CACHE_SIZE ids, TIN number -> tin dict
+		self.id_groups: OrderedDict = OrderedDict()
+		self.tins: list[dict | None] = []
+
+		self.file = None
+		self.mmap = None
+
+	@property
+	def sealed(self) -> bool:
+		return self.sorted_ids is not None
+
+	def intern_tin(self, tin: dict) -> int:
+		key = (tin.get('type'), tin.get('value'))
+		number = self.tin_numbers.get(key)
+		if number is None:
+			type_number = self.type_numbers.get(key[0])
+			if type_number is None:
+				type_number = self.type_numbers[key[0]] = len(self.type_names)
+				self.type_names.append(key[0])
+
+			number = self.tin_numbers[key] = len(self.tin_values)
+			self.tin_types.append(type_number)
+			self.tin_values.append(key[1])
+		return number
+
+	def add(self, group_id, groups: list[dict]) -> None:
+		"""Adds a processed reference. Like a dict, adding the
+		same id again replaces it"""
+		if self.sealed:
+			raise ValueError("Can't add to a sealed reference map")
+
+		for group in groups:
+			self.group_tins.append(self.intern_tin(group['tin']))
+			npis = list(group['npi'])
+			try:
+				# fromlist leaves the array as it was if it fails
+				self.npis.fromlist(npis)
+			except OverflowError:
+				self.npis = array('Q', self.npis)
+				self.npis.fromlist(npis)
+			self.npi_offsets.append(len(self.npis))
+
+		slot = len(self.ref_offsets) - 1
+		try:
+			self.ids.append(group_id)
+		except (TypeError, OverflowError):
+			self.ids.append(0)
+			self.other_slots[group_id] = slot
+		else:
+			self.other_slots.pop(group_id, None)
+		self.ref_offsets.append(len(self.group_tins))
+
+	def seal(self) -> None:
+		"""Builds the sorted id index and drops what's only
+		needed for adding"""
+		if self.sealed:
+			return
+
+		other = set(self.other_slots.values())
+		# Stable, so the last slot added for an id sorts last
+		order = sorted(
+			(slot for slot in range(len(self.ids)) if slot not in other),
+			key = self.ids.__getitem__,
+		)
+		self.sorted_ids = array('q', (self.ids[slot] for slot in order))
+		self.sorted_slots = array('Q', order)
+
+		self.ids = None
+		self.tin_numbers = None
+		self.type_numbers = None
+		self.tins = [None] * len(self.tin_values)
+
+	def find_slot(self, group_id) -> int | None:
+		if not self.sealed:
+			self.seal()
+
+		if group_id in self.other_slots:
+			return self.other_slots[group_id]
+
+		try:
+			i = bisect.bisect_right(self.sorted_ids, group_id) - 1
+		except TypeError:
+			# Not comparable with ints
+			return None
+
+		if i >= 0 and self.sorted_ids[i] == group_id:
+			return self.sorted_slots[i]
+		return None
+
+	def tin(self, number: int) -> dict:
+		tin = self.tins[number]
+		if tin is None:
+			tin = self.tins[number] = dict(
+				type = self.type_names[self.tin_types[number]],
+				value = self.tin_values[number],
+			)
+		return tin
+
+	def group(self, number: int) -> dict:
+		start, end = self.npi_offsets[number], self.npi_offsets[number + 1]
+		return dict(
+			npi = self.npis[start:end],
+			tin = self.tin(self.group_tins[number]),
+		)
+
+	def get(self, group_id, default = None) -> list[dict] | None:
+		id_groups = self.id_groups
+		try:
+			groups = id_groups[group_id]
+		except KeyError:
+			groups = id_groups[group_id] = self.build(group_id)
+			if len(id_groups) > CACHE_SIZE:
+				id_groups.popitem(last = False)
+		else:
+			id_groups.move_to_end(group_id)
+		return default if groups is None else groups
+
+	def build(self, group_id) -> list[dict] | None:
+		slot = self.find_slot(group_id)
+		if slot is None:
+			return None
+
+		start, end = self.ref_offsets[slot], self.ref_offsets[slot + 1]
+		return [self.group(number) for number in range(start, end)]
+
+	def __getitem__(self, group_id) -> list[dict]:
+		groups = self.get(group_id)
+		if groups is None:
+			raise KeyError(group_id)
+		return groups
+
+	def __contains__(self, group_id) -> bool:
+		return self.find_slot(group_id) is not None
+
+	def __len__(self) -> int:
+		"""Number of references added (an id added twice
+		counts twice)"""
+		return len(self.ref_offsets) - 1
+
+	def freeze(self, dir: str | None = None) -> None:
+		"""Seals the map and moves the arrays to a memory-mapped
+		temporary file"""
+		self.seal()
+		self.file = tempfile.TemporaryFile(dir = dir)
+
+		layout = []
+		for name in ARRAYS:
+			arr = getattr(self, name)
+			layout.append((name, self.file.tell(), len(arr), arr.typecode, arr.itemsize))
+			arr.tofile(self.file)
+		self.file.flush()
+
+		self.mmap = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+		view = memoryview(self.mmap)
+		for name, start, length, typecode, itemsize in layout:
+			setattr(self, name, view[start:start + length * itemsize].cast(typecode))
+
+	def __getstate__(self) -> dict:
+		state = self.__dict__.copy()
+		# Built again on lookup, by whoever unpickles it
+		state.update(file = None, mmap = None, id_groups = OrderedDict(), tins = [None] * len(self.tins))
+		if self.mmap is not None:
+			# memoryviews can't be pickled: send plain arrays
+			for name in ARRAYS:
+				view = getattr(self, name)
+				state[name] = array(view.format, view)
+		return state
+
+
+def seal(ref_map: CompactReferenceMap) -> CompactReferenceMap:
+	"""Seals ref_map, and memory-maps it if set_mmap_dir was called"""
+	ref_map.seal()
+	if mmap_dir is not None and ref_map:
+		ref_map.freeze(mmap_dir)
+	return ref_map
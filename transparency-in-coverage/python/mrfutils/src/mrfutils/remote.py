@@ -0,0 +1,351 @@
+"""
+Reading remote MRFs
+###################
+
+A big MRF is one HTTP response that takes hours to stream, and before
+this a connection reset anywhere in it killed the run.
+
+RemoteReader is the file object JSONOpen hands to the decompressor (or to
+ijson) for remote files. It counts the bytes it has returned, and when the
+connection drops, times out or ends early, it reconnects and asks for the
+rest with `Range: bytes=<position>-`. The bytes it returns are the same
+either way, so the decompressor and the parser never notice. If the server
+ignores the Range header, the response is read from the start again and the
+bytes we already have are thrown away. If the file changed in the meantime
+(a different ETag or Last-Modified), reading fails with FetchError instead
+of splicing two files together. So does running out of reconnects: RETRIES
+in a row without getting a byte.
+
+The first request accepts gzip, so plain .json files, which servers
+usually gzip on the fly, come over in a tenth of the bytes or less. The
+positions count the bytes as they were sent, so a reconnect asks for the
+same encoding again, and fails if it gets another one. Servers that gzip
+on the fly tend to ignore Range, so for those files a reconnect reads
+the response again up to where it left off.
+
+Reading a URL more than once (the second pass over a file whose
+provider_references come last, or another run over the same file) can come
+from disk instead:
+
+>>> set_cache_dir('mrf_cache')
+
+Then RemoteReader tees the bytes it reads, as they came over the wire
+(still gzipped), into a file in that directory, which JSONOpen opens
+instead of the URL from then on. A .json that was sent gzipped is saved
+as a .json.gz (cached_copy looks for both). The file only gets its name once the
+whole response has been read, so a cached copy is always complete.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import random
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+import urllib3
+
+from mrfutils.exceptions import FetchError
+
+log = logging.getLogger('mrfutils')
+
+# Reconnects in a row without reading anything
+RETRIES = 8
+
+# Seconds. The n-th reconnect waits a random time
+# between 0 and min(MAX_BACKOFF, BACKOFF * 2**n)
+BACKOFF = 1
+MAX_BACKOFF = 60
+
+# Seconds to connect, and between bytes
+TIMEOUT = (30, 120)
+
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+GZIP_ENCODINGS = {'gzip', 'x-gzip'}
+
+COPY_SIZE = 2**20
+
+# Bytes read off the connection at a time. A reset loses
+# what's been read of the piece it happens in
+PIECE_SIZE = 2**16
+
+# What can go wrong with a connection, and is worth another try
+CONNECTION_ERRORS = (
+	requests.RequestException,
+	urllib3.exceptions.HTTPError,
+	ConnectionError,
+	TimeoutError,
+)
+
+default_cache_dir = None
+
+
+def set_cache_dir(cache_dir: str | None) -> None:
+	"""Keep copies of remote files in cache_dir (None to stop)"""
+	global default_cache_dir
+	default_cache_dir = cache_dir
+
+
+def cache_path(url: str, suffix: str) -> Path | None:
+	"""Where the copy of url goes. The suffix is kept so the
+	copy is opened like the URL would be"""
+	if default_cache_dir is None:
+		return None
+	key = hashlib.sha256(url.encode()).hexdigest()[:32]
+	return Path(default_cache_dir) / f'{key}{suffix}'
+
+
+def cached_copy(url: str, suffix: str) -> str | None:
+	suffixes = (suffix, f'{suffix}.gz') if suffix.endswith('.json') else (suffix,)
+	for suffix in suffixes:
+		path = cache_path(url, suffix)
+		if path is not None and path.exists():
+			return str(path)
+	return None
+
+
+class RemoteReader:
+	"""
+	A read-only file object over the body of a GET, which
+	reconnects where it left off (see the module docstring).
+	`tee` is a path to save a copy of the body to.
+	"""
+
+	def __init__(
+		self,
+		url: str,
+		tee: str | Path | None = None,
+		retries: int = RETRIES,
+		backoff: float = BACKOFF,
+		max_backoff: float = MAX_BACKOFF,
+		timeout: tuple = TIMEOUT,
+	):
+		self.url = url
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.timeout = timeout
+
+		self.session = requests.Session()
+		self.response = None
+
+		# Bytes returned so far
+		self.pos = 0
+		# From the first response
+		self.size = None
+		self.etag = None
+		self.last_modified = None
+		self.content_encoding = None
+
+		self.failures = 0
+		self.reconnects = 0
+		self.closed = False
+
+		self.tee_path = None
+		self.tee_file = None
+		self.tee_tmp = None
+
+		try:
+			self.connect()
+		except CONNECTION_ERRORS as e:
+			self.reconnect(repr(e))
+
+		if tee is not None:
+			self.start_tee(Path(tee))
+
+	def readable(self) -> bool:
+		return True
+
+	def start_tee(self, path: Path) -> None:
+		if self.content_encoding in GZIP_ENCODINGS and not path.name.endswith('.gz'):
+			# Gzipped bytes of a .json
+			path = path.with_name(f'{path.name}.gz')
+		elif self.content_encoding not in (None, 'identity', *GZIP_ENCODINGS):
+			log.info(f'Not caching {self.url}: it is sent with Content-Encoding {self.content_encoding}')
+			return
+
+		path.parent.mkdir(parents = True, exist_ok = True)
+		fd, self.tee_tmp = tempfile.mkstemp(dir = path.parent, prefix = path.name, suffix = '.part')
+		self.tee_file = os.fdopen(fd, 'wb')
+		self.tee_path = path
+
+	def headers(self) -> dict:
+		if not self.pos:
+			# Only what JSONOpen can inflate
+			return {'Accept-Encoding': 'gzip'}
+
+		# Byte offsets are offsets into what the first response
+		# sent, so they only hold for the same encoding
+		headers = {
+			'Accept-Encoding': self.content_encoding or 'identity',
+			'Range': f'bytes={self.pos}-',
+		}
+		# A 200 with the whole file if it changed
+		if self.etag and not self.etag.startswith('W/'):
+			headers['If-Range'] = self.etag
+		elif self.last_modified:
+			headers['If-Range'] = self.last_modified
+		return headers
+
+	def connect(self) -> None:
+		response = self.session.get(
+			self.url,
+			headers = self.headers(),
+			stream = True,
+			timeout = self.timeout,
+		)
+		if response.status_code in RETRY_STATUSES:
+			response.close()
+			raise requests.HTTPError(f'HTTP {response.status_code}')
+
+		if response.status_code not in (200, 206):
+			response.close()
+			raise FetchError(f'{self.url}: HTTP {response.status_code}')
+
+		self.response = response
+		headers = response.headers
+
+		# The first response, or a retry of it
+		if not self.pos:
+			length = headers.get('Content-Length')
+			self.size = int(length) if length and response.status_code == 200 else None
+			self.etag = headers.get('ETag')
+			self.last_modified = headers.get('Last-Modified')
+			self.content_encoding = headers.get('Content-Encoding')
+			return
+
+		if headers.get('Content-Encoding') != self.content_encoding:
+			raise FetchError(
+				f'{self.url}: sent with Content-Encoding {headers.get("Content-Encoding")} after'
+				f' {self.content_encoding}, can\'t pick up where it left off'
+			)
+
+		if response.status_code == 206:
+			match = re.match(r'bytes (\d+)-', headers.get('Content-Range', ''))
+			if not match or int(match.group(1)) != self.pos:
+				raise FetchError(f'{self.url}: asked for bytes {self.pos}-, got {headers.get("Content-Range")}')
+			return
+
+		# A 200 to a Range request: the file changed, or
+		# the server doesn't do ranges
+		if (
+			(self.etag and headers.get('ETag') != self.etag)
+			or (self.last_modified and headers.get('Last-Modified') != self.last_modified)
+		):
+			raise FetchError(f'{self.url} changed while it was being read')
+
+		log.warning(f'{self.url}: the server ignored Range, skipping {self.pos:,} bytes')
+		to_skip = self.pos
+		while to_skip:
+			data = response.raw.read(min(to_skip, COPY_SIZE))
+			if not data:
+				raise requests.ConnectionError('Connection closed while skipping')
+			to_skip -= len(data)
+
+	def reconnect(self, reason: str) -> None:
+		while True:
+			self.failures += 1
+			if self.failures > self.retries:
+				raise FetchError(f'{self.url}: {reason} at byte {self.pos:,}, after {self.retries} reconnects')
+
+			wait = random.uniform(0, min(self.max_backoff, self.backoff * 2**(self.failures - 1)))
+			log.warning(f'Reconnecting to {self.url} at byte {self.pos:,} in {wait:.1f}s: {reason}')
+			time.sleep(wait)
+
+			if self.response is not None:
+				self.response.close()
+				self.response = None
+
+			try:
+				self.connect()
+				self.reconnects += 1
+				return
+			except CONNECTION_ERRORS as e:
+				reason = repr(e)
+
+	def read(self, size: int = -1) -> bytes:
+		if size is None or size < 0:
+			parts = []
+			while data := self.read(COPY_SIZE):
+				parts.append(data)
+			return b''.join(parts)
+
+		parts = []
+		while size > 0:
+			data = self.read_piece(min(size, PIECE_SIZE))
+			if not data:
+				break
+			parts.append(data)
+			size -= len(data)
+		return b''.join(parts)
+
+	def read_piece(self, size: int) -> bytes:
+		while True:
+			try:
+				# Not decoded: these are the bytes the ranges count
+				data = self.response.raw.read(size, decode_content = False)
+			except CONNECTION_ERRORS as e:
+				self.reconnect(repr(e))
+				continue
+
+			if not data and self.size is not None and self.pos < self.size:
+				self.reconnect(f'connection closed after {self.pos:,} of {self.size:,} bytes')
+				continue
+			break
+
+		self.pos += len(data)
+		if data:
+			self.failures = 0
+
+		if self.tee_file is not None:
+			if data:
+				self.tee_file.write(data)
+			else:
+				self.finish_tee()
+
+		return data
+
+	def readinto(self, b) -> int:
+		data = self.read(len(b))
+		b[:len(data)] = data
+		return len(data)
+
+	def finish_tee(self) -> None:
+		"""Called at the end of the body: the copy is complete"""
+		self.tee_file.flush()
+		os.fsync(self.tee_file.fileno())
+		self.tee_file.close()
+		self.tee_file = None
+		os.replace(self.tee_tmp, self.tee_path)
+		log.info(f'Saved a copy of {self.url} to {self.tee_path}')
+
+	def drain(self) -> None:
+		"""Reads the rest of the body, if it's being copied, so
+		the copy is complete even if the reader stopped early"""
+		if self.tee_file is None:
+			return
+		while self.read(COPY_SIZE):
+			pass
+
+	def close(self) -> None:
+		if self.closed:
+			return
+		self.closed = True
+
+		if self.tee_file is not None:
+			# Incomplete
+			self.tee_file.close()
+			os.unlink(self.tee_tmp)
+			self.tee_file = None
+
+		if self.response is not None:
+			self.response.close()
+		self.session.close()
+
+		if self.reconnects:
+			log.info(f'Read {self.url} with {self.reconnects} reconnects')
@@ -0,0 +1,391 @@
+"""
+Flattening a downloader inventory
+#################################
+
+The downloaders (python/downloaders) record every in-network file they
+find in the in_network_files(url, size) table of a sqlite file, with the
+size from a HEAD request (-1 when the server didn't say). Scheduler
+flattens everything in one of those inventories, several files at a time,
+each with in_network_file_to_csv in a process of its own, writing to a
+directory of its own under out_dir.
+
+Files start largest first, so the biggest ones aren't still running at the
+end while the other slots sit idle. Each file's memory is estimated from
+its size (MemoryModel), and a file only starts if its estimate fits in
+what the running files leave of `memory`. If it doesn't, the files after
+it wait too, so a big file can't be held back forever by smaller ones; a
+file that doesn't fit even on its own runs alone. Files the inventory
+doesn't have a size for go last, and are assumed to be as big as the
+biggest one it does.
+
+Each file's state is kept in the same sqlite file, in flatten_jobs:
+pending, running, done or failed, with the attempts so far, the last
+error, how long it took and the peak memory of its process (to check the
+MemoryModel against). A file whose run fails, or whose process is killed
+(by the OOM killer, say), goes back in the queue and picks up from its
+last checkpoint, until it's been tried `attempts` times. Running the
+scheduler again skips the files that are done, retries the ones that
+failed if `retry_failed`, and starts over the ones a dead scheduler left
+running.
+
+Settings like set_cache_dir() carry over to the files' processes on
+platforms that fork (Linux). The hash mode always does.
+
+Usage:
+>>> scheduler = Scheduler('aetna_data.db', 'aetna_csv', jobs = 8, memory = 64 * 2**30)
+>>> scheduler.run(code_filter = codes)
+"""
+from __future__ import annotations
+
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from mrfutils import flatteners
+from mrfutils.hashers import get_hash_mode, set_hash_mode
+from mrfutils.metrics import RunStats, format_bytes
+
+log = logging.getLogger('mrfutils')
+
+JOBS_TABLE = 'flatten_jobs'
+
+# Times a file is tried before it's marked failed
+ATTEMPTS = 3
+
+# Bytes. The memory of a process flattening a file of `size` bytes (as
+# it's stored, usually gzipped) is estimated as BASE + PER_BYTE * size
+MEMORY_BASE = 256 * 2**20
+MEMORY_PER_BYTE = 0.1
+
+# Of the machine's memory, for the default budget
+MEMORY_FRACTION = 0.8
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS {JOBS_TABLE} (
+	url TEXT PRIMARY KEY,
+	size INTEGER,
+	status TEXT NOT NULL DEFAULT '{PENDING}',
+	attempts INTEGER NOT NULL DEFAULT 0,
+	out_dir TEXT,
+	error TEXT,
+	started REAL,
+	finished REAL,
+	seconds REAL,
+	peak_rss INTEGER
+)
+"""
+
+
+class MemoryModel:
+	"""
+	Estimates the memory a file needs from its size. Most of it is the
+	provider reference map, which grows with the file, and every pool
+	worker (workers = N) keeps a copy of it
+	"""
+
+	def __init__(self, base: float = MEMORY_BASE, per_byte: float = MEMORY_PER_BYTE):
+		self.base = base
+		self.per_byte = per_byte
+
+	def __call__(self, size: int, workers: int = 0) -> int:
+		return int((self.base + self.per_byte * size) * (1 + workers))
+
+
+def total_memory() -> int | None:
+	try:
+		return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+	except (AttributeError, ValueError, OSError):
+		return None
+
+
+def job_dir_name(url: str) -> str:
+	"""The file's name, and a hash of the URL in case two
+	files have the same name"""
+	name = re.sub(r'[^\w.-]', '_', flatteners.extract_filename_from_url(url))[:100]
+	return f'{name}-{hashlib.sha256(url.encode()).hexdigest()[:8]}'
+
+
+def job_order(job: Job) -> tuple:
+	"""Largest first, then the ones we don't know"""
+	return job.size is None, -(job.size or 0), job.url
+
+
+def peak_rss() -> int:
+	"""Bytes, of this process"""
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 2**10
+
+
+def run_job(conn, url: str, out_dir: str, attempt: int, hash_mode: str, kwargs: dict) -> None:
+	"""Runs in the file's process, and sends back
+	(error or None, peak RSS)"""
+	set_hash_mode(hash_mode)
+	error = None
+	try:
+		# A run that died before its first checkpoint
+		# can have left rows that no checkpoint accounts for
+		resume = bool(glob.glob(os.path.join(out_dir, '.checkpoint-*')))
+		if attempt > 1 and not resume:
+			shutil.rmtree(out_dir, ignore_errors = True)
+		os.makedirs(out_dir, exist_ok = True)
+
+		kwargs.setdefault('checkpoint', True)
+		flatteners.in_network_file_to_csv(
+			url = url,
+			out_dir = out_dir,
+			resume = resume,
+			stats = RunStats(summary_file = os.path.join(out_dir, 'stats.json')),
+			**kwargs,
+		)
+	except Exception:
+		error = traceback.format_exc()
+	conn.send((error, peak_rss()))
+	conn.close()
+
+
+class Job:
+
+	def __init__(self, url: str, size: int | None, attempts: int, estimate: int):
+		self.url = url
+		self.size = size
+		self.attempts = attempts
+		self.estimate = estimate
+		self.process = None
+		self.conn = None
+		self.started = None
+
+
+class Scheduler:
+	"""
+	Flattens the files in `inventory` (a downloader's sqlite file) into
+	out_dir/<file name>-<hash>, `jobs` at a time (default: a process per
+	core), keeping the estimated memory of the running files under
+	`memory` bytes (default: MEMORY_FRACTION of the machine's)
+	"""
+
+	def __init__(
+		self,
+		inventory: str,
+		out_dir: str,
+		jobs: int | None = None,
+		memory: int | None = None,
+		memory_model: MemoryModel | None = None,
+		attempts: int = ATTEMPTS,
+		table: str = 'in_network_files',
+	):
+		self.inventory = inventory
+		self.out_dir = out_dir
+		self.jobs = jobs or os.cpu_count() or 1
+		if memory is None:
+			total = total_memory()
+			memory = int(total * MEMORY_FRACTION) if total else None
+		self.memory = memory
+		self.memory_model = memory_model or MemoryModel()
+		self.attempts = attempts
+		self.table = table
+
+		self.con = sqlite3.connect(inventory, isolation_level = None)
+		self.con.execute(SCHEMA)
+
+	def sync(self) -> None:
+		"""Adds the inventory's new files to the jobs table"""
+		with self.con:
+			self.con.execute(f"""
+				INSERT OR IGNORE INTO {JOBS_TABLE} (url, size)
+				SELECT url, size FROM {self.table}
+			""")
+			# The inventory may have been refreshed
+			self.con.execute(f"""
+				UPDATE {JOBS_TABLE} SET size = (
+					SELECT size FROM {self.table} WHERE {self.table}.url = {JOBS_TABLE}.url
+				)
+				WHERE status = ? AND url IN (SELECT url FROM {self.table})
+			""", (PENDING,))
+
+	def requeue(self, retry_failed: bool = False) -> None:
+		"""Queues the files a scheduler that died left running again,
+		and the ones that failed if retry_failed"""
+		with self.con:
+			self.con.execute(f'UPDATE {JOBS_TABLE} SET status = ? WHERE status = ?', (PENDING, RUNNING))
+			if retry_failed:
+				self.con.execute(
+					f'UPDATE {JOBS_TABLE} SET status = ?, attempts = 0 WHERE status = ?',
+					(PENDING, FAILED),
+				)
+
+	def status(self) -> dict:
+		"""Files and bytes by status"""
+		return {
+			status: dict(files = files, bytes = size or 0)
+			for status, files, size in self.con.execute(f"""
+				SELECT status, COUNT(*), SUM(MAX(size, 0)) FROM {JOBS_TABLE} GROUP BY status
+			""")
+		}
+
+	def plan(self, workers: int = 0) -> list[Job]:
+		"""The pending files, in the order they'll start"""
+		rows = self.con.execute(
+			f'SELECT url, size, attempts FROM {JOBS_TABLE} WHERE status = ?',
+			(PENDING,),
+		).fetchall()
+
+		known = [size for _, size, _ in rows if size is not None and size >= 0]
+		unknown_size = max(known, default = 0)
+
+		jobs = []
+		for url, size, attempts in rows:
+			if size is None or size < 0:
+				size = None
+			estimate = self.memory_model(unknown_size if size is None else size, workers)
+			jobs.append(Job(url, size, attempts, estimate))
+
+		jobs.sort(key = job_order)
+		return jobs
+
+	def run(self, retry_failed: bool = False, **kwargs) -> dict:
+		"""Flattens every pending file. kwargs go to
+		in_network_file_to_csv. Returns status()"""
+		self.sync()
+		self.requeue(retry_failed)
+		queue = self.plan(kwargs.get('workers', 0))
+		log.info(
+			f'{len(queue):,} files to flatten, {self.jobs} at a time'
+			+ (f' in {format_bytes(self.memory)}' if self.memory else '')
+		)
+
+		running: dict = {}
+		try:
+			self.schedule(queue, running, kwargs)
+		finally:
+			# Interrupted: the files that were running start over next time
+			for job in running.values():
+				job.process.terminate()
+				job.process.join()
+			if running:
+				with self.con:
+					self.con.executemany(
+						f'UPDATE {JOBS_TABLE} SET status = ?, attempts = attempts - 1 WHERE url = ?',
+						[(PENDING, job.url) for job in running.values()],
+					)
+
+		status = self.status()
+		log.info('Jobs: ' + ', '.join(f'{s} {v["files"]:,}' for s, v in status.items()))
+		return status
+
+	def schedule(self, queue: list[Job], running: dict, kwargs: dict) -> None:
+		"""Starts the files in queue as they fit, until they're
+		all finished"""
+		total = len(queue)
+		reserved = 0
+		finished = 0
+		while queue or running:
+			while queue and len(running) < self.jobs:
+				job = queue[0]
+				fits = self.memory is None or reserved + job.estimate <= self.memory
+				if not fits and running:
+					break
+				if not fits:
+					log.warning(
+						f'{job.url} is estimated to need {format_bytes(job.estimate)}, more than '
+						f'{format_bytes(self.memory)}. Running it on its own'
+					)
+				queue.pop(0)
+				self.start(job, kwargs)
+				running[job.conn] = job
+				reserved += job.estimate
+
+			for conn in wait(list(running)):
+				job = running.pop(conn)
+				reserved -= job.estimate
+				if self.finish(job):
+					finished += 1
+				elif job.attempts < self.attempts:
+					# Back in line, by size
+					queue.append(job)
+					queue.sort(key = job_order)
+				else:
+					finished += 1
+				log.info(f'{finished:,} of {total:,} files finished, {len(running)} running, {len(queue):,} waiting')
+
+	def start(self, job: Job, kwargs: dict) -> None:
+		job.attempts += 1
+		job.started = time.time()
+		out_dir = os.path.join(self.out_dir, job_dir_name(job.url))
+
+		with self.con:
+			self.con.execute(
+				f'UPDATE {JOBS_TABLE} SET status = ?, attempts = ?, out_dir = ?, started = ? WHERE url = ?',
+				(RUNNING, job.attempts, out_dir, job.started, job.url),
+			)
+
+		job.conn, child_conn = multiprocessing.Pipe(duplex = False)
+		# Not a daemon, so it can start a pool of its own (workers = N)
+		job.process = multiprocessing.Process(
+			target = run_job,
+			args = (child_conn, job.url, out_dir, job.attempts, get_hash_mode(), kwargs),
+			name = f'mrfutils-job-{job_dir_name(job.url)}',
+		)
+		job.process.start()
+		child_conn.close()
+
+		size = 'unknown size' if job.size is None else format_bytes(job.size)
+		log.info(f'Started {job.url} ({size}, attempt {job.attempts})')
+
+	def finish(self, job: Job) -> bool:
+		"""Records how the file's process ended. True if it's done"""
+		try:
+			error, rss = job.conn.recv()
+		except EOFError:
+			# Died without a word: killed, or crashed in C
+			job.process.join()
+			code = job.process.exitcode
+			error = f'Killed by signal {-code}' if code < 0 else f'Process exited with code {code}'
+			rss = None
+		job.process.join()
+		job.conn.close()
+
+		finished = time.time()
+		if error is None:
+			status = DONE
+		elif job.attempts < self.attempts:
+			status = PENDING
+		else:
+			status = FAILED
+
+		with self.con:
+			self.con.execute(
+				f"""UPDATE {JOBS_TABLE}
+				SET status = ?, error = ?, finished = ?, seconds = ?, peak_rss = ?
+				WHERE url = ?""",
+				(status, error, finished, finished - job.started, rss, job.url),
+			)
+
+		if error is None:
+			log.info(f'Done with {job.url} in {finished - job.started:,.0f}s')
+		else:
+			log.error(f'{job.url} failed (attempt {job.attempts} of {self.attempts}): {error.strip().splitlines()[-1]}')
+		return error is None
+
+	def close(self) -> None:
+		self.con.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
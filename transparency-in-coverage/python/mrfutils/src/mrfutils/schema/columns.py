@@ -0,0 +1,67 @@
+"""
+Column types from schema.sql
+############################
+
+SCHEMA (schema.py) only has the column names, in CSV order. The types live
+in schema.sql, which is what the Dolt tables are created from. This reads
+them back out so typed outputs (Parquet, databases) agree with the tables.
+
+>>> column_types()['rate']
+{'id': 'BIGINT UNSIGNED', 'code_id': 'BIGINT UNSIGNED', ..., 'negotiated_rate': 'DECIMAL(9,2)'}
+"""
+from __future__ import annotations
+
+import functools
+import re
+from pathlib import Path
+
+SCHEMA_SQL = Path(__file__).parent / 'schema.sql'
+
+TABLE_RE = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+) \((.*?)\n\);', re.DOTALL)
+COLUMN_RE = re.compile(r'^\s*(\w+)\s+(.+?),?$')
+ENUM_RE = re.compile(r'ENUM\((.*?)\)')
+PRIMARY_KEY_RE = re.compile(r'^\s*PRIMARY KEY \((.*?)\)')
+
+NOT_COLUMNS = ('PRIMARY', 'FOREIGN', 'KEY', 'INDEX', 'UNIQUE')
+
+
+def read_schema_sql() -> str:
+	return SCHEMA_SQL.read_text()
+
+
+@functools.lru_cache()
+def column_types() -> dict[str, dict[str, str]]:
+	"""Table name -> column name -> SQL type (everything after the
+	column name, minus the trailing comma)"""
+	tables = {}
+	for table_name, body in TABLE_RE.findall(read_schema_sql()):
+		columns = {}
+		for line in body.splitlines():
+			line = line.strip()
+			if not line or line.startswith('--'):
+				continue
+			m = COLUMN_RE.match(line)
+			if m is None or m[1].upper() in NOT_COLUMNS:
+				continue
+			columns[m[1]] = m[2]
+		tables[table_name] = columns
+	return tables
+
+
+@functools.lru_cache()
+def primary_keys() -> dict[str, tuple[str, ...]]:
+	"""Table name -> primary key columns"""
+	keys = {}
+	for table_name, body in TABLE_RE.findall(read_schema_sql()):
+		for line in body.splitlines():
+			if m := PRIMARY_KEY_RE.match(line):
+				keys[table_name] = tuple(col.strip() for col in m[1].split(','))
+	return keys
+
+
+def enum_values(sql_type: str) -> list[str] | None:
+	"""The values of an ENUM type, or None for any other type"""
+	m = ENUM_RE.search(sql_type)
+	if m is None:
+		return None
+	return [value.strip().strip('"\'') for value in m[1].split(',')]
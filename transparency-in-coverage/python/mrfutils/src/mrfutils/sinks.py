@@ -0,0 +1,619 @@
+"""
+Where the rows go
+#################
+
+A sink takes rows for the tables in SCHEMA and writes them somewhere.
+The flatteners only ever call
+
+>>> sink.write(table_name, row_data)
+
+where row_data is a row or a list of rows, and close the sink when they're
+done (sinks are context managers).
+
+`write_table` opens and closes the CSV every time it's called, which is
+fine for one row but not for millions. CSVSink opens each table once per
+run and buffers rows in memory until it has `max_rows` rows or `max_bytes`
+bytes for that table.
+
+ParquetSink writes typed, compressed Parquet instead (column types come
+from schema.sql), so polars/duckdb don't have to re-parse every id and
+rate from text. It needs pyarrow: pip install mrfutils[parquet]
+
+SQLiteSink and DuckDBSink load the rows straight into a database file in
+out_dir, with the tables from schema.sql and INSERT OR IGNORE on their
+primary keys, so the database is deduplicated as soon as the run ends and
+there's no CSV import step.
+
+Use `make_sink(out_format, out_dir)` to get a sink by name.
+"""
+from __future__ import annotations
+
+import csv
+import functools
+import io
+import os
+import sqlite3
+
+from mrfutils.schema.columns import column_types, enum_values, primary_keys
+from mrfutils.schema.schema import SCHEMA
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+try:
+	import duckdb
+except ImportError:
+	duckdb = None
+
+# To distinguish data from rows
+Row = dict
+
+MAX_BUFFERED_ROWS = 50_000
+MAX_BUFFERED_BYTES = 4 * 2**20
+
+# Rows per Parquet row group
+ROW_GROUP_SIZE = 200_000
+PARQUET_COMPRESSION = 'zstd'
+
+# Rows (over all tables) per database transaction
+DB_BATCH_SIZE = 200_000
+
+# Parents before children, like dolt_utils/import_*.sh
+TABLE_ORDER = (
+	'file',
+	'code',
+	'rate_metadata',
+	'rate',
+	'tin',
+	'tin_rate_file',
+	'npi_tin',
+	'toc',
+	'toc_plan',
+	'toc_file',
+	'toc_plan_file',
+)
+
+
+class CSVTable:
+	"""One open CSV file and its write buffer"""
+
+	def __init__(self, file_loc: str, fieldnames: list[str]):
+		file_exists = os.path.exists(file_loc)
+
+		# newline = '' is to prevent Windows
+		# from adding \r\n\n to the end of each line
+		self.f = open(file_loc, 'a', newline = '')
+		self.buffer = io.StringIO(newline = '')
+		self.writer = csv.DictWriter(self.buffer, fieldnames = fieldnames)
+		self.n_rows = 0
+
+		if not file_exists:
+			self.writer.writeheader()
+
+	@property
+	def n_bytes(self) -> int:
+		return self.buffer.tell()
+
+	def write(self, row_data: list[Row] | Row) -> None:
+		if isinstance(row_data, list):
+			self.writer.writerows(row_data)
+			self.n_rows += len(row_data)
+
+		elif isinstance(row_data, dict):
+			self.writer.writerow(row_data)
+			self.n_rows += 1
+
+	def flush(self) -> None:
+		self.f.write(self.buffer.getvalue())
+		self.f.flush()
+		self.buffer.seek(0)
+		self.buffer.truncate()
+		self.n_rows = 0
+
+	def sync(self) -> None:
+		self.flush()
+		os.fsync(self.f.fileno())
+
+	def close(self) -> None:
+		self.flush()
+		self.f.close()
+
+
+class CSVSink:
+	"""
+	Usage:
+	>>> with CSVSink(out_dir) as sink:
+	>>>     sink.write('code', code_row)
+
+	Tables are opened the first time they're written to, so tables that
+	never get rows never get files. Like `write_table`, an existing CSV is
+	appended to and the header is only written to new files.
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		max_rows: int = MAX_BUFFERED_ROWS,
+		max_bytes: int = MAX_BUFFERED_BYTES,
+	):
+		self.out_dir = out_dir
+		self.max_rows = max_rows
+		self.max_bytes = max_bytes
+		self.tables: dict[str, CSVTable] = {}
+
+	def table_loc(self, table_name: str) -> str:
+		return f'{self.out_dir}/{table_name}.csv'
+
+	def open_table(self, table_name: str) -> CSVTable:
+		table = CSVTable(self.table_loc(table_name), SCHEMA[table_name])
+		self.tables[table_name] = table
+		return table
+
+	def write(self, table_name: str, row_data: list[Row] | Row) -> None:
+		table = self.tables.get(table_name) or self.open_table(table_name)
+		table.write(row_data)
+
+		if (
+			table.n_rows >= self.max_rows
+			or table.n_bytes >= self.max_bytes
+		):
+			table.flush()
+
+	def flush(self) -> None:
+		for table in self.tables.values():
+			table.flush()
+
+	def checkpoint(self) -> dict:
+		"""Writes everything out and returns the size of every
+		table's file (None if there isn't one)"""
+		for table in self.tables.values():
+			table.sync()
+
+		sizes = {}
+		for table_name in SCHEMA:
+			try:
+				sizes[table_name] = os.path.getsize(self.table_loc(table_name))
+			except FileNotFoundError:
+				sizes[table_name] = None
+		return sizes
+
+	def table_bytes(self) -> dict:
+		"""The size of every table's file, as far as it's been written"""
+		return {
+			table_name: os.path.getsize(self.table_loc(table_name))
+			for table_name in SCHEMA
+			if os.path.exists(self.table_loc(table_name))
+		}
+
+	def restore(self, sizes: dict) -> None:
+		"""Cuts every table's file back to its size at the checkpoint.
+		Only call this before anything is written"""
+		for table_name, size in sizes.items():
+			file_loc = self.table_loc(table_name)
+			if not os.path.exists(file_loc):
+				continue
+			if size is None:
+				os.remove(file_loc)
+			elif os.path.getsize(file_loc) > size:
+				os.truncate(file_loc, size)
+
+	def close(self) -> None:
+		while self.tables:
+			_, table = self.tables.popitem()
+			table.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		# Whatever made it into the buffer is written out even if
+		# the flattener failed, same as writing row by row would
+		self.close()
+
+
+def arrow_type(sql_type: str, decimal_rates: bool = False):
+	"""The Arrow type for a column type in schema.sql"""
+	sql_type = sql_type.upper()
+
+	if sql_type.startswith('BIGINT UNSIGNED'):
+		return pa.uint64()
+	if sql_type.startswith('BIGINT'):
+		return pa.int64()
+	if sql_type.startswith('INT UNSIGNED'):
+		return pa.uint32()
+	if sql_type.startswith('INT'):
+		return pa.int32()
+	if sql_type.startswith('DECIMAL'):
+		if not decimal_rates:
+			return pa.float64()
+		precision, scale = sql_type[sql_type.index('(') + 1:sql_type.index(')')].split(',')
+		return pa.decimal128(int(precision), int(scale))
+	if enum_values(sql_type) is not None:
+		return pa.dictionary(pa.int32(), pa.string())
+
+	# VARCHAR, TEXT, and JSON (which we write as JSON text)
+	return pa.string()
+
+
+def arrow_schema(table_name: str, decimal_rates: bool = False):
+	types = column_types()[table_name]
+	return pa.schema([
+		(column, arrow_type(types.get(column, 'TEXT'), decimal_rates))
+		for column in SCHEMA[table_name]
+	])
+
+
+def to_arrow(values: list, type_):
+	"""An Arrow array of one column"""
+	if pa.types.is_dictionary(type_):
+		values = [value if value is None else str(value) for value in values]
+		return pa.array(values, pa.string()).dictionary_encode()
+
+	if pa.types.is_decimal(type_):
+		return pa.array(values, pa.float64()).cast(type_)
+
+	if pa.types.is_string(type_):
+		# MRFs sometimes have numbers where we expect strings
+		values = [value if value is None or type(value) is str else str(value) for value in values]
+
+	return pa.array(values, type_)
+
+
+class ParquetTable:
+	"""One Parquet file and the rows waiting for the next row group"""
+
+	def __init__(self, file_loc: str, schema):
+		self.schema = schema
+		self.writer = pq.ParquetWriter(file_loc, schema, compression = PARQUET_COMPRESSION)
+		self.rows: list[Row] = []
+
+	@property
+	def n_rows(self) -> int:
+		return len(self.rows)
+
+	def write(self, row_data: list[Row] | Row) -> None:
+		if isinstance(row_data, list):
+			self.rows.extend(row_data)
+
+		elif isinstance(row_data, dict):
+			self.rows.append(row_data)
+
+	def flush(self) -> None:
+		if not self.rows:
+			return
+
+		columns = [
+			to_arrow([row.get(field.name) for row in self.rows], field.type)
+			for field in self.schema
+		]
+		table = pa.Table.from_arrays(columns, schema = self.schema)
+		self.writer.write_table(table)
+		self.rows = []
+
+	def close(self) -> None:
+		self.flush()
+		self.writer.close()
+
+
+class ParquetSink:
+	"""
+	Usage:
+	>>> with ParquetSink(out_dir) as sink:
+	>>>     sink.write('code', code_row)
+
+	Parquet files can't be appended to, so each table is a directory of
+	parts and every run adds a part:
+
+		out_dir/code/part-00000.parquet
+		out_dir/code/part-00001.parquet
+
+	which duckdb and polars read as one table (e.g.
+	`read_parquet('out_dir/code/*.parquet')`).
+
+	Ids are uint64, NPIs uint32, ENUMs are dictionary-encoded and
+	negotiated_rate is float64, or decimal128(9, 2) with
+	`decimal_rates = True` (out_format 'parquet-decimal').
+	"""
+
+	def __init__(
+		self,
+		out_dir: str,
+		row_group_size: int = ROW_GROUP_SIZE,
+		decimal_rates: bool = False,
+	):
+		if pa is None:
+			raise ImportError('The Parquet sink needs pyarrow: pip install mrfutils[parquet]')
+
+		self.out_dir = out_dir
+		self.row_group_size = row_group_size
+		self.decimal_rates = decimal_rates
+		self.tables: dict[str, ParquetTable] = {}
+
+	def table_dir(self, table_name: str) -> str:
+		return f'{self.out_dir}/{table_name}'
+
+	def open_table(self, table_name: str) -> ParquetTable:
+		table_dir = self.table_dir(table_name)
+		os.makedirs(table_dir, exist_ok = True)
+
+		part = 0
+		while os.path.exists(file_loc := f'{table_dir}/part-{part:05d}.parquet'):
+			part += 1
+
+		schema = arrow_schema(table_name, self.decimal_rates)
+		table = ParquetTable(file_loc, schema)
+		self.tables[table_name] = table
+		return table
+
+	def write(self, table_name: str, row_data: list[Row] | Row) -> None:
+		table = self.tables.get(table_name) or self.open_table(table_name)
+		table.write(row_data)
+
+		if table.n_rows >= self.row_group_size:
+			table.flush()
+
+	def flush(self) -> None:
+		for table in self.tables.values():
+			table.flush()
+
+	def parts(self, table_name: str) -> list[str]:
+		try:
+			return sorted(
+				name for name in os.listdir(self.table_dir(table_name))
+				if name.endswith('.parquet')
+			)
+		except FileNotFoundError:
+			return []
+
+	def checkpoint(self) -> dict:
+		"""Finishes the open parts (a Parquet file can't be read until
+		it's closed) and returns every table's parts. The next rows
+		go to new parts"""
+		self.close()
+		return {table_name: self.parts(table_name) for table_name in SCHEMA}
+
+	def table_bytes(self) -> dict:
+		"""The size of every table's finished parts"""
+		return {
+			table_name: sum(
+				os.path.getsize(f'{self.table_dir(table_name)}/{name}')
+				for name in parts
+			)
+			for table_name in SCHEMA
+			if (parts := self.parts(table_name))
+		}
+
+	def restore(self, parts: dict) -> None:
+		"""Deletes the parts written after the checkpoint"""
+		for table_name, kept in parts.items():
+			for name in set(self.parts(table_name)) - set(kept):
+				os.remove(f'{self.table_dir(table_name)}/{name}')
+
+	def close(self) -> None:
+		while self.tables:
+			_, table = self.tables.popitem()
+			table.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class DatabaseSink:
+	"""
+	Buffers rows for every table and writes them all in one transaction
+	every `batch_size` rows, parents before children. Tables are created
+	from schema.sql if they don't exist, without the NOT NULL and FOREIGN
+	KEY constraints: the CSVs don't enforce those either, and the file
+	row is only written after its rates.
+
+	Subclasses set `db_file` and implement connect, sql_type and insert.
+	"""
+
+	db_file = None
+
+	def __init__(self, out_dir: str, batch_size: int = DB_BATCH_SIZE):
+		self.db_loc = f'{out_dir}/{self.db_file}'
+		self.batch_size = batch_size
+		self.rows: dict[str, list[Row]] = {}
+		self.n_rows = 0
+		self.con = self.connect()
+		self.create_tables()
+
+	def create_table_sql(self, table_name: str) -> str:
+		types = column_types()[table_name]
+		columns = [
+			f'"{column}" {self.sql_type(types.get(column, "TEXT"))}'
+			for column in SCHEMA[table_name]
+		]
+		key = ', '.join(f'"{column}"' for column in primary_keys()[table_name])
+		columns.append(f'PRIMARY KEY ({key})')
+		return f'CREATE TABLE IF NOT EXISTS "{table_name}" ({", ".join(columns)})'
+
+	def create_tables(self) -> None:
+		for table_name in TABLE_ORDER:
+			self.con.execute(self.create_table_sql(table_name))
+
+	def insert_sql(self, table_name: str) -> str:
+		columns = SCHEMA[table_name]
+		names = ', '.join(f'"{column}"' for column in columns)
+		params = ', '.join('?' for _ in columns)
+		return f'INSERT OR IGNORE INTO "{table_name}" ({names}) VALUES ({params})'
+
+	def write(self, table_name: str, row_data: list[Row] | Row) -> None:
+		rows = self.rows.setdefault(table_name, [])
+
+		if isinstance(row_data, list):
+			rows.extend(row_data)
+			self.n_rows += len(row_data)
+
+		elif isinstance(row_data, dict):
+			rows.append(row_data)
+			self.n_rows += 1
+
+		if self.n_rows >= self.batch_size:
+			self.flush()
+
+	def flush(self) -> None:
+		if not self.n_rows:
+			return
+
+		self.con.execute('BEGIN TRANSACTION')
+		try:
+			for table_name in TABLE_ORDER:
+				if rows := self.rows.pop(table_name, None):
+					self.insert(table_name, rows)
+		except Exception:
+			self.con.execute('ROLLBACK')
+			raise
+		self.con.execute('COMMIT')
+
+		self.rows = {}
+		self.n_rows = 0
+
+	def checkpoint(self) -> dict:
+		# Rows are inserted with INSERT OR IGNORE, so writing the
+		# ones after the checkpoint again is harmless
+		self.flush()
+		return {}
+
+	def restore(self, state: dict) -> None:
+		pass
+
+	def table_bytes(self) -> dict:
+		# Every table is in the one database file
+		return {}
+
+	def close(self) -> None:
+		try:
+			self.flush()
+		finally:
+			self.con.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+
+
+class SQLiteSink(DatabaseSink):
+	"""
+	Writes to out_dir/mrf.sqlite.
+
+	SQLite integers are signed, so the unsigned 64-bit ids that don't fit
+	are stored as id - 2**64 (the same 64 bits). Use `to_unsigned` (or
+	`(id + (1 << 64)) % (1 << 64)` in SQL) to get the original id back.
+	"""
+
+	db_file = 'mrf.sqlite'
+
+	def connect(self):
+		# isolation_level = None: we run our own transactions
+		con = sqlite3.connect(self.db_loc, isolation_level = None)
+		con.execute('PRAGMA journal_mode = WAL')
+		con.execute('PRAGMA synchronous = OFF')
+		return con
+
+	def sql_type(self, sql_type: str) -> str:
+		sql_type = sql_type.upper()
+		if sql_type.startswith(('BIGINT', 'INT')):
+			return 'INTEGER'
+		if sql_type.startswith('DECIMAL'):
+			return 'REAL'
+		return 'TEXT'
+
+	def insert(self, table_name: str, rows: list[Row]) -> None:
+		types = column_types()[table_name]
+		columns = SCHEMA[table_name]
+		unsigned = {
+			i for i, column in enumerate(columns)
+			if types.get(column, '').upper().startswith('BIGINT UNSIGNED')
+		}
+
+		def values(row: Row) -> tuple:
+			values = [row.get(column) for column in columns]
+			for i in unsigned:
+				if values[i] is not None and values[i] >= 2**63:
+					values[i] -= 2**64
+			return tuple(values)
+
+		self.con.executemany(self.insert_sql(table_name), map(values, rows))
+
+
+def to_unsigned(value: int | None) -> int | None:
+	"""An id read back from SQLiteSink's database"""
+	if value is None:
+		return None
+	return value % 2**64
+
+
+class DuckDBSink(DatabaseSink):
+	"""
+	Writes to out_dir/mrf.duckdb. Ids are UBIGINT. If pyarrow is
+	installed, each batch goes in as an Arrow table instead of row
+	by row.
+	"""
+
+	db_file = 'mrf.duckdb'
+
+	def connect(self):
+		if duckdb is None:
+			raise ImportError('The DuckDB sink needs duckdb: pip install mrfutils[duckdb]')
+		return duckdb.connect(self.db_loc)
+
+	def sql_type(self, sql_type: str) -> str:
+		sql_type = sql_type.upper()
+		if sql_type.startswith('BIGINT UNSIGNED'):
+			return 'UBIGINT'
+		if sql_type.startswith('BIGINT'):
+			return 'BIGINT'
+		if sql_type.startswith('INT UNSIGNED'):
+			return 'UINTEGER'
+		if sql_type.startswith('INT'):
+			return 'INTEGER'
+		if sql_type.startswith('DECIMAL'):
+			return 'DOUBLE'
+		return 'VARCHAR'
+
+	def insert(self, table_name: str, rows: list[Row]) -> None:
+		columns = SCHEMA[table_name]
+
+		if pa is None:
+			values = [tuple(row.get(column) for column in columns) for row in rows]
+			self.con.executemany(self.insert_sql(table_name), values)
+			return
+
+		schema = arrow_schema(table_name)
+		batch = pa.Table.from_arrays(
+			[to_arrow([row.get(field.name) for row in rows], field.type) for field in schema],
+			schema = schema,
+		)
+		self.con.register('batch', batch)
+		try:
+			names = ', '.join(f'"{column}"' for column in columns)
+			self.con.execute(
+				f'INSERT OR IGNORE INTO "{table_name}" ({names}) SELECT {names} FROM batch'
+			)
+		finally:
+			self.con.unregister('batch')
+
+
+SINKS = {
+	'csv': CSVSink,
+	'parquet': ParquetSink,
+	'parquet-decimal': functools.partial(ParquetSink, decimal_rates = True),
+	'sqlite': SQLiteSink,
+	'duckdb': DuckDBSink,
+}
+
+
+def make_sink(out_format: str, out_dir: str):
+	if out_format not in SINKS:
+		raise ValueError(f'Output format must be one of {tuple(SINKS)}: {out_format=}')
+	return SINKS[out_format](out_dir)
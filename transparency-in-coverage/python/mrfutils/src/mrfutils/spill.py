@@ -0,0 +1,66 @@
+"""
+Holding in-network items until the references show up
+######################################################
+
+When provider_references come after in_network (or not at all), we can't
+swap the references into the items as we read them. Without spilling, the
+flattener skips in_network, reads the references and then reads the whole
+file again (downloading it again if it's remote).
+
+In spill mode the items that pass the code filter are pickled to a
+temporary file as they're read, and replayed once the references are
+known. The source is only read once, and only the items we're keeping hit
+the disk. The temporary file goes wherever `tempfile` puts things (set
+TMPDIR to change it) and is deleted when the store is closed.
+
+Usage:
+>>> with SpillStore() as store:
+>>>     store.extend(items)
+>>>     for item in store.replay():
+>>>         ...
+"""
+from __future__ import annotations
+
+import logging
+import pickle
+import tempfile
+from typing import Generator, Iterable
+
+log = logging.getLogger('mrfutils')
+
+BUFFER_SIZE = 2**20
+
+
+class SpillStore:
+
+	def __init__(self, dir: str | None = None):
+		self.f = tempfile.TemporaryFile(dir = dir, buffering = BUFFER_SIZE)
+		self.n_items = 0
+
+	def append(self, item: dict) -> None:
+		# One pickle per item. A shared Pickler would keep
+		# every item alive in its memo
+		pickle.dump(item, self.f, pickle.HIGHEST_PROTOCOL)
+		self.n_items += 1
+
+	def extend(self, items: Iterable[dict]) -> None:
+		for item in items:
+			self.append(item)
+
+	def replay(self) -> Generator:
+		"""Yields the items in the order they were added"""
+		self.f.flush()
+		log.debug(f'Replaying {self.n_items} spilled items ({self.f.tell()} bytes)')
+		self.f.seek(0)
+
+		for _ in range(self.n_items):
+			yield pickle.load(self.f)
+
+	def close(self) -> None:
+		self.f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
@@ -0,0 +1,128 @@
+"""
+Fanning one parse out to many filters
+#####################################
+
+Running the flattener once per NPI list means decompressing and parsing the
+same file once per list. Instead we parse once with the union of every
+tenant's filters and route what survives to each tenant afterwards.
+
+Each tenant gets one bit. The NPI index maps every NPI to the bitmask of the
+tenants that want it, so routing a provider group is a dict lookup per NPI
+instead of a set lookup per NPI per tenant.
+
+A tenant with no NPI set takes every NPI. A tenant with no code set falls
+back to the shared code filter passed to the flattener (if any). Code sets
+can have ranges, prefixes and field rules (see mrfutils.codefilter).
+"""
+from __future__ import annotations
+
+from array import array
+from typing import Generator
+
+from mrfutils.codefilter import CodeFilter, compile_code_filter, union_code_filters
+
+
+class TenantIndex:
+
+	def __init__(
+		self,
+		npi_filters: dict[str, set | None],
+		code_filters: dict[str, set | CodeFilter | None] | None = None,
+		code_filter: set | CodeFilter | None = None,
+	):
+		if not npi_filters:
+			raise ValueError('Need at least one tenant')
+
+		self.names = list(npi_filters)
+		self.bits = {name: 1 << i for i, name in enumerate(self.names)}
+
+		# Tenants without an NPI filter match every NPI
+		self.all_npi_mask = 0
+		self.npi_masks: dict[int, int] = {}
+
+		for name, npis in npi_filters.items():
+			bit = self.bits[name]
+			if not npis:
+				self.all_npi_mask |= bit
+				continue
+			for npi in npis:
+				npi = int(npi)
+				self.npi_masks[npi] = self.npi_masks.get(npi, 0) | bit
+
+		code_filters = code_filters or {}
+		self.code_filters = {
+			name: code_filters.get(name) or code_filter
+			for name in self.names
+		}
+		self.compiled_code_filters = {
+			name: compile_code_filter(code_filter)
+			for name, code_filter in self.code_filters.items()
+		}
+
+	@property
+	def npi_filter(self) -> set | None:
+		"""The union of every tenant's NPIs, or None if any
+		tenant takes every NPI"""
+		if self.all_npi_mask:
+			return None
+		return set(self.npi_masks)
+
+	@property
+	def code_filter(self) -> set | None:
+		"""The union of every tenant's code rules, or None
+		if any tenant takes every item"""
+		return union_code_filters(self.code_filters.values())
+
+	def code_mask(self, in_network_item: dict) -> int:
+		mask = 0
+		for name, code_filter in self.compiled_code_filters.items():
+			if code_filter.matches(in_network_item):
+				mask |= self.bits[name]
+
+		return mask
+
+	def route_group(self, group: dict, mask: int) -> dict[int, dict]:
+		"""Splits one provider group into per-tenant groups,
+		keyed by tenant bit"""
+		npi_masks = self.npi_masks
+		all_npi_mask = self.all_npi_mask
+
+		npis_by_bit: dict[int, list] = {}
+		for npi in group['npi']:
+			npi_mask = (npi_masks.get(npi, 0) | all_npi_mask) & mask
+			while npi_mask:
+				bit = npi_mask & -npi_mask
+				npis_by_bit.setdefault(bit, []).append(npi)
+				npi_mask ^= bit
+
+		return {
+			bit: dict(group, npi = array('L', npis))
+			for bit, npis in npis_by_bit.items()
+		}
+
+	def route(self, in_network_item: dict) -> Generator:
+		"""
+		Yields (tenant_name, in_network_item) for every tenant that has
+		at least one rate left after filtering. The in-network items
+		must already have their references swapped and their NPIs
+		converted to ints (i.e. they went through process_in_network).
+		"""
+		mask = self.code_mask(in_network_item)
+		if not mask:
+			return
+
+		rates_by_bit: dict[int, list] = {}
+		for rate in in_network_item['negotiated_rates']:
+			groups_by_bit: dict[int, list] = {}
+			for group in rate['provider_groups']:
+				for bit, routed_group in self.route_group(group, mask).items():
+					groups_by_bit.setdefault(bit, []).append(routed_group)
+
+			for bit, groups in groups_by_bit.items():
+				routed_rate = dict(rate, provider_groups = groups)
+				rates_by_bit.setdefault(bit, []).append(routed_rate)
+
+		for name in self.names:
+			rates = rates_by_bit.get(self.bits[name])
+			if rates:
+				yield name, dict(in_network_item, negotiated_rates = rates)
@@ -0,0 +1,286 @@
+"""
+Flattening table of contents files
+##################################
+
+A TOC's reporting_structure is a list of items, each with a list of
+reporting_plans and a list of in_network_files. toc_plan_file gets a row
+for every plan and file in an item, with a `link` that's a hash of the
+whole item. Some insurers list the same thousands of in-network files under
+thousands of items, and the flattener used to build every item whole and
+write its plans and files again every time they showed up.
+
+TOCWriter takes an item a piece at a time: each plan and each file as it
+comes out of the parser, and the item's other keys whole. For the item it
+only keeps the plan and file ids (for toc_plan_file) and the item's JSON
+text, which is what the link is a hash of (the same text
+helpers.dicthasher would hash, so the links don't change). toc_plan rows
+are written once per plan id and toc_file rows once per URL, for the whole
+file. Rows go to the sink a whole item (or BATCH_SIZE rows) at a time.
+
+Two readers feed it: write_structure_events takes ijson.parse events (the
+'parse' engine), write_structure_bytes takes a bytescan.ByteScanner and
+hands each item to json.loads (the 'byte_skip' engine).
+
+Usage:
+>>> toc_file_to_csv(..., engine = 'byte_skip')
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from typing import Iterator
+
+import ijson
+
+from mrfutils import flatteners, metrics
+from mrfutils.bytescan import ByteScanner
+from mrfutils.exceptions import InvalidMRF
+from mrfutils.helpers import append_hash
+
+# toc_plan_file rows per write
+BATCH_SIZE = 50_000
+
+ITEM = 'reporting_structure.item'
+PLANS = 'reporting_plans'
+FILES = 'in_network_files'
+
+
+class TOCWriter:
+	"""
+	Usage:
+	>>> writer = TOCWriter(toc_id, sink)
+	>>> writer.start_item()
+	>>> writer.start_array('reporting_plans')
+	>>> writer.add('reporting_plans', plan)
+	>>> writer.add_value('allowed_amount_file', value)
+	>>> writer.end_item()
+	"""
+
+	def __init__(self, toc_id: int, sink, batch_size: int = BATCH_SIZE):
+		self.toc_id = toc_id
+		self.sink = sink
+		self.batch_size = batch_size
+
+		# Hash of the plan's JSON -> plan id, and hash of the URL ->
+		# file id, for the plans and files that have been written
+		self.plan_ids: dict[int, int] = {}
+		self.file_ids: dict[int, int] = {}
+
+		self.start_item()
+
+	def start_item(self) -> None:
+		# Key -> the value as json.dumps(sort_keys = True)
+		# writes it (a list of them for the arrays)
+		self.parts = {}
+		self.plan_rows = []
+		self.file_rows = []
+		self.item_plan_ids = []
+		self.item_file_ids = []
+
+	def add_value(self, key: str, value) -> None:
+		"""A key of the item, other than the arrays we stream"""
+		if key in (PLANS, FILES):
+			# Not an array, so no plans or files
+			self.start_array(key)
+		self.parts[key] = json.dumps(value, sort_keys = True)
+
+	def start_array(self, key: str) -> None:
+		self.parts[key] = []
+		if key == PLANS:
+			self.item_plan_ids = []
+			self.plan_rows = []
+		else:
+			self.item_file_ids = []
+
+	def add(self, key: str, value: dict) -> None:
+		"""An element of reporting_plans or in_network_files"""
+		text = json.dumps(value, sort_keys = True)
+		self.parts[key].append(text)
+		if key == PLANS:
+			self.add_plan(value, text)
+		else:
+			self.add_file(value)
+
+	def add_plan(self, plan: dict, text: str) -> None:
+		text_hash = hash(text)
+		plan_id = self.plan_ids.get(text_hash)
+		if plan_id is None:
+			plan_row = append_hash(plan, 'id', 'toc_plan')
+			plan_row['toc_id'] = self.toc_id
+			plan_id = plan_row['id']
+			# Only written if the item has in-network files
+			self.plan_rows.append((text_hash, plan_row))
+		else:
+			metrics.count('toc_plans_repeated')
+		self.item_plan_ids.append(plan_id)
+
+	def add_file(self, file: dict) -> None:
+		url = file['location']
+		url_hash = hash(url)
+		file_id = self.file_ids.get(url_hash)
+		if file_id is not None:
+			metrics.count('toc_files_repeated')
+			self.item_file_ids.append(file_id)
+			return
+
+		file_row = dict(
+			filename = flatteners.extract_filename_from_url(url)
+		)
+		file_row = append_hash(file_row, 'id', 'toc_file')
+		file_row['toc_id'] = self.toc_id
+		file_row['url'] = url
+		file_row['description'] = file['description']
+		self.file_rows.append(file_row)
+
+		file_id = self.file_ids[url_hash] = file_row['id']
+		self.item_file_ids.append(file_id)
+
+	def link(self) -> int:
+		"""dicthasher() of the whole item"""
+		h = hashlib.sha256(b'{')
+		for n, key in enumerate(sorted(self.parts)):
+			if n:
+				h.update(b', ')
+			value = self.parts[key]
+			if isinstance(value, list):
+				value = f'[{", ".join(value)}]'
+			h.update(f'{json.dumps(key)}: {value}'.encode())
+		h.update(b'}')
+		return int.from_bytes(h.digest()[:8], 'little')
+
+	def end_item(self) -> None:
+		metrics.count('toc_items')
+
+		# Items without in-network files aren't written at all
+		if not self.item_file_ids:
+			self.start_item()
+			return
+
+		plan_rows = []
+		for text_hash, plan_row in self.plan_rows:
+			# Twice in this item
+			if text_hash in self.plan_ids:
+				continue
+			self.plan_ids[text_hash] = plan_row['id']
+			plan_rows.append(plan_row)
+
+		if plan_rows:
+			self.sink.write('toc_plan', plan_rows)
+		if self.file_rows:
+			self.sink.write('toc_file', self.file_rows)
+
+		link = self.link()
+		rows = []
+		for plan_id in self.item_plan_ids:
+			for file_id in self.item_file_ids:
+				rows.append(dict(
+					link = link,
+					toc_file_id = file_id,
+					toc_plan_id = plan_id,
+				))
+			if len(rows) >= self.batch_size:
+				self.sink.write('toc_plan_file', rows)
+				rows = []
+		if rows:
+			self.sink.write('toc_plan_file', rows)
+
+		self.start_item()
+		metrics.tick()
+
+
+def build_value(parser: Iterator, prefix: str, event: str, value):
+	"""Builds the value that starts with this event"""
+	if event not in ('start_map', 'start_array'):
+		return value
+
+	builder = ijson.ObjectBuilder()
+	builder.event(event, value)
+	for p, event, value in parser:
+		builder.event(event, value)
+		if p == prefix and event in ('end_map', 'end_array'):
+			return builder.value
+
+
+def write_structure_events(parser: Iterator, writer: TOCWriter) -> None:
+	"""Reads reporting_structure from ijson.parse events. The
+	parser has to be just past the array's start_array"""
+	key = None
+	for prefix, event, value in parser:
+		if prefix == 'reporting_structure':
+			# end_array
+			return
+
+		if prefix == ITEM:
+			if event == 'map_key':
+				key = value
+			elif event == 'start_map':
+				writer.start_item()
+			elif event == 'end_map':
+				writer.end_item()
+			else:
+				# An item that isn't an object
+				build_value(parser, prefix, event, value)
+
+		elif key in (PLANS, FILES) and event == 'start_array':
+			writer.start_array(key)
+			for p, event, value in parser:
+				if p == prefix:
+					# end_array
+					break
+				writer.add(key, build_value(parser, p, event, value))
+
+		else:
+			writer.add_value(key, build_value(parser, prefix, event, value))
+
+
+def write_structure_bytes(scanner: ByteScanner, writer: TOCWriter) -> None:
+	"""Reads reporting_structure (the value the scanner is at). Each
+	item is small next to the file, and handing it to json.loads whole
+	is much faster than splitting it up in Python"""
+	if scanner.peek() != ord('['):
+		scanner.skip_value()
+		return
+
+	for _ in scanner.gen_array():
+		item = json.loads(scanner.read_value())
+		if not isinstance(item, dict):
+			continue
+
+		writer.start_item()
+		for key, value in item.items():
+			if key in (PLANS, FILES) and isinstance(value, list):
+				writer.start_array(key)
+				for element in value:
+					writer.add(key, element)
+			else:
+				writer.add_value(key, value)
+		writer.end_item()
+
+
+def write_toc_events(f, writer: TOCWriter) -> dict:
+	"""The 'parse' engine. Returns the top-level fields
+	other than reporting_structure"""
+	parser = metrics.count_events(ijson.parse(f))
+	metadata = ijson.ObjectBuilder()
+	for prefix, event, value in parser:
+		if (prefix, event, value) == ('reporting_structure', 'start_array', None):
+			write_structure_events(parser, writer)
+		else:
+			metadata.event(event, value)
+	return metadata.value
+
+
+def write_toc_bytes(f, writer: TOCWriter) -> dict:
+	"""Same as write_toc_events, for the 'byte_skip' engine"""
+	scanner = ByteScanner(f)
+	if scanner.peek() != ord('{'):
+		raise InvalidMRF('MRF is not a JSON object')
+
+	metadata = {}
+	for key in scanner.gen_keys():
+		key = json.loads(key)
+		if key == 'reporting_structure':
+			write_structure_bytes(scanner, writer)
+		else:
+			metadata[key] = json.loads(scanner.read_value())
+	return metadata
@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+
+from mrfutils.bytescan import ByteScanner
+from mrfutils.exceptions import InvalidMRF
+
+
+def scanner(data: bytes, read_size: int) -> ByteScanner:
+    return ByteScanner(io.BytesIO(data), read_size = read_size)
+
+
+@pytest.mark.parametrize('literal', [b'null', b'true', b'false', b'-12.5e3'])
+@pytest.mark.parametrize('cut', range(1, 6))
+def test_scalar_cut_at_read_boundary(literal, cut):
+    # The scalar starts `cut` bytes before the end of the first read
+    data = b'[' + b' ' * (16 - cut - 1) + literal + b', 1]'
+    s = scanner(data, read_size = 16)
+    values = []
+    for _ in s.gen_array():
+        values.append(s.read_value())
+    assert [json.loads(v) for v in values] == [json.loads(literal), 1]
+
+
+def test_bad_scalar_still_raises():
+    with pytest.raises(InvalidMRF):
+        scanner(b'nul', read_size = 2).read_value()
+    with pytest.raises(InvalidMRF):
+        scanner(b'nope, 1', read_size = 2).read_value()
+
+
+VALUES = [
+    {'a': [1, 2, {'b': 'c'}], 'd': None},
+    'brackets ] } [ { in a string',
+    'escaped \\" quote \\\\ and backslash \\\\',
+    '\\\\',
+    '',
+    [[], {}, [[[]]], {'': {'': []}}],
+    -1.5e-7,
+    0,
+    True,
+    False,
+    None,
+    {'"': '\\"}]', 'x': ['"', '\\', '}{', '][']},
+    'unicode é ☃ \\u00e9',
+    [1, 'two', 3.0, None, True, {'six': [7]}],
+]
+
+
+def document(spaces: bool) -> bytes:
+    separator = ', ' if spaces else ','
+    return ('[' + separator.join(json.dumps(v, ensure_ascii = False) for v in VALUES) + ']').encode()
+
+
+@pytest.mark.parametrize('spaces', [False, True])
+@pytest.mark.parametrize('read_size', [1, 2, 3, 5, 7, 64, 2**20])
+def test_skip_value_boundaries(spaces, read_size):
+    data = document(spaces)
+    s = ByteScanner(io.BytesIO(data), read_size = read_size, block_size = 4)
+    bounds = []
+    for _ in s.gen_array():
+        s.peek()
+        start = s.tell
+        s.skip_value()
+        bounds.append((start, s.tell))
+
+    assert s.peek() is None
+    assert [json.loads(data[start:end]) for start, end in bounds] == VALUES
+
+
+@pytest.mark.parametrize('read_size', [1, 3, 64])
+def test_read_value(read_size):
+    s = ByteScanner(io.BytesIO(document(True)), read_size = read_size, block_size = 4)
+    values = []
+    for _ in s.gen_array():
+        values.append(json.loads(s.read_value()))
+    assert values == VALUES
+
+
+@pytest.mark.parametrize('read_size', [1, 4, 64])
+def test_gen_keys(read_size):
+    data = json.dumps({'first': VALUES, 'second': {'nested': VALUES[0]}, 'third': None}).encode()
+    s = ByteScanner(io.BytesIO(data), read_size = read_size, block_size = 4)
+    keys = []
+    for key in s.gen_keys():
+        keys.append(json.loads(key))
+        s.skip_value()
+    assert keys == ['first', 'second', 'third']
+
+
+def test_unterminated_container_raises():
+    s = ByteScanner(io.BytesIO(b'[{"a": [1, 2}'), read_size = 2)
+    with pytest.raises(InvalidMRF):
+        s.skip_value()
@@ -0,0 +1,31 @@
+import pytest
+
+from mrfutils.codefilter import CodeFilter
+
+
+@pytest.mark.parametrize('code, matches', [
+    (('NDC', '00002-3227'), True),
+    (('NDC', '00002'), False),
+    (('NDC', '00002-3228'), False),
+    (('NDC', '3227'), False),
+])
+def test_hyphenated_code_is_exact(code, matches):
+    assert (code in CodeFilter({('NDC', '00002-3227')})) == matches
+
+
+@pytest.mark.parametrize('code, matches', [
+    (('CPT', '90935'), True),
+    (('CPT', '90937'), True),
+    (('CPT', '90940'), True),
+    (('CPT', '90941'), False),
+    (('HCPCS', 'J0125'), True),
+    (('HCPCS', 'J0140'), False),
+    (('HCPCS', 'J01250'), False),
+])
+def test_range(code, matches):
+    code_filter = CodeFilter({('CPT', '90935..90940'), ('HCPCS', 'J0120..J0135')})
+    assert (code in code_filter) == matches
+
+
+def test_range_matches_itself():
+    assert ('CPT', '90935..90940') in CodeFilter({('CPT', '90935..90940')})
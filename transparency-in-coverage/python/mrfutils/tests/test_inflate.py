@@ -0,0 +1,60 @@
+import gzip
+import io
+import shutil
+
+import pytest
+
+from mrfutils import inflate
+
+DATA = b'{"in_network": [' + b', '.join(b'{"billing_code": "%d"}' % i for i in range(50_000)) + b']}'
+GZ = gzip.compress(DATA)
+
+BAD_FILES = {
+    'truncated': GZ[:len(GZ) // 2],
+    'no_trailer': GZ[:-8],
+    'bad_crc': GZ[:-8] + bytes(8),
+}
+
+# pigz and gzip take the same -dc, so the pigz backend can
+# be checked with gzip where pigz isn't installed
+BACKENDS = [backend for backend in inflate.available_backends() if backend != 'pigz']
+BACKENDS += [command for command in (('pigz', '-dc'), ('gzip', '-dc')) if shutil.which(command[0])]
+
+
+@pytest.fixture(params = BACKENDS, ids = str)
+def backend(request, monkeypatch):
+    if isinstance(request.param, tuple):
+        monkeypatch.setattr(inflate, 'PIGZ_COMMAND', request.param)
+        return 'pigz'
+    return request.param
+
+
+def read(data: bytes, backend: str, by_name: bool, threaded: bool, tmp_path) -> bytes:
+    if by_name:
+        path = tmp_path / 'file.json.gz'
+        path.write_bytes(data)
+        f = inflate.open_mrf_gzip(filename = str(path), backend = backend, threaded = threaded)
+    else:
+        f = inflate.open_mrf_gzip(fileobj = io.BytesIO(data), backend = backend, threaded = threaded)
+
+    parts = []
+    try:
+        while chunk := f.read(2**16):
+            parts.append(chunk)
+    finally:
+        f.close()
+    return b''.join(parts)
+
+
+@pytest.mark.parametrize('by_name', [True, False])
+@pytest.mark.parametrize('threaded', [True, False])
+def test_good_file(backend, by_name, threaded, tmp_path):
+    assert read(GZ, backend, by_name, threaded, tmp_path) == DATA
+
+
+@pytest.mark.parametrize('bad', BAD_FILES)
+@pytest.mark.parametrize('by_name', [True, False])
+@pytest.mark.parametrize('threaded', [True, False])
+def test_bad_file_raises(backend, bad, by_name, threaded, tmp_path):
+    with pytest.raises((EOFError, OSError)):
+        read(BAD_FILES[bad], backend, by_name, threaded, tmp_path)